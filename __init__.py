@@ -2,12 +2,14 @@ from __future__ import print_function
 from binja_toolbar import add_image_button, set_bv, add_picker
 from binjatron_extensions import run_binary, step_one, step_over, step_out, \
     continue_exec, get_registers, sync, set_breakpoint, get_memory, kill, \
-    get_backtrace, register_sync_callback, set_tty, sync_state, set_arguments
+    register_sync_callback, set_tty, sync_state, set_arguments, \
+    get_state, registers_request, memory_request, backtrace_request, get_pid, set_memory_backend, \
+    step_n, run_until, set_tracepoints, set_coverage_breakpoints
 from binja_spawn_terminal import spawn_terminal
 from collections import OrderedDict
 from functools import partial
 from time import sleep
-import psutil, os
+import psutil, os, struct
 
 iconsize = (24, 24)
 
@@ -17,9 +19,20 @@ from traceback_viewer import TracebackWindow
 from terminal_emulator import TerminalWindow
 from message_box import MessageBox
 from debugger_arg_window import get_debugger_argument
+from update_scheduler import UpdateScheduler
+from procfs import ProcessMaps, ProcessMemory
+from frame_analysis import ReturnSlotCache
+from trace_recorder import TraceRecorder, MemoryHistory, page_keys
+from perf_monitor import PerfWindow, timed, stage
+from tracepoints import TracepointStore
+from block_coverage import CoverageMap
+from mapping_viewer import MappingWindow
+from heap_viewer import HeapIndex, HeapWindow
+from memory_search import SearchWindow
+from address_classifier import AddressClassifier
 from binaryninja import PluginCommand, log_info, log_alert, log_error, \
  execute_on_main_thread_and_wait, user_plugin_path, get_open_filename_input, BinaryViewType, \
- LowLevelILOperation
+ LowLevelILOperation, BackgroundTask, get_form_input, IntegerField, TextLineField, execute_on_main_thread
 from PyQt5.QtWidgets import QApplication, QMainWindow
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
@@ -33,49 +46,75 @@ reg_width = 64
 reg_prefix = 'r'
 executing_on_stack = False
 stack_bv = None
+scheduler = None
+return_slots = None
+vector_registers = [] # Whichever vector registers are on screen in the register window
+recorder = None
+memory_history = None
+tracepoints = None
+coverage = None
+heap_index = None
+classifier = None
+executed_at = 0 # Generation of the last command that could have moved the inferior
+recorded_at = 0 # Value executed_at had when we last recorded a step in the history
+want_derefs = False # Only ask Voltron for dereference chains while the register window is showing them
 lowest_stack = 0xffffffffffffffff
+stack_slack = 0x1000 # How far below the lowest stack pointer we've seen to speculatively read
+process_maps = None
+last_ip = None
+syscall_opcodes = ['\x0f\x05', '\x0f\x34', '\xcd\x80'] # syscall, sysenter, int 0x80
+last_bp = None
+last_frames = None
+backtrace_dirty = True # Set whenever something other than a single step ran since the last backtrace
+# LLIL operations after which the call stack might not look the same
+frame_changing_ops = [getattr(LowLevelILOperation, op) for op in ['LLIL_CALL', 'LLIL_CALL_STACK_ADJUST', 'LLIL_TAILCALL',
+    'LLIL_RET', 'LLIL_JUMP', 'LLIL_SYSCALL', 'LLIL_TRAP', 'LLIL_UNDEF', 'LLIL_UNIMPL'] if hasattr(LowLevelILOperation, op)]
 
 def get_current_function(bv, addr):
+    if return_slots is not None:
+        return return_slots.function_at(addr)
     blocks = bv.get_basic_blocks_at(addr)
     if len(blocks) > 0:
         return blocks[0].function
 
+@timed("return_address")
 def calculate_return_addr_pos(stack_pointer, base_pointer, instr_pointer, bv):
     """ Makes a guess at where the return address is likely to be based on the stack pointer and base pointer.
     When functions follow the calling conventions, this should basically always be ebp+width. However, since that's
-    not the case, we rely on Binja to try and calculate it based on the static offsets. """
-    func = get_current_function(bv, instr_pointer)
-    if func is None:
+    not the case, we rely on Binja to try and calculate it based on the static offsets. The per-function metadata
+    comes from the return slot cache, which is warmed up in the background by enable_dynamics. """
+    global return_slots
+    if return_slots is None:
+        return_slots = ReturnSlotCache(bv, reg_prefix + 'bp')
+    func = return_slots.lookup(instr_pointer)
+    if func is None or len(func.returns) == 0:
+        # Not in a function, or the function doesn't have a return instruction
         return None
-    func = func.low_level_il
-    returns = filter(lambda il: il.operation == LowLevelILOperation.LLIL_RET, [instr for block in func for instr in block])
-    if (len(returns) == 0):
-        # Function doesn't have a return instruction
+    targets = []
+    current_bp, current_sp = func.offsets_at(instr_pointer)
+    for _ret, final_sp in func.returns:
+        # If we can, we use the base pointer for our offset, since it's much less likely to change than the stack pointer.
+        if current_bp is not None:
+            target = base_pointer - current_bp
+        elif current_sp is not None and final_sp is not None:
+            # When the stack is aligned to n bytes, we can't accurately calculate the stack pointer offset
+            # because Binja can't know how many of the zeroed bits were initally set. Since Binja doesn't
+            # warn us about this, we only use stack pointer offsets when the base pointer isn't available.
+            # This works on all my test binaries, but may fail in some real world cases. Tough to know ahead of time.
+            target = stack_pointer - (current_sp - final_sp)
+        else:
+            continue
+        if target not in targets:
+            targets.append(target)
+    if(len(targets) == 0):
         return None
-    else:
-        targets = []
-        for ret in returns:
-            # If we can, we use the base pointer for our offset, since it's much less likely to change than the stack pointer.
-            current_bp = func.source_function.get_reg_value_at(instr_pointer, reg_prefix + 'bp')
-            if hasattr(current_bp, 'offset'):
-                target = base_pointer - current_bp.offset
-            else:
-                # When the stack is aligned to n bytes, we can't accurately calculate the stack pointer offset
-                # because Binja can't know how many of the zeroed bits were initally set. Since Binja doesn't
-                # warn us about this, we only use stack pointer offsets when the base pointer isn't available.
-                # This works on all my test binaries, but may fail in some real world cases. Tough to know ahead of time.
-                final_sp = func.source_function.get_reg_value_at(ret.address, bv.arch.stack_pointer)
-                current_sp = func.source_function.get_reg_value_at(instr_pointer, bv.arch.stack_pointer)
-                target = stack_pointer - (current_sp.offset - final_sp.offset)
-            if target not in targets:
-                targets.append(target)
-        if(len(targets) > 1):
-            print("Warning: Function has multiple possible returns!")
-        # for target in targets:
-        #     print("return address will be at 0x{:02x} (0x{:02x} + {})".format(target, stack_pointer, target - stack_pointer))
-        # We should probably come up with something more intelligent to do with multiple return addreses than just returning the first.
-        # However, I haven't seen this in the wild yet, so it's difficult to know what the right behavior should be.
-        return targets[0]
+    if(len(targets) > 1):
+        print("Warning: Function has multiple possible returns!")
+    # for target in targets:
+    #     print("return address will be at 0x{:02x} (0x{:02x} + {})".format(target, stack_pointer, target - stack_pointer))
+    # We should probably come up with something more intelligent to do with multiple return addreses than just returning the first.
+    # However, I haven't seen this in the wild yet, so it's difficult to know what the right behavior should be.
+    return targets[0]
 
 def navigate_to_address(bv, address):
     """ Jumps binja to an address, if it's within the scope of the binary. Might
@@ -90,6 +129,14 @@ def init_gui():
     if main_window is None:
         app = QApplication.instance()
         main_window = [x for x in app.allWidgets() if x.__class__ is QMainWindow][0]
+        app.aboutToQuit.connect(shutdown)
+
+def shutdown():
+    """ Runs when Binary Ninja quits. Cleans up the temporary files we've been writing to. """
+    if hasattr(main_window, 'term_window'):
+        main_window.term_window.close_session()
+    if tracepoints is not None:
+        tracepoints.close()
 
 def show_message(message):
     """ Originally popped up a message box. Now just logs to console """
@@ -105,7 +152,7 @@ def show_message(message):
 def show_register_window(bv):
     """ Builds the register window and attaches it to the main window so it won't
     get garbage collected """
-    global reglist, main_window
+    global reglist, main_window, recorder, memory_history
     regs = OrderedDict() # Keep the registers in a sensible order
     # Figures out rip/eip and rflags/eflags for different architectures
     reglist.append(reg_prefix + 'ip')
@@ -118,12 +165,86 @@ def show_register_window(bv):
         regs[reg] = (0, bv.arch.regs[reg].size * 8)
         reglist.append(reg)
 
+    # The registers we filtered out go in the vector panel, which only fetches them when it's open
+    vectors = OrderedDict()
+    for reg in filter(lambda x: 'mm' in x or 'st' in x, bv.arch.full_width_regs):
+        vectors[reg] = bv.arch.regs[reg].size * 8
+
     # Attach register window to main window
     init_gui()
     main_window.regwindow = RegisterWindow()
     main_window.regwindow.update_registers(regs)
+    main_window.regwindow.vector_panel.set_registers(vectors)
+    main_window.regwindow.vector_panel.WANTED_CHANGED.connect(partial(request_vector_registers, bv))
+    main_window.regwindow.HISTORY_SELECTED.connect(partial(show_history, bv))
+    main_window.regwindow.DISPLAY_MODE_CHANGED.connect(partial(request_derefs, bv))
     main_window.regwindow.show()
 
+    # Start recording every step so the history slider can go back to them
+    recorder = TraceRecorder(reglist, reg_prefix + 'ip', reg_prefix + 'flags')
+    memory_history = MemoryHistory()
+
+def show_history(bv, entry):
+    """ Called when the history slider moves. Rebuilds the registers at that step from the trace
+    recorder and shows them (and where the instruction pointer was) without asking the debugger. """
+    if recorder is None or entry >= len(recorder):
+        return
+    registers = recorder.state_at(entry)
+    for reg in registers:
+        main_window.regwindow.update_single_register(reg, registers[reg])
+    main_window.regwindow.highlight_dirty()
+    if classifier is not None:
+        main_window.regwindow.update_classes(classify_registers(registers))
+    if entry == len(recorder) - 1:
+        main_window.regwindow.set_history_label("Live")
+    else:
+        main_window.regwindow.set_history_label("Step {} of {}".format(entry + 1, len(recorder)))
+    show_memory_history(recorder.steps[entry], registers)
+    navigate_to_address(bv, registers[reg_prefix + 'ip'])
+
+def show_memory_history(step, registers):
+    """ Puts the stack and .bss back the way they were at the given step, straight from the memory history """
+    if memory_history is None or not hasattr(main_window, 'hexv'):
+        return
+    main_window.hexv.begin_highlights()
+    for segment in ('stack', 'bss'):
+        entry = memory_history.find(segment, step)
+        if entry is not None:
+            address, memory = memory_history.segment_at(segment, entry)
+            main_window.hexv.update_display(segment, address, memory)
+            if segment == 'stack' and classifier is not None:
+                main_window.hexv.highlight_pointers(segment, classifier.classify_words(memory, address, reg_width // 8), width=reg_width // 8)
+    main_window.hexv.highlight_stack_pointer(registers[reg_prefix + 'sp'], width=reg_width/8)
+    main_window.hexv.highlight_base_pointer(registers[reg_prefix + 'bp'], width=reg_width/8)
+    main_window.hexv.commit_highlights()
+
+def request_vector_registers(bv, names):
+    """ Called when the vector panel is opened or scrolled. Remembers which registers it wants so the next
+    fetch includes them, and queues a refresh so they show up straight away. """
+    global vector_registers
+    vector_registers = names
+    if len(names) > 0:
+        init_scheduler()
+        scheduler.schedule(lambda _: None, bv)
+
+def request_derefs(bv, mode):
+    """ Called when the register display mode changes. Voltron's dereference chains are only fetched
+    while they're on screen, so switching to deref mode queues a refresh to fill them in. """
+    global want_derefs
+    want_derefs = mode == 'deref'
+    if want_derefs:
+        init_scheduler()
+        scheduler.schedule(lambda _: None, bv)
+
+def classify_registers(registers):
+    """ Works out where each general purpose register points, using the local address classifier """
+    classes = {}
+    for reg in reglist:
+        if reg in registers:
+            value = registers[reg]
+            classes[reg] = (classifier.classify(value), classifier.label(value))
+    return classes
+
 def show_memory_window(_bv):
     """ Builds an empty memory viewer and attaches it to the main window """
     global main_window
@@ -142,10 +263,75 @@ def show_traceback_window(bv):
     main_window.tb_window.set_hyperlink_handler(lambda addr: navigate_to_address(bv, int(addr.toString())))
     main_window.tb_window.show()
 
+def show_mapping_window(bv):
+    """ Builds the viewer for browsing any mapping of the inferior. It reads on its own thread, so it gets
+    its own memory slot. """
+    global main_window
+    init_gui()
+    if not hasattr(main_window, 'mapping_window'):
+        main_window.mapping_window = MappingWindow(lambda address, length: get_memory(bv, address, length, slot='mapping'))
+        if process_maps is not None:
+            main_window.mapping_window.set_regions(process_maps.regions)
+    main_window.mapping_window.show()
+
+def show_heap_window(bv):
+    """ Builds the heap chunk viewer. Chunks get marked in the memory map viewer, which also follows
+    whichever chunk is clicked. """
+    global main_window, heap_index
+    init_gui()
+    show_mapping_window(bv)
+    if not hasattr(main_window, 'heap_window'):
+        main_window.heap_window = HeapWindow()
+        main_window.heap_window.CHUNK_SELECTED.connect(main_window.mapping_window.goto)
+        main_window.heap_window.CLOSED.connect(close_heap_index)
+        main_window.mapping_window.view.annotate = lambda first, last: \
+            main_window.heap_window.chunks.annotations(first, last) if main_window.heap_window.chunks is not None else []
+    if heap_index is None:
+        heap_index = HeapIndex(reg_width // 8)
+        # Fill it in without waiting for the next step
+        init_scheduler()
+        scheduler.schedule(lambda _: None, bv)
+    main_window.heap_window.show()
+
+def close_heap_index():
+    """ Called when the heap window is closed. The heap is only read and indexed while it's open. """
+    global heap_index
+    heap_index = None
+
+def show_search_window(bv):
+    """ Builds the memory search window. Searches cover every readable mapping the process had at the last step. """
+    global main_window
+    init_gui()
+    if not hasattr(main_window, 'search_window'):
+        main_window.search_window = SearchWindow()
+        read = lambda address, length, slot: get_memory(bv, address, length, slot=slot)
+        main_window.search_window.SEARCH_REQUESTED.connect(lambda pattern: main_window.search_window.run_search(
+            process_maps.regions if process_maps is not None else [], read, pattern))
+        main_window.search_window.RESULT_SELECTED.connect(partial(show_search_hit, bv))
+    main_window.search_window.show()
+
+def show_search_hit(bv, address):
+    """ Shows a search hit in the memory map viewer, and in the binary view too if it's part of the binary """
+    show_mapping_window(bv)
+    main_window.mapping_window.goto(address)
+    if bv.is_valid_offset(address):
+        navigate_to_address(bv, address)
+
+def show_perf_window(_bv):
+    """ Builds the performance panel, which times each stage of a step while it's open """
+    global main_window
+    init_gui()
+    if not hasattr(main_window, 'perf_window'):
+        main_window.perf_window = PerfWindow()
+    main_window.perf_window.show()
+
 def show_terminal_window(bv):
     """ Builds empty terminal window and attaches it to the main window """
     global main_window
     init_gui()
+    if hasattr(main_window, 'term_window'):
+        main_window.term_window.close_session()
+        main_window.term_window.close()
     main_window.term_window = TerminalWindow()
     main_window.term_window.show()
 
@@ -163,123 +349,479 @@ def update_registers(registers, derefs):
         for reg in reglist:
             try:
                 main_window.regwindow.update_single_register(reg, registers[reg])
-                dereferences[reg] = derefs[reg]
+                dereferences[reg] = derefs.get(reg, [])
             except KeyError:
                 log_error("Voltron did not return a register called " + reg)
         main_window.regwindow.update_derefs(dereferences)
         main_window.regwindow.highlight_dirty()
 
 def signal_sync_done(bv, _results):
-    """ Callback designed to run the update_wrapper function again immediately after we've had our first successful sync
-    after being unable to succesfully sync. Has to run on the main thread to prevent a crash. The outer lambda function
-    calls the update wrapper, while the inner lambda function acts as a stub so that wrapped() doesn't fail. """
-    execute_on_main_thread_and_wait(lambda: update_wrapper(lambda _: log_info("Called update wrapper within callback"), bv))
+    """ Callback designed to refresh the displays again immediately after we've had our first successful sync
+    after being unable to succesfully sync. The scheduler is thread safe, so we can queue the refresh straight
+    from binjatron's thread. The lambda acts as a stub so that the scheduler has a command to run. """
+    global executed_at
+    executed_at = scheduler.schedule(lambda _: log_info("Called update wrapper within callback"), bv)
 
-import pprint as pp
-def update_wrapper(wrapped, bv):
-    global executing_on_stack, stack_bv, lowest_stack
-    """ Runs each time a button on the toolbar is pushed. Updates the live displays of program information """
-    # Call wrapped function
-    wrapped(bv)
-    # Handle Register Updates
-    reg, derefs = get_registers(bv) # derefs will have the error message if something goes wrong
-    try:
-        update_registers(reg, derefs)
-    except AttributeError: # reg was None
-        if(derefs == 'Target busy'):  # Probably living in kernel-land, which could be for a number of reasons.
-            # We make the hopeful assumption that the reason is the program is waiting for user input.
-            main_window.term_window.bring_to_front()
-            log_info("The target was busy, preventing us from retrieving the register state. It may be waiting for input from you.")
-        elif(derefs == 'No such target'):
-            # Usually happens when the inferior process has exited
-            log_alert("Couldn't get register state. The process may not be running.")
-        else:
-            # Maybe you didn't run the binary yet?
-            log_alert("Couldn't get register state. Please consult the log for more information")
-        # If something went wrong with the last update, we register a callback that will get run
-        # the next time we have a sucessful sync. We partially apply the arguments on the callback
-        # so we don't lose our reference to the binary view. See docstring on signal_sync_done for more
-        register_sync_callback(partial(signal_sync_done, bv), should_delete=True)
-        return
-    # Handle Memory Updates
+def _align_down(addr, alignment=32):
+    """ Lock an address to an even multiple of alignment so we don't get confusing
+    column-wise shifts in the display """
+    return addr - (addr % alignment)
+
+@timed("psutil")
+def find_pid_by_name(bv):
+    """ Fallback for debuggers that won't tell us the PID. Iterates through the processes on
+    the system to find one with the same name as the binary. """
     procname = filename.split("/")[-1] if filename is not None else bv.file.filename.split("/")[-1].replace(".bndb","")
-    # Iterate through the processes on the system to find the right memory map
     for proc in psutil.process_iter():
         if proc.name() == procname: # Found debugged process
-            maps = proc.memory_maps(grouped=False)
-            for m in maps:
-                # Update Stack
-                if(m.path.strip("[]") == 'stack'):
-                    addr = m.addr.split("-")
-                    high = int(addr[1],16)
-                    sp, bp, ip = reg[reg_prefix + 'sp'], reg[reg_prefix + 'bp'], reg[reg_prefix + 'ip']
-                    # Lock out the top of the memory to an even multiple of 32 so we don't
-                    # get confusing column-wise shifts in the display
-                    memtop = min([sp, lowest_stack])
-                    memtop = memtop if (memtop % 32 == 0) else (memtop + (32 - memtop % 32) - 32)
-                    lowest_stack = memtop
-                    mem = get_memory(bv, memtop, high-memtop)
-                    if mem is None:
-                        log_error("No memory returned!")
-                        return
-                    # Display memory from the base of the stack (high addresses)
-                    # to the stack pointer (low addresses)
-                    main_window.hexv.update_display('stack', memtop, mem)
-                    main_window.hexv.highlight_stack_pointer(sp, width=reg_width/8)
-                    main_window.hexv.highlight_base_pointer(bp, width=reg_width/8)
-
-                    # If the instruction pointer is on the stack, highlight it in the memory viewer
-                    # and try to display it in the Binary Ninja window.
-                    if (ip > memtop and ip <= high):
-                        main_window.hexv.highlight_instr_pointer(ip)
-                        if not executing_on_stack:
-                            executing_on_stack = True
-                            # Ideally we'd like to get the stack view inline using something like
-                            # stack_bv = BinaryViewType.get_view_of_file('/dev/null'),
-                            # but that doesn't actually work because Binary Ninja really only supports
-                            # getting active binary views via callbacks, for now.
-                            if stack_bv is not None:
-                                # because of the way .write is implemented, this works if we jump to the stack
-                                # exactly one time and stay there. If we go to the stack, leave, and come back,
-                                # we end up creating multiple overlapping segments, which will probably break things.
-                                stack_bv.write(memtop, mem)
-                                stack_bv.add_function(ip, plat=bv.arch.standalone_platform)
-                                print(stack_bv)
-                    else:
-                        executing_on_stack = False
-
-                    # Update BSS
-                    try:
-                        bss = bv.sections['.bss']
-                        bssmem = get_memory(bv, bss.start, bss.length)
-                        main_window.hexv.update_display('bss', bss.start, bssmem)
-                    except KeyError:
-                        log_info('Binary has no bss section')
-
-                    # Repaint the viewer once (much faster than the 8 times we used to do)
-                    main_window.hexv.redraw()
-
-                    # Update traceback
-                    main_window.tb_window.update_frames(get_backtrace(bv))
-
-                    # Update return address
-                    try:
-                        ret = calculate_return_addr_pos(sp, bp, ip, bv)
-                        ret_add_offset = (ret - memtop) if (ret is not None) else (bp - memtop + (reg_width/8))
-                        main_window.hexv.highlight_retn_addr((ret) if (ret is not None) else (bp+ (reg_width/8)), width=reg_width/8)
-                        retrieved = mem[ret_add_offset:ret_add_offset + (reg_width/8)][::-1].encode('hex')
-                        if(len(retrieved) > 0):
-                            ret_add = int(retrieved, 16)
-                            main_window.tb_window.update_ret_address(ret_add)
-                    except ValueError:
-                        log_error("Tried to find the return address before the stack was set up. Carry on.")
-                    break
-            break
+            return proc.pid
+    return None
+
+@timed("maps")
+def inferior_maps(bv):
+    """ Returns the cached memory map of the debugged process, or None if it isn't running.
+    The PID is only looked up the first time we need it each run. """
+    global process_maps
+    if process_maps is None:
+        pid = get_pid(bv)
+        if pid is None:
+            pid = find_pid_by_name(bv)
+        if pid is None:
+            return None
+        process_maps = ProcessMaps(pid)
+        try:
+            set_memory_backend(ProcessMemory(pid))
+        except (IOError, OSError) as e:
+            log_info("Can't read /proc/{}/mem, so memory will come from Voltron -- {}".format(pid, e))
+            set_memory_backend(None)
+    try:
+        process_maps.refresh()
+    except (IOError, OSError):
+        # The process went away, so we'll look up the new one next time
+        process_maps = None
+        return None
+    return process_maps
+
+def new_inferior(wrapped, bv):
+    """ Wraps commands that start or kill the inferior so that we look up the new PID on the next refresh """
+    global process_maps, last_ip, last_frames
+    process_maps = None
+    last_ip = None
+    last_frames = None
+    set_memory_backend(None)
+    wrapped(bv)
+
+def find_stack_bounds(bv):
+    """ Returns the (low, high) bounds of the stack mapping of the debugged process, or None if we couldn't find it """
+    maps = inferior_maps(bv)
+    stack = maps.named('stack') if maps is not None else None
+    if stack is None:
+        return None
+    return stack.start, stack.end
+
+def handle_register_error(bv, message):
+    """ Explains why we couldn't get the registers, and registers a callback so we try again
+    the next time binjatron has a successful sync """
+    if(message == 'Target busy'):  # Probably living in kernel-land, which could be for a number of reasons.
+        # We make the hopeful assumption that the reason is the program is waiting for user input.
+        main_window.term_window.bring_to_front()
+        log_info("The target was busy, preventing us from retrieving the register state. It may be waiting for input from you.")
+    elif(message == 'No such target'):
+        # Usually happens when the inferior process has exited
+        log_alert("Couldn't get register state. The process may not be running.")
+    else:
+        # Maybe you didn't run the binary yet?
+        log_alert("Couldn't get register state. Please consult the log for more information")
+    # If something went wrong with the last update, we register a callback that will get run
+    # the next time we have a sucessful sync. We partially apply the arguments on the callback
+    # so we don't lose our reference to the binary view. See docstring on signal_sync_done for more
+    register_sync_callback(partial(signal_sync_done, bv), should_delete=True)
+
+@timed("backtrace_check")
+def backtrace_needed(bv):
+    """ A single step can only change the call stack if the instruction it stepped over was a call, a return,
+    some sort of jump out of the function, or wrote the frame pointer (a prologue, or a leave), so we only ask
+    the debugger for a new backtrace when the previous ip says it might have changed (or when we don't know
+    what the previous instruction was). Deciding this up front lets the backtrace ride along with the batch. """
+    if backtrace_dirty or not last_frames or last_ip is None:
+        return True
+    func = get_current_function(bv, last_ip)
+    if func is None:
+        return True
+    il = func.get_low_level_il_at(last_ip)
+    return il is None or il.operation in frame_changing_ops or reg_prefix + 'bp' in func.get_regs_written_by(last_ip)
+
+def fetch_state(bv, is_stale):
+    """ Runs on the update scheduler's worker thread after each debugger command. Does all the
+    talking to the debugger and all the parsing, and returns a dict describing the new program
+    state for render_state to display. Everything we need from the debugger is requested in
+    one batch, whose requests go out concurrently, so a step waits on one round trip. """
+    global lowest_stack, last_ip, last_bp, last_frames, backtrace_dirty
+    stack = find_stack_bounds(bv)
+    # The stack read depends on the stack pointer we haven't fetched yet, so we speculatively
+    # read a little past the lowest stack pointer we've seen and trim it once the registers arrive.
+    requests = [registers_request(deref=want_derefs)]
+    bss = None
+    if stack is not None:
+        low, high = stack
+        guess = high - stack_slack if lowest_stack > high else lowest_stack - stack_slack
+        stack_read = max(low, _align_down(guess))
+        requests.append(memory_request(stack_read, high - stack_read))
+        try:
+            bss = bv.sections['.bss']
+            requests.append(memory_request(bss.start, bss.length))
+        except KeyError:
+            log_info('Binary has no bss section')
+        if backtrace_needed(bv):
+            backtrace_dirty = False
+            backtrace_index = len(requests)
+            requests.append(backtrace_request())
+        else:
+            backtrace_index = None
+        if last_ip is not None:
+            # Rides along with the rest of the batch so we can tell whether we just stepped over a syscall
+            syscall_index = len(requests)
+            requests.append(memory_request(last_ip, 2))
+    wanted = vector_registers
+    if len(wanted) > 0:
+        vector_index = len(requests)
+        requests.append(registers_request(wanted))
+    state = get_state(bv, requests)
+    store = tracepoints # Clearing the tracepoints on the main thread can swap this out from under us
+    if store is not None and len(store) > 0:
+        with stage("tracepoints"):
+            comments = import_tracepoints(store)
+        if comments:
+            execute_on_main_thread(partial(set_comments, bv, comments))
+    hits = coverage # Same goes for the coverage map
+    if hits is not None:
+        with stage("coverage"):
+            blocks = hits.import_new()
+        if blocks:
+            execute_on_main_thread(partial(highlight_coverage, hits, blocks))
+    if stack is not None and last_ip is not None:
+        if not state.ok(syscall_index) or memoryview(state[syscall_index]).tobytes() in syscall_opcodes:
+            process_maps.invalidate()
+    last_ip = None
+
+    if not state.ok(0):
+        return {'bv': bv, 'error': state.error(0)}
+    reg, derefs = state[0]
+    snapshot = {'bv': bv, 'registers': reg, 'derefs': derefs}
+    if process_maps is not None:
+        snapshot['regions'] = process_maps.regions
+        heap = process_maps.named('heap')
+        index = heap_index # Closing the heap window drops this on the main thread
+        if index is not None and heap is not None:
+            # The heap viewer is open, so bring its chunk index up to date with whatever pages changed
+            with stage("heap"):
+                mem = get_memory(bv, heap.start, heap.end - heap.start, slot='heap')
+                if mem is not None:
+                    index.update(heap.start, mem)
+                    index.update_arena(lambda address, length: get_memory(bv, address, length, slot='arena'),
+                                       process_maps.regions, mem)
+                    snapshot['heap'] = (index, index.delta())
+    if classifier is not None:
+        # Without the maps we can still tell code from data inside the binary itself
+        with stage("classify"):
+            if process_maps is not None:
+                classifier.update_maps(process_maps.regions)
+            snapshot['classes'] = classify_registers(reg)
+    if len(wanted) > 0 and state.ok(vector_index):
+        snapshot['vectors'] = state[vector_index][0]
+    if stack is None or len(reg.keys()) == 0 or is_stale():
+        return snapshot
+
+    sp, bp, ip = reg[reg_prefix + 'sp'], reg[reg_prefix + 'bp'], reg[reg_prefix + 'ip']
+    last_ip = ip
+    if sp < low:
+        # The kernel grew the stack mapping since we last read the maps
+        process_maps.invalidate()
+    memtop = _align_down(min([sp, lowest_stack]))
+    lowest_stack = memtop
+    if memtop >= stack_read and state.ok(1):
+        view = memoryview(state[1])[memtop - stack_read:]
+    else:
+        # The stack grew past our guess, so we have to go back for the rest of it
+        mem = get_memory(bv, memtop, high-memtop)
+        view = memoryview(mem) if mem is not None else None
+    if view is None:
+        log_error("No memory returned!")
+        return snapshot
+    # The views may point into buffers the next fetch will reuse, so this is the one copy we make
+    snapshot.update({'sp': sp, 'bp': bp, 'ip': ip, 'memtop': memtop, 'stack_high': high, 'stack': view.tobytes()})
+    if classifier is not None and 'classes' in snapshot:
+        with stage("classify"):
+            snapshot['pointers'] = classifier.classify_words(view, memtop, reg_width // 8)
+    if bss is not None and state.ok(2):
+        snapshot['bss'] = (bss.start, memoryview(state[2]).tobytes())
+    if memory_history is not None:
+        # Hash the pages here so render_state only has to compare digests
+        with stage("memory_history"):
+            snapshot['stack_pages'] = page_keys(memtop, snapshot['stack'])
+            if 'bss' in snapshot:
+                snapshot['bss_pages'] = page_keys(*snapshot['bss'])
+    if backtrace_index is None and bp != last_bp:
+        # The frame pointer moved behind backtrace_needed's back. Rather than make another round trip
+        # now, show the frames we have and fetch a fresh backtrace with the next batch.
+        backtrace_dirty = True
+        last_frames = [dict(last_frames[0], addr=ip)] + last_frames[1:]
+    elif backtrace_index is None:
+        # Same frames as last time, except the innermost one has moved on to the new ip
+        last_frames = [dict(last_frames[0], addr=ip)] + last_frames[1:]
+    elif state.ok(backtrace_index):
+        last_frames = state[backtrace_index]
+    else:
+        last_frames = None
+    last_bp = bp
+    if last_frames:
+        snapshot['frames'] = last_frames
+
+    # Work out where the return address should be
+    try:
+        ret = calculate_return_addr_pos(sp, bp, ip, bv)
+        snapshot['ret_pos'] = (ret) if (ret is not None) else (bp + (reg_width/8))
+        ret_add_offset = snapshot['ret_pos'] - memtop
+        if ret_add_offset >= 0:
+            snapshot['ret_add'] = struct.unpack_from('<Q' if reg_width == 64 else '<I', view, ret_add_offset)[0]
+    except (ValueError, struct.error):
+        log_error("Tried to find the return address before the stack was set up. Carry on.")
+    return snapshot
+
+@timed("render")
+def render_state(update):
+    """ Runs on the main thread whenever the update scheduler finishes a fetch. Pushes the
+    snapshot produced by fetch_state into the register, memory and traceback windows. """
+    global executing_on_stack, recorded_at
+    generation, state = update
+    if scheduler.is_stale(generation):
+        # A newer step is already on its way, so don't bother drawing this one
+        return
+    if hasattr(main_window, 'term_window'):
+        main_window.term_window.set_step(generation)
+    if 'error' in state:
+        handle_register_error(state['bv'], state['error'])
+        return
+    with stage("register_view"):
+        update_registers(state['registers'], state['derefs'])
+        if 'classes' in state:
+            main_window.regwindow.update_classes(state['classes'])
+    # Refreshes that didn't run the inferior (opening the vector panel, say) don't count as history steps
+    record = executed_at != recorded_at
+    recorded_at = executed_at
+    if record and recorder is not None and len(state['registers'].keys()) > 0:
+        recorder.record(generation, state['registers'])
+        main_window.regwindow.set_history_length(len(recorder))
+    if 'vectors' in state:
+        main_window.regwindow.vector_panel.update_values(state['vectors'])
+    if hasattr(main_window, 'mapping_window'):
+        main_window.mapping_window.step(state.get('regions'))
+    if 'heap' in state and state['heap'][0] is heap_index:
+        # Tell the index how far we've got, so it can let go of the changes we've applied
+        heap_index.acked = main_window.heap_window.update_heap(state['heap'][1])
+    if 'stack' not in state:
+        return
+
+    # Display memory from the base of the stack (high addresses)
+    # to the stack pointer (low addresses)
+    memtop, mem, ip = state['memtop'], state['stack'], state['ip']
+    # Every highlight for this step goes in one transaction, so only what moved gets touched
+    main_window.hexv.begin_highlights()
+    with stage("memory_view"):
+        main_window.hexv.update_display('stack', memtop, mem)
+    if record and memory_history is not None:
+        memory_history.record(generation, 'stack', memtop, mem, state.get('stack_pages'))
+    if 'pointers' in state:
+        main_window.hexv.highlight_pointers('stack', state['pointers'], width=reg_width // 8)
+    main_window.hexv.highlight_stack_pointer(state['sp'], width=reg_width/8)
+    main_window.hexv.highlight_base_pointer(state['bp'], width=reg_width/8)
+
+    # If the instruction pointer is on the stack, highlight it in the memory viewer
+    # and try to display it in the Binary Ninja window.
+    if (ip > memtop and ip <= state['stack_high']):
+        main_window.hexv.highlight_instr_pointer(ip)
+        if not executing_on_stack:
+            executing_on_stack = True
+            # Ideally we'd like to get the stack view inline using something like
+            # stack_bv = BinaryViewType.get_view_of_file('/dev/null'),
+            # but that doesn't actually work because Binary Ninja really only supports
+            # getting active binary views via callbacks, for now.
+            if stack_bv is not None:
+                # because of the way .write is implemented, this works if we jump to the stack
+                # exactly one time and stay there. If we go to the stack, leave, and come back,
+                # we end up creating multiple overlapping segments, which will probably break things.
+                stack_bv.write(memtop, mem)
+                stack_bv.add_function(ip, plat=state['bv'].arch.standalone_platform)
+                print(stack_bv)
+    else:
+        main_window.hexv.highlight_instr_pointer(None)
+        executing_on_stack = False
+
+    # Update BSS
+    if 'bss' in state:
+        with stage("memory_view"):
+            main_window.hexv.update_display('bss', state['bss'][0], state['bss'][1])
+        if record and memory_history is not None:
+            memory_history.record(generation, 'bss', state['bss'][0], state['bss'][1], state.get('bss_pages'))
+
+    # Update return address
+    if 'ret_pos' in state:
+        main_window.hexv.highlight_retn_addr(state['ret_pos'], width=reg_width/8)
+
+    # Apply the highlights that changed and repaint the viewer once
+    with stage("hexview_redraw"):
+        main_window.hexv.commit_highlights()
+
+    # Update traceback
+    if 'frames' in state:
+        with stage("traceback_view"):
+            main_window.tb_window.update_frames(state['frames'])
+
+    # Update return address
+    if 'ret_add' in state:
+        main_window.tb_window.update_ret_address(state['ret_add'])
+
+def init_scheduler():
+    """ Starts the worker thread that runs debugger commands and fetches the program state.
+    Has to be called from the main thread so the STATE_READY signal gets delivered there. """
+    global scheduler
+    if scheduler is None:
+        scheduler = UpdateScheduler(fetch_state)
+        scheduler.STATE_READY.connect(render_state)
+        scheduler.start()
+
+def update_wrapper(wrapped, bv):
+    """ Runs each time a button on the toolbar is pushed. Hands the command off to the update
+    scheduler, which runs it and refreshes the live displays without blocking the UI. """
+    global backtrace_dirty
+    init_scheduler()
+    # A single step can only change the mappings if it was a syscall, and can only change the call stack if it
+    # was a call or return, both of which fetch_state checks for. Anything else (or a step that gets coalesced
+    # with others) might run arbitrary code.
+    if wrapped is not step_one or not scheduler.idle():
+        backtrace_dirty = True
+        if process_maps is not None:
+            process_maps.invalidate()
+    global executed_at
+    executed_at = scheduler.schedule(wrapped, bv)
+
+def import_tracepoints(store):
+    """ Pulls in the tracepoint hits the debugger wrote out when it stopped. Returns an (address, comment)
+    pair summing up each tracepoint that got new hits, for set_comments to put in on the main thread. """
+    return [(history.address, history.summary()) for history in store.import_new()]
+
+def set_comments(bv, comments):
+    for address, comment in comments:
+        bv.set_comment_at(address, comment)
+
+def add_tracepoint(bv, address):
+    """ Asks which values to record at an address, then has the debugger start recording them """
+    global tracepoints
+    if tracepoints is not None and tracepoints.history(address) is not None:
+        # The debugger would record every hit twice, so make the user clear the old one first
+        log_alert("There's already a tracepoint at {:#x}. Clear the tracepoints to change it.".format(address))
+        return
+    expressions = TextLineField("Values to record, comma separated (eg $rax, *(long *)($rsp + 8))")
+    if not get_form_input([expressions], "Add Tracepoint") or not expressions.result:
+        return
+    if tracepoints is None:
+        tracepoints = TracepointStore()
+    expressions = [e.strip() for e in expressions.result.split(',') if e.strip()]
+    tracepoints.add(address, expressions)
+    bv.set_comment_at(address, tracepoints.history(address).summary())
+    path = tracepoints.path
+    def install(bv):
+        error = set_tracepoints(bv, {address: expressions}, path)
+        if error is not None:
+            log_alert("Couldn't set the tracepoint -- " + error)
+    init_scheduler()
+    scheduler.schedule(install, bv)
+
+def clear_tracepoints(bv):
+    """ Removes every tracepoint, along with the comments that summed them up """
+    global tracepoints
+    if tracepoints is None:
+        return
+    for address in tracepoints.points:
+        bv.set_comment_at(address, "")
+    tracepoints.close()
+    path, tracepoints = tracepoints.path, None
+    init_scheduler()
+    scheduler.schedule(lambda bv: set_tracepoints(bv, {}, path, clear=True), bv)
+
+def collect_coverage(bv, functions=None):
+    """ Puts a one-shot breakpoint on every basic block (or every block in the given functions) and lets the
+    program run. The blocks that were hit get highlighted whenever it stops. """
+    global coverage
+    if coverage is not None:
+        coverage.clear_highlights()
+        coverage.close()
+    coverage = hits = CoverageMap(bv, functions)
+    log_info("Collecting coverage of {} basic blocks".format(len(coverage.blocks)))
+    def start(bv):
+        error = set_coverage_breakpoints(bv, hits.addresses(), hits.path, clear=True)
+        if error is not None:
+            log_alert("Couldn't set the coverage breakpoints -- " + error)
+            return
+        continue_exec(bv)
+    update_wrapper(start, bv)
+
+def highlight_coverage(hits, blocks):
+    """ Paints newly hit blocks, unless the coverage was cleared or restarted since they were read """
+    if hits is coverage:
+        hits.highlight(blocks)
+
+def clear_coverage(bv):
+    """ Removes the coverage highlights, and any coverage breakpoints that haven't been hit """
+    global coverage
+    if coverage is None:
+        return
+    coverage.clear_highlights()
+    coverage.close()
+    path, coverage = coverage.path, None
+    init_scheduler()
+    scheduler.schedule(lambda bv: set_coverage_breakpoints(bv, [], path, clear=True), bv)
+
+def burst_command(description, run):
+    """ Turns a step_n or run_until call into a scheduler command that shows how far it's got in Binary Ninja's
+    status bar and can be cancelled from there. run is called as run(bv, progress). Since the whole burst is a
+    single command, the viewers only refresh once it's over. """
+    def command(bv):
+        task = BackgroundTask(description, True)
+        def progress(done, total):
+            task.progress = "{} ({}/{} instructions)".format(description, done, total)
+            return not task.cancelled
+        try:
+            run(bv, progress)
+        finally:
+            task.finish()
+    return command
+
+def step_n_wrapper(bv):
+    """ Asks how many instructions to run, then runs them all before refreshing """
+    count = IntegerField("Instructions to run")
+    if not get_form_input([count], "Step N Instructions") or count.result is None or count.result <= 0:
+        return
+    update_wrapper(burst_command("Stepping", lambda bv, progress: step_n(bv, count.result, progress=progress)), bv)
+
+def run_until_wrapper(bv):
+    """ Asks for a condition, then steps until the debugger says it holds """
+    condition = TextLineField("Stop when (eg $rax == 0)")
+    limit = IntegerField("Give up after (instructions)")
+    if not get_form_input([condition, limit], "Run Until") or not condition.result:
+        return
+    def run(bv, progress):
+        steps, hit, error = run_until(bv, condition.result, limit.result or 1000000, progress=progress)
+        if error is not None:
+            log_alert("Stopped after {} instructions -- {}".format(steps, error))
+        elif not hit:
+            log_info("Condition not met after {} instructions".format(steps))
+    update_wrapper(burst_command("Running until " + condition.result, run), bv)
 
 def enable_dynamics(bv):
     """ Does first time setup for everything. See show_message calls for more explanation.
     Not sure how well this handles being called twice... """
-    global main_window, reg_prefix, reg_width
+    global main_window, reg_prefix, reg_width, return_slots, classifier
     if(bv.arch.name == 'x86_64'):
         pass
     elif(bv.arch.name == 'x86'):
@@ -297,6 +839,12 @@ def enable_dynamics(bv):
             if(sync(bv)):
                 break
             sleep(1)
+    # Work out where every function keeps its return address while we wait for the user
+    if return_slots is not None:
+        return_slots.close()
+    return_slots = ReturnSlotCache(bv, reg_prefix + 'bp')
+    return_slots.warm_up()
+    classifier = AddressClassifier(bv, return_slots.function_at)
     show_message("Attempting to set breakpoint at main")
     funcs = [f for f in filter(lambda b: b.name == 'main', bv.functions)]
     if(len(funcs) != 0):
@@ -307,6 +855,7 @@ def enable_dynamics(bv):
     show_message("Placing windows")
     # Set the binary view the toolbar should pass to everything it calls
     set_bv(bv)
+    init_scheduler()
     show_register_window(bv)
     show_memory_window(bv)
     show_traceback_window(bv)
@@ -338,6 +887,19 @@ def terminal_wrapper(bv):
 
 add_picker(['gdb', 'lldb'], picker_callback)
 PluginCommand.register("Enable Dynamic Analysis Tools", "Enables features for dynamic analysis on this binary view", enable_dynamics)
+# binja_toolbar only takes image buttons, so the burst commands live in the tools menu
+PluginCommand.register("Step N Instructions...", "Runs a number of instructions and refreshes once at the end", step_n_wrapper)
+PluginCommand.register("Run Until...", "Steps until a debugger expression is true and refreshes once at the end", run_until_wrapper)
+PluginCommand.register_for_address("Add Tracepoint Here...", "Records values every time this address runs, without stopping", add_tracepoint)
+PluginCommand.register("Clear Tracepoints", "Removes all tracepoints", clear_tracepoints)
+PluginCommand.register("Collect Coverage", "Highlights every basic block the program runs from here on", collect_coverage)
+PluginCommand.register_for_function("Collect Coverage of Function", "Highlights the basic blocks of this function that run",
+    lambda bv, func: collect_coverage(bv, [func]))
+PluginCommand.register("Clear Coverage", "Removes coverage highlights and breakpoints", clear_coverage)
+PluginCommand.register("Show Memory Map Viewer", "Browse any mapping of the running program, a page at a time", show_mapping_window)
+PluginCommand.register("Show Heap Viewer", "Lists the glibc malloc chunks on the heap, and marks them in the memory map viewer", show_heap_window)
+PluginCommand.register("Search Memory...", "Searches all of the running program's memory for a string, bytes or a number", show_search_window)
+PluginCommand.register("Show Performance Panel", "Times each stage of a step and shows rolling statistics", show_perf_window)
 PluginCommand.register("Close All Windows", "Closes the entire application", lambda _bv: QApplication.instance().closeAllWindows())
 
 def attach_live_view(bv):
@@ -357,8 +919,8 @@ path = os.path.dirname(os.path.realpath(__file__)) + '/'
 # path = user_plugin_path + '/binja_dynamics/'
 add_image_button(path + "icons/terminal.png", iconsize, terminal_wrapper, "Open a terminal with the selected debugger session")
 add_image_button(path + "icons/write.png", iconsize, set_debugger_args, "Set Runtime Arguments")
-add_image_button(path + "icons/run.png", iconsize, partial(update_wrapper, run_binary), "Run Binary")
-add_image_button(path + "icons/stop.png", iconsize, partial(update_wrapper, kill), "Kill program")
+add_image_button(path + "icons/run.png", iconsize, partial(update_wrapper, partial(new_inferior, run_binary)), "Run Binary")
+add_image_button(path + "icons/stop.png", iconsize, partial(update_wrapper, partial(new_inferior, kill)), "Kill program")
 add_image_button(path + "icons/stepinto.png", iconsize, partial(update_wrapper, step_one), "Step to next instruction")
 add_image_button(path + "icons/stepover.png", iconsize, partial(update_wrapper, step_over), "Step over call instruction")
 add_image_button(path + "icons/finish.png", iconsize, partial(update_wrapper, step_out), "Step out of stack frame")
@@ -0,0 +1,129 @@
+from PyQt5.QtGui import QColor
+from collections import OrderedDict
+from bisect import bisect_right
+import os
+import struct
+
+# Sections of the binary that hold code. Everything else bv.sections knows about counts as data.
+code_sections = ['.text', '.plt', '.plt.got', '.plt.sec', '.init', '.fini']
+
+# Colours for stack words that point somewhere interesting, soft enough that the sp/bp/ret
+# highlights still stand out on top of them
+kind_colors = OrderedDict([('code', QColor(229, 204, 255)),
+                           ('stack', QColor(204, 229, 255)),
+                           ('heap', QColor(204, 255, 204)),
+                           ('libc', QColor(255, 229, 204)),
+                           ('data', QColor(255, 255, 204))])
+
+def region_kind(region):
+    """ Decides what sort of memory a line from /proc/<pid>/maps is """
+    if region.path == '[stack]':
+        return 'stack'
+    if region.path == '[heap]':
+        return 'heap'
+    if os.path.basename(region.path).startswith('libc'):
+        return 'libc'
+    if 'x' in region.perms:
+        return 'code'
+    return 'data'
+
+class IntervalIndex(object):
+    """ Sorted list of non-overlapping [start, end) intervals, each with a value attached,
+    that can be searched with a single bisect. Overlapping intervals are dropped (the
+    first one to start wins), which only happens if the maps file changes under us. """
+    def __init__(self, intervals):
+        self._starts = []
+        self._ends = []
+        self._values = []
+        for start, end, value in sorted(intervals, key=lambda i: i[0]):
+            if end <= start or (self._ends and start < self._ends[-1]):
+                continue
+            self._starts.append(start)
+            self._ends.append(end)
+            self._values.append(value)
+        self.low = self._starts[0] if self._starts else 0
+        self.high = self._ends[-1] if self._ends else 0
+
+    def __len__(self):
+        return len(self._starts)
+
+    def find(self, address):
+        """ Returns the value of the interval containing address, or None """
+        if address < self.low or address >= self.high:
+            return None
+        index = bisect_right(self._starts, address) - 1
+        if index >= 0 and address < self._ends[index]:
+            return self._values[index]
+        return None
+
+class AddressClassifier(object):
+    """ Works out what a value points to (code, stack, heap, libc or data) without asking the
+    debugger. The binary's sections are checked first, since they can tell code from data inside
+    the main executable, then the process mappings. Both indexes are rebuilt only when their
+    source changes, so classifying a whole stack is a bisect per word. """
+    def __init__(self, bv, function_at=None):
+        self._function_at = function_at
+        sections = []
+        for name, section in bv.sections.items():
+            kind = 'code' if name in code_sections else 'data'
+            sections.append((section.start, section.end, (kind, name)))
+        self._sections = IntervalIndex(sections)
+        self._maps = IntervalIndex([])
+        self._regions = None
+
+    def update_maps(self, regions):
+        """ Rebuilds the mapping index if we've been handed a different list of regions. ProcessMaps
+        only replaces its list when the maps actually change, so this is usually free. """
+        if regions is self._regions:
+            return
+        self._regions = regions
+        self._maps = IntervalIndex([(r.start, r.end, (region_kind(r), r)) for r in regions])
+
+    def classify(self, value):
+        """ Returns the kind of memory value points into, or None if it doesn't look like a pointer """
+        hit = self._sections.find(value)
+        if hit is None:
+            hit = self._maps.find(value)
+        return hit[0] if hit is not None else None
+
+    def label(self, value):
+        """ Returns a short description of where value points, like 'code: main+0x1c' or
+        'heap: [heap]+0x2a0'. Empty if it doesn't point anywhere we know about. """
+        section = self._sections.find(value)
+        if section is not None:
+            kind, name = section
+            if kind == 'code' and self._function_at is not None:
+                func = self._function_at(value)
+                if func is not None:
+                    return "code: {}+{:#x}".format(func.name, value - func.start)
+            return "{}: {}".format(kind, name)
+        mapping = self._maps.find(value)
+        if mapping is not None:
+            kind, region = mapping
+            name = os.path.basename(region.path) or 'anonymous'
+            return "{}: {}+{:#x}".format(kind, name, value - region.start)
+        return ""
+
+    def classify_words(self, memory, address, width=8):
+        """ Reads memory (which starts at address) as an array of little-endian pointers, and
+        returns an (address, kind) pair for every aligned word that points somewhere we know about """
+        skip = (-address) % width
+        count = (len(memory) - skip) // width
+        if count <= 0:
+            return []
+        words = struct.unpack_from('<{}{}'.format(count, 'Q' if width == 8 else 'I'), memory, skip)
+        sections, maps = self._sections, self._maps
+        low = min(sections.low, maps.low) if len(sections) and len(maps) else max(sections.low, maps.low)
+        high = max(sections.high, maps.high)
+        out = []
+        base = address + skip
+        for index, value in enumerate(words):
+            # Most stack words are small integers or zero, so check the overall bounds before bisecting
+            if value < low or value >= high:
+                continue
+            hit = sections.find(value)
+            if hit is None:
+                hit = maps.find(value)
+            if hit is not None:
+                out.append((base + index * width, hit[0]))
+        return out
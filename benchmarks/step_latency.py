@@ -0,0 +1,167 @@
+""" Measures how long a single step takes, from the toolbar click to the last viewer being redrawn,
+by driving the plugin's real update_wrapper path against the stub Voltron server with Qt running
+offscreen. Prints p50/p95/p99 latencies for the whole step and for each stage as JSON. The stages
+are the ones the plugin's perf_monitor hooks time, so they match the performance panel.
+
+Run it with the Python that Binary Ninja uses (headless mode needs a license that allows it):
+
+    python benchmarks/step_latency.py --binary benchmarks/targets/bigbss --steps 500 --output run.json
+    python benchmarks/step_latency.py --binary benchmarks/targets/bigbss --compare run.json
+
+The plugin's own dependencies (binjatron, binja_toolbar, binja_spawn_terminal, hexview) are imported
+from --plugins, which defaults to Binary Ninja's user plugin folder. The inferior is a real process
+(--inferior, a sleeping Python by default), so the stack bounds come from its /proc/<pid>/maps just
+like they would while debugging, but every debugger request is answered by the stub.
+"""
+from __future__ import print_function
+import argparse, importlib, json, os, subprocess, sys, time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+here = os.path.dirname(os.path.realpath(__file__))
+repo = os.path.dirname(here)
+sys.path.insert(0, here)
+
+from stub_voltron import StubServer, Scenario, Replay
+
+def compare(summary, baseline, threshold):
+    """ Returns a list of (stage, baseline p95, new p95) for stages that got slower than threshold times the baseline """
+    regressions = []
+    for stage, stats in summary.items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is not None and stats['p95_ms'] > threshold * old['p95_ms'] and stats['p95_ms'] - old['p95_ms'] > 0.05:
+            regressions.append((stage, old['p95_ms'], stats['p95_ms']))
+    return regressions
+
+def stack_bounds(pid):
+    with open('/proc/{}/maps'.format(pid)) as maps:
+        for line in maps:
+            if line.rstrip().endswith('[stack]'):
+                low, high = line.split()[0].split('-')
+                return int(low, 16), int(high, 16)
+    raise RuntimeError('Process {} has no stack mapping'.format(pid))
+
+def load_plugin(plugins):
+    """ Imports the plugin as a package, the same way Binary Ninja does from the plugins folder """
+    sys.path.insert(0, plugins)
+    sys.path.insert(0, os.path.dirname(repo))
+    return importlib.import_module(os.path.basename(repo))
+
+def point_binjatron_at(port):
+    """ binjatron makes its Voltron client at import time, so swap it for one that talks to the stub """
+    import binjatron
+    from voltron.core import Client
+    binjatron.client = Client(host='127.0.0.1', port=port)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--binary', required=True, help='Binary to open in Binary Ninja')
+    parser.add_argument('--inferior', nargs='+', default=[sys.executable, '-c', 'import time; time.sleep(3600)'],
+                        help='Command for the process whose memory maps stand in for the debugged program')
+    parser.add_argument('--plugins', help="Folder with the plugin's dependencies (default: Binary Ninja's user plugin folder)")
+    parser.add_argument('--replay', help='Serve responses recorded with stub_voltron.py --record instead of the synthetic scenario')
+    parser.add_argument('--memory', choices=['local', 'voltron'], default='local',
+                        help="Read memory from /proc/<pid>/mem (the default when it's allowed) or always ask Voltron")
+    parser.add_argument('--depth', type=lambda x: int(x, 0), default=0x4000, help='How deep the synthetic stack goes')
+    parser.add_argument('--frames', type=int, default=64, help='Frames in the synthetic backtrace')
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results from an earlier run to check for regressions against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='p95 slowdown that counts as a regression')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a step before giving up')
+    args = parser.parse_args()
+
+    from PyQt5.QtWidgets import QApplication, QMainWindow
+    from PyQt5.QtCore import QEventLoop, QTimer
+    app = QApplication(sys.argv)
+    # The plugin (and binja_toolbar) go looking for Binary Ninja's main window
+    window = QMainWindow()
+
+    inferior = subprocess.Popen(args.inferior, stdin=subprocess.PIPE)
+    try:
+        time.sleep(0.2)
+        low, high = stack_bounds(inferior.pid)
+        backend = Replay(args.replay) if args.replay else \
+            Scenario(low, high, pid=inferior.pid, depth=args.depth, frames=args.frames)
+        port = StubServer(backend, port=0).start()
+
+        import binaryninja
+        plugin = load_plugin(args.plugins or binaryninja.user_plugin_path)
+        point_binjatron_at(port)
+        if args.memory == 'voltron':
+            plugin.ProcessMemory = lambda pid: (_ for _ in ()).throw(OSError('Direct reads disabled for this run'))
+
+        bv = binaryninja.BinaryViewType.get_view_of_file(args.binary)
+        bv.update_analysis_and_wait()
+        if bv.arch.name == 'x86':
+            plugin.reg_width, plugin.reg_prefix = 32, 'e'
+        plugin.return_slots = plugin.ReturnSlotCache(bv, plugin.reg_prefix + 'bp')
+        plugin.return_slots.warm_up()
+        # The stages are timed by the plugin's own perf_monitor hooks
+        perf_monitor = sys.modules[plugin.__name__ + '.perf_monitor']
+        perf_monitor.enable()
+        perf_monitor.reset(size=args.steps * 8)
+        plugin.init_scheduler()
+        plugin.show_register_window(bv)
+        plugin.show_memory_window(bv)
+        plugin.show_traceback_window(bv)
+
+        loop = QEventLoop()
+        # Connected after render_state, so it runs once the step has been drawn
+        plugin.scheduler.STATE_READY.connect(lambda _update: loop.quit())
+        # If the step or the fetch raises on the worker, STATE_READY never comes, so don't wait forever
+        timed_out = []
+        timer = QTimer()
+        timer.setSingleShot(True)
+        timer.setInterval(int(args.timeout * 1000))
+        def give_up():
+            timed_out.append(True)
+            loop.quit()
+        timer.timeout.connect(give_up)
+
+        for step in range(args.warmup + args.steps):
+            if step == args.warmup:
+                perf_monitor.reset()
+            start = perf_monitor.clock()
+            plugin.update_wrapper(plugin.step_one, bv)
+            timer.start()
+            loop.exec_()
+            timer.stop()
+            if timed_out:
+                break
+            app.processEvents()
+            perf_monitor.record('step', perf_monitor.clock() - start)
+
+        plugin.scheduler.stop()
+        plugin.scheduler.wait(int(args.timeout * 1000))
+    finally:
+        inferior.kill()
+
+    if timed_out:
+        print('FAILED: step {} took longer than {} seconds (check the Binary Ninja log for errors)'.format(
+            step, args.timeout), file=sys.stderr)
+        sys.exit(2)
+
+    results = {
+        'binary': os.path.basename(args.binary),
+        'steps': args.steps,
+        'memory': args.memory,
+        'scenario': 'replay' if args.replay else {'depth': args.depth, 'frames': args.frames},
+        'stages': perf_monitor.summary(),
+    }
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results['stages'], json.load(baseline), args.threshold)
+        for stage, old, new in regressions:
+            print('REGRESSION {}: p95 {:.3f} ms -> {:.3f} ms'.format(stage, old, new), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+""" A stand-in for the Voltron API server, for benchmarking without a debugger. It speaks the same
+JSON-over-HTTP protocol as Voltron, and answers requests either from a synthetic scenario (a program
+single stepping through a deep stack) or by replaying responses recorded from a real Voltron server.
+
+    python stub_voltron.py --port 5555                       # synthetic scenario
+    python stub_voltron.py --record responses.jsonl \\
+        --upstream http://127.0.0.1:5556                      # proxy to a real Voltron and record
+    python stub_voltron.py --replay responses.jsonl          # replay a recording
+"""
+from __future__ import print_function
+import argparse, base64, json, random, struct, threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen, Request
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen, Request
+
+page_size = 0x1000
+x86_64_registers = ['rax', 'rbx', 'rcx', 'rdx', 'rsi', 'rdi', 'rbp', 'rsp', 'r8', 'r9', 'r10', 'r11',
+                    'r12', 'r13', 'r14', 'r15', 'rip', 'rflags', 'cs', 'ss', 'ds', 'es', 'fs', 'gs']
+
+def success(data):
+    return {'type': 'response', 'status': 'success', 'data': data}
+
+def error(message, code=0x1000):
+    return {'type': 'response', 'status': 'error', 'data': {'code': code, 'message': message}}
+
+class Scenario(object):
+    """ Pretends to be a program being single stepped. Each "si" moves the instruction pointer along,
+    walks the stack pointer up and down a deep stack, writes a few bytes just above it, and every so
+    often calls or returns so the backtrace changes. Memory that hasn't been written reads back as
+    random bytes that stay the same from one request to the next. """
+    def __init__(self, stack_low, stack_high, pid=0, code_base=0x400000, depth=0x4000, frames=64,
+                 call_every=16, host_version='gdb 8.0.1', seed=0):
+        self.stack_low = stack_low
+        self.stack_high = stack_high
+        self.pid = pid
+        self.code_base = code_base
+        self.depth = depth
+        self.frames = frames
+        self.call_every = call_every
+        self.host_version = host_version
+        self.seed = seed
+        self.step = 0
+        self._pages = {}
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def _page(self, page):
+        data = self._pages.get(page)
+        if data is None:
+            rng = random.Random(self.seed ^ page)
+            data = self._pages[page] = bytearray(rng.getrandbits(8) for _ in range(page_size))
+        return data
+
+    def stack_pointer(self):
+        # Sweeps back and forth over the bottom `depth` bytes of the stack, a word at a time
+        span = self.depth // 8
+        phase = self.step % (2 * span)
+        return self.stack_high - self.depth + 8 * (phase if phase < span else 2 * span - phase - 1) - 0x100
+
+    def registers(self, deref=True):
+        sp = self.stack_pointer()
+        registers = dict((name, (self.seed + index * 0x1111 + self.step) & 0xffffffff)
+                         for index, name in enumerate(x86_64_registers))
+        registers.update({'rsp': sp, 'rbp': sp + 0x40, 'rip': self.code_base + 0x100 + (self.step % 0x400) * 4,
+                          'rflags': 0x246 if self.step % 2 else 0x202})
+        if not deref:
+            return {'registers': registers}
+        deref = dict((name, [['pointer', registers[name]]]) for name in registers)
+        return {'registers': registers, 'deref': deref}
+
+    def memory(self, address, length):
+        chunks = []
+        for page in range(address - (address % page_size), address + length, page_size):
+            low, high = max(address, page), min(address + length, page + page_size)
+            chunks.append(bytes(self._page(page)[low - page:high - page]))
+        return b''.join(chunks)
+
+    def backtrace(self):
+        count = self.frames + (self.step // self.call_every) % 4
+        return {'frames': [{'index': i, 'addr': self.code_base + 0x1000 + 0x40 * i, 'name': 'func_{}'.format(i)}
+                           for i in range(count)]}
+
+    def command(self, command):
+        if command in ('si', 'ni', 'stepi', 'nexti'):
+            self.step += 1
+            # Leave a little evidence on the stack so there's something for the memory view to diff
+            sp = self.stack_pointer()
+            page = self._page(sp - sp % page_size)
+            struct.pack_into('<Q', page, sp % page_size & ~7, self.step)
+            return ''
+        if command == 'info inferiors':
+            return '  Num  Description       Executable\n* 1    process {}     /tmp/target\n'.format(self.pid)
+        if command == 'process status':
+            return 'Process {} stopped\n'.format(self.pid)
+        return ''
+
+    def respond(self, request, data):
+        with self._lock:
+            if request == 'version':
+                return success({'api_version': 1.1, 'host_version': self.host_version, 'capabilities': []})
+            if request == 'state':
+                return success({'state': 'stopped'})
+            if request == 'registers':
+                return success(self.registers(data.get('deref', True)))
+            if request == 'memory':
+                memory = self.memory(int(data['address']), int(data['length']))
+                return success({'memory': base64.b64encode(memory).decode('ascii')})
+            if request == 'backtrace':
+                return success(self.backtrace())
+            if request == 'command':
+                return success({'output': self.command(data.get('command', '').strip())})
+            return error('Unknown request type: ' + str(request))
+
+def _key(request, data):
+    return json.dumps([request, dict((k, v) for k, v in data.items() if k != 'block')], sort_keys=True)
+
+class Replay(object):
+    """ Serves responses recorded from a real Voltron server. Requests are matched on their type and
+    arguments, and repeated requests get the recorded answers in order, starting over at the end. """
+    def __init__(self, path):
+        self._responses = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        with open(path) as recording:
+            for line in recording:
+                entry = json.loads(line)
+                self._responses.setdefault(_key(entry['request'], entry['data']), []).append(entry['response'])
+
+    def respond(self, request, data):
+        key = _key(request, data)
+        with self._lock:
+            answers = self._responses.get(key)
+            if not answers:
+                return error('No recorded response for ' + key)
+            index = self._next.get(key, 0)
+            self._next[key] = (index + 1) % len(answers)
+            return answers[index]
+
+class Recorder(object):
+    """ Forwards every request to a real Voltron server and appends each exchange to a JSONL file """
+    def __init__(self, path, upstream):
+        self._file = open(path, 'a')
+        self._upstream = upstream.rstrip('/') + '/api/request'
+        self._lock = threading.Lock()
+
+    def respond(self, request, data):
+        body = json.dumps({'type': 'request', 'request': request, 'data': data}).encode('utf-8')
+        response = json.loads(urlopen(Request(self._upstream, body, {'Content-Type': 'application/json'})).read().decode('utf-8'))
+        with self._lock:
+            self._file.write(json.dumps({'request': request, 'data': data, 'response': response}) + '\n')
+            self._file.flush()
+        return response
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real server
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        try:
+            response = self.server.backend.respond(body.get('request'), body.get('data') or {})
+        except Exception as e:
+            response = error('Stub server raised an exception: ' + str(e))
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """ Answers each request on its own thread, since get_state puts a whole batch on the wire at once """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, backend, host='127.0.0.1', port=5555):
+        HTTPServer.__init__(self, (host, port), _Handler)
+        self.backend = backend
+
+    def start(self):
+        """ Serves on a background thread and returns the port we ended up on """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server_address[1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--replay', help='JSONL file of recorded responses to serve')
+    parser.add_argument('--record', help='JSONL file to append exchanges with --upstream to')
+    parser.add_argument('--upstream', default='http://127.0.0.1:5556', help='Real Voltron server to record from')
+    parser.add_argument('--stack', default='0x7ffffffde000-0x7ffffffff000', help='Stack mapping of the synthetic scenario')
+    parser.add_argument('--depth', type=lambda x: int(x, 0), default=0x4000, help='How deep the synthetic stack goes')
+    parser.add_argument('--frames', type=int, default=64, help='Frames in the synthetic backtrace')
+    args = parser.parse_args()
+    if args.replay:
+        backend = Replay(args.replay)
+    elif args.record:
+        backend = Recorder(args.record, args.upstream)
+    else:
+        low, high = [int(x, 16) for x in args.stack.split('-')]
+        backend = Scenario(low, high, depth=args.depth, frames=args.frames)
+    server = StubServer(backend, port=args.port)
+    print('Stub Voltron server listening on port', server.server_address[1])
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
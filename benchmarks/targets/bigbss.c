@@ -0,0 +1,22 @@
+/* Benchmark target with a 16 MB .bss and a deep call stack.
+ * Build with: gcc -O0 -g -o bigbss bigbss.c */
+#include <stdio.h>
+
+static char big[16 * 1024 * 1024];
+
+static int recurse(int depth)
+{
+    char frame[256];
+    frame[0] = (char) depth;
+    if (depth == 0)
+        return getchar() + frame[0];
+    return recurse(depth - 1) + frame[0];
+}
+
+int main(void)
+{
+    int i;
+    for (i = 0; i < (int) sizeof(big); i += 4096)
+        big[i] = (char) i;
+    return recurse(200) + big[4096];
+}
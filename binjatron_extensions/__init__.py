@@ -1,17 +1,25 @@
-import binjatron, tempfile
+import binjatron, tempfile, threading, re, errno, json, time
 from binaryninja import log_error, log_info
+from ..perf_monitor import timed, stage
 
 # Most of this module is undocumented, but hopefully the function names and inline strings
 # will make the functionality fairly clear. This module serves as a wrapper around the functions
 # exported by binjatron that allow us to get a lot more functionality in terms of interaction
 # with Voltron, but without having to modify Binjatron itself.
 
+# Optional local reader (eg, procfs.ProcessMemory) that memory requests try before going through Voltron
+memory_backend = None
+# Shortest time between progress callbacks while running a burst of instructions
+progress_interval = 0.25
+
 def _build_command_dict(cmd):
     return {"command": cmd, "block": False}
 
+@timed("voltron.get_version")
 def get_version(_view):
     return binjatron.custom_request("version", {})
 
+@timed("voltron.set_arguments")
 def set_arguments(arguments, _view):
     version = get_version(_view).host_version
     if 'gdb' in version:
@@ -32,24 +40,320 @@ def set_arguments(arguments, _view):
             tempf.flush()
             binjatron.custom_request("command", _build_command_dict("command source " + tempf.name))
 
+@timed("voltron.run_binary")
 def run_binary(_view):
     binjatron.custom_request("command", _build_command_dict("run"))
 
+@timed("voltron.step_one")
 def step_one(_view):
     binjatron.custom_request("command", _build_command_dict("si"))
 
+@timed("voltron.step_over")
 def step_over(_view):
     binjatron.custom_request("command", _build_command_dict("ni"))
 
+@timed("voltron.step_out")
 def step_out(_view):
     binjatron.custom_request("command", _build_command_dict("finish"))
 
+@timed("voltron.kill")
 def kill(_view):
     binjatron.custom_request("command", _build_command_dict("ki"), alert=False)
 
+@timed("voltron.continue_exec")
 def continue_exec(_view):
     binjatron.custom_request("command", _build_command_dict("continue"))
 
+def _progress(progress, done, total, last):
+    """ Calls progress(done, total) unless we already did recently. Returns (keep going, time of last call). """
+    now = time.time()
+    if progress is None or (now - last < progress_interval and done < total):
+        return True, last
+    return progress(done, total) is not False, now
+
+@timed("voltron.step_n")
+def step_n(_view, count, progress=None, chunk=1000):
+    """ Runs count instructions without stopping in between, in chunks of chunk instructions so
+    progress(done, count) can be called (at most every progress_interval seconds) and can return
+    False to stop early. Returns how many instructions were run. """
+    version = get_version(_view).host_version
+    done, last = 0, time.time()
+    while done < count:
+        n = min(chunk, count - done)
+        if 'gdb' in version:
+            res = binjatron.custom_request("command", _build_command_dict("stepi " + str(n)), alert=False)
+        else:
+            res = binjatron.custom_request("command", _build_command_dict("thread step-inst -c " + str(n)), alert=False)
+        if res.is_error:
+            log_error("Stopped stepping after " + str(done) + " instructions -- " + res.message)
+            break
+        done += n
+        keep_going, last = _progress(progress, done, count, last)
+        if not keep_going:
+            break
+    return done
+
+# Sourced by the debugger to step until a condition holds without talking to Voltron in between.
+# The result goes back through a file, since Voltron only hands us the command's text output.
+_run_until_gdb = """
+import gdb, json
+condition, limit, out = {condition!r}, {limit!r}, {out!r}
+steps, hit, error = 0, False, None
+try:
+    while steps < limit:
+        gdb.execute("stepi", to_string=True)
+        steps += 1
+        if int(gdb.parse_and_eval(condition)) != 0:
+            hit = True
+            break
+except gdb.error as e:
+    error = str(e)
+with open(out, "w") as f:
+    json.dump({{"steps": steps, "hit": hit, "error": error}}, f)
+"""
+
+_run_until_lldb = """
+import lldb, json
+condition, limit, out = {condition!r}, {limit!r}, {out!r}
+steps, hit, error = 0, False, None
+process = lldb.debugger.GetSelectedTarget().GetProcess()
+thread = process.GetSelectedThread()
+while steps < limit:
+    thread.StepInstruction(False)
+    steps += 1
+    if process.GetState() != lldb.eStateStopped:
+        error = "The process is no longer stopped"
+        break
+    value = thread.GetSelectedFrame().EvaluateExpression(condition)
+    if not value.GetError().Success():
+        error = value.GetError().GetCString()
+        break
+    if value.GetValueAsUnsigned() != 0:
+        hit = True
+        break
+with open(out, "w") as f:
+    json.dump({{"steps": steps, "hit": hit, "error": error}}, f)
+"""
+
+def _source_script(version, code):
+    """ Has the debugger run some Python, sourced from a temp file the same way set_arguments does it """
+    command = "source " if 'gdb' in version else "command script import "
+    with tempfile.NamedTemporaryFile(suffix='.py') as script:
+        script.write(code)
+        script.flush()
+        return binjatron.custom_request("command", _build_command_dict(command + script.name), alert=False)
+
+@timed("voltron.run_until")
+def run_until(_view, condition, limit=1000000, progress=None, chunk=1000):
+    """ Steps until condition (an expression in the debugger's own syntax, eg "$rax == 0 && *(int *)($rsp + 8) > 3")
+    is true, for at most limit instructions. The condition is checked by the debugger after every instruction.
+    progress works the same as for step_n. Returns (instructions run, whether the condition was hit, error or None). """
+    version = get_version(_view).host_version
+    if 'gdb' in version:
+        template = _run_until_gdb
+    elif 'lldb' in version:
+        template = _run_until_lldb
+    else:
+        return 0, False, "Unknown debugger: " + version
+    done, last = 0, time.time()
+    while done < limit:
+        n = min(chunk, limit - done)
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            res = _source_script(version, template.format(condition=condition, limit=n, out=out.name))
+            if res.is_error:
+                return done, False, res.message
+            try:
+                with open(out.name) as f:
+                    result = json.load(f)
+            except ValueError:
+                # The script never got as far as writing its result, so the output should say why
+                return done, False, res.output
+        done += result['steps']
+        if result['hit'] or result['error'] is not None:
+            return done, result['hit'], result['error']
+        keep_going, last = _progress(progress, done, limit, last)
+        if not keep_going:
+            break
+    return done, False, None
+
+# Tracepoints are breakpoints that note down some values and carry on without stopping. Hits pile up in the
+# debugger and get appended to the output file as one JSON line of {"address": [[value, ...], ...]} each time
+# the program really stops. The state lives somewhere that survives the script being sourced again.
+_tracepoints_gdb = """
+import gdb, json
+if not hasattr(gdb, "_binja_tracepoints"):
+    gdb._binja_tracepoints = {{"out": None, "hits": {{}}, "points": []}}
+    def _flush(_event=None):
+        state = gdb._binja_tracepoints
+        if state["hits"] and state["out"] is not None:
+            with open(state["out"], "a") as f:
+                f.write(json.dumps(state["hits"]) + "\\n")
+        state["hits"] = {{}}
+    gdb.events.stop.connect(_flush)
+    gdb.events.exited.connect(_flush)
+    class Tracepoint(gdb.Breakpoint):
+        def __init__(self, address, expressions):
+            gdb.Breakpoint.__init__(self, "*" + hex(address), internal=True)
+            self.key, self.expressions = str(address), expressions
+        def stop(self):
+            values = []
+            for expression in self.expressions:
+                try:
+                    values.append(int(gdb.parse_and_eval(expression)))
+                except (gdb.error, ValueError, OverflowError):
+                    values.append(None)
+            gdb._binja_tracepoints["hits"].setdefault(self.key, []).append(values)
+            return False
+    gdb._binja_tracepoint_class = Tracepoint
+state = gdb._binja_tracepoints
+if {clear!r}:
+    for point in state["points"]:
+        point.delete()
+    state["points"], state["hits"] = [], {{}}
+state["out"] = {out!r}
+for address, expressions in {points!r}:
+    state["points"].append(gdb._binja_tracepoint_class(address, expressions))
+"""
+
+_tracepoints_lldb = """
+import lldb, json
+if not hasattr(lldb, "_binja_tracepoints"):
+    lldb._binja_tracepoints = {{"out": None, "hits": {{}}, "points": []}}
+    def _flush():
+        state = lldb._binja_tracepoints
+        if state["hits"] and state["out"] is not None:
+            with open(state["out"], "a") as f:
+                f.write(json.dumps(state["hits"]) + "\\n")
+        state["hits"] = {{}}
+    def _hit(frame, location, _dict):
+        key = str(location.GetLoadAddress())
+        values = []
+        for expression in lldb._binja_tracepoints["expressions"][key]:
+            if expression.startswith("$") and frame.FindRegister(expression[1:]).IsValid():
+                value = frame.FindRegister(expression[1:])
+            else:
+                value = frame.EvaluateExpression(expression)
+            values.append(value.GetValueAsUnsigned() if value.GetError().Success() else None)
+        lldb._binja_tracepoints["hits"].setdefault(key, []).append(values)
+        return False
+    lldb._binja_flush, lldb._binja_hit = _flush, _hit
+    lldb._binja_tracepoints["expressions"] = {{}}
+    lldb.debugger.HandleCommand("target stop-hook add -o 'script lldb._binja_flush()'")
+state = lldb._binja_tracepoints
+target = lldb.debugger.GetSelectedTarget()
+if {clear!r}:
+    for point in state["points"]:
+        target.BreakpointDelete(point)
+    state["points"], state["hits"], state["expressions"] = [], {{}}, {{}}
+state["out"] = {out!r}
+for address, expressions in {points!r}:
+    breakpoint = target.BreakpointCreateByAddress(address)
+    breakpoint.SetScriptCallbackFunction("lldb._binja_hit")
+    state["expressions"][str(address)] = expressions
+    state["points"].append(breakpoint.GetID())
+"""
+
+@timed("voltron.set_tracepoints")
+def set_tracepoints(_view, points, out, clear=False):
+    """ Installs a tracepoint at each address in the points dict, which maps addresses to lists of debugger
+    expressions (eg ["$rax", "*(long *)($rsp + 8)"]) to record each time it's hit. Everything goes in with
+    a single command. Hits are appended to the file at out whenever execution stops. With clear, any
+    tracepoints already installed are removed first. Returns None, or an error message. """
+    version = get_version(_view).host_version
+    if 'gdb' in version:
+        template = _tracepoints_gdb
+    elif 'lldb' in version:
+        template = _tracepoints_lldb
+    else:
+        return "Unknown debugger: " + version
+    points = [(int(address), [str(e) for e in expressions]) for address, expressions in points.items()]
+    res = _source_script(version, template.format(points=points, out=out, clear=bool(clear)))
+    return res.message if res.is_error else None
+
+# Coverage breakpoints note their address and get deleted the first time they're hit, without stopping. gdb doesn't
+# allow deleting a breakpoint from its own stop(), so that gets posted to run once the hit has been dealt with.
+# Addresses that were hit get appended to the output file as a JSON list each time the program really stops.
+_coverage_gdb = """
+import gdb, json
+if not hasattr(gdb, "_binja_coverage"):
+    gdb._binja_coverage = {{"out": None, "hits": [], "points": {{}}}}
+    def _flush(_event=None):
+        state = gdb._binja_coverage
+        if state["hits"] and state["out"] is not None:
+            with open(state["out"], "a") as f:
+                f.write(json.dumps(state["hits"]) + "\\n")
+        state["hits"] = []
+    gdb.events.stop.connect(_flush)
+    gdb.events.exited.connect(_flush)
+    class CoveragePoint(gdb.Breakpoint):
+        def __init__(self, address):
+            gdb.Breakpoint.__init__(self, "*" + hex(address), internal=True)
+            self.address = address
+        def stop(self):
+            gdb._binja_coverage["hits"].append(self.address)
+            gdb._binja_coverage["points"].pop(self.address, None)
+            gdb.post_event(self.delete)
+            return False
+    gdb._binja_coverage_class = CoveragePoint
+state = gdb._binja_coverage
+if {clear!r}:
+    for point in state["points"].values():
+        if point.is_valid():
+            point.delete()
+    state["points"], state["hits"] = {{}}, []
+state["out"] = {out!r}
+for address in {addresses!r}:
+    if address not in state["points"]:
+        state["points"][address] = gdb._binja_coverage_class(address)
+"""
+
+_coverage_lldb = """
+import lldb, json
+if not hasattr(lldb, "_binja_coverage"):
+    lldb._binja_coverage = {{"out": None, "hits": [], "points": {{}}}}
+    def _flush():
+        state = lldb._binja_coverage
+        if state["hits"] and state["out"] is not None:
+            with open(state["out"], "a") as f:
+                f.write(json.dumps(state["hits"]) + "\\n")
+        state["hits"] = []
+    def _hit(frame, location, _dict):
+        address = location.GetLoadAddress()
+        lldb._binja_coverage["hits"].append(address)
+        location.GetBreakpoint().SetEnabled(False)
+        return False
+    lldb._binja_coverage_flush, lldb._binja_coverage_hit = _flush, _hit
+    lldb.debugger.HandleCommand("target stop-hook add -o 'script lldb._binja_coverage_flush()'")
+state = lldb._binja_coverage
+target = lldb.debugger.GetSelectedTarget()
+if {clear!r}:
+    for point in state["points"].values():
+        target.BreakpointDelete(point)
+    state["points"], state["hits"] = {{}}, []
+state["out"] = {out!r}
+for address in {addresses!r}:
+    if address not in state["points"]:
+        breakpoint = target.BreakpointCreateByAddress(address)
+        breakpoint.SetScriptCallbackFunction("lldb._binja_coverage_hit")
+        state["points"][address] = breakpoint.GetID()
+"""
+
+@timed("voltron.set_coverage_breakpoints")
+def set_coverage_breakpoints(_view, addresses, out, clear=False):
+    """ Puts a one-shot, non-stopping breakpoint on every address in the list, with a single command. The
+    addresses that get hit are appended to the file at out whenever execution stops. With clear, any coverage
+    breakpoints that haven't been hit yet are removed first. Returns None, or an error message. """
+    version = get_version(_view).host_version
+    if 'gdb' in version:
+        template = _coverage_gdb
+    elif 'lldb' in version:
+        template = _coverage_lldb
+    else:
+        return "Unknown debugger: " + version
+    res = _source_script(version, template.format(addresses=[int(a) for a in addresses], out=out, clear=bool(clear)))
+    return res.message if res.is_error else None
+
+@timed("voltron.set_tty")
 def set_tty(_view, tty):
     version = get_version(_view).host_version
     if 'gdb' in version:
@@ -58,6 +362,26 @@ def set_tty(_view, tty):
         binjatron.custom_request("command", _build_command_dict("settings set target.input-path " + tty))
         binjatron.custom_request("command", _build_command_dict("settings set target.output-path " + tty))
 
+@timed("voltron.get_pid")
+def get_pid(_view):
+    """ Asks the debugger for the PID of the inferior. Returns None if nothing is running. """
+    version = get_version(_view).host_version
+    if 'gdb' in version:
+        # *  1    process 12345     /path/to/binary
+        command = "info inferiors"
+    elif 'lldb' in version:
+        # Process 12345 stopped
+        command = "process status"
+    else:
+        return None
+    res = binjatron.custom_request("command", _build_command_dict(command), alert=False)
+    if res.is_error:
+        log_error("Could not get the PID of the inferior -- " + res.message)
+        return None
+    match = re.search(r'[Pp]rocess (\d+)', res.output)
+    return int(match.group(1)) if match is not None else None
+
+@timed("voltron.get_registers")
 def get_registers(_view):
     res = binjatron.custom_request("registers", {"block":False, "deref":True}, alert=False)
     if(res.is_error):
@@ -65,13 +389,41 @@ def get_registers(_view):
         return None, res.message
     return res.registers, res.deref
 
-def get_memory(_view, address, length):
+def set_memory_backend(backend):
+    """ Sets (or clears, with None) the local memory reader that get_memory and get_state try first """
+    global memory_backend
+    if memory_backend is not None and memory_backend is not backend:
+        memory_backend.close()
+    memory_backend = backend
+
+def _read_local(address, length, slot=None):
+    """ Tries to read memory with the local backend. Returns None if we have to ask Voltron instead. """
+    global memory_backend
+    backend = memory_backend
+    if backend is None:
+        return None
+    try:
+        return backend.read_into(address, length, slot)
+    except (IOError, OSError) as e:
+        if getattr(e, 'errno', None) in (errno.EACCES, errno.EPERM):
+            # We aren't allowed to look at this process after all, so stop trying
+            log_info("Direct memory reads are blocked, falling back to Voltron -- " + str(e))
+            memory_backend = None
+        return None
+
+@timed("voltron.get_memory")
+def get_memory(_view, address, length, slot=None):
+    """ Reads memory, locally if we can. Callers on different threads should pass different slots. """
+    local = _read_local(address, length, slot)
+    if local is not None:
+        return local.tobytes()
     res = binjatron.custom_request("memory", {"block":False, "address":address, "length":length}, alert=False)
     if(res.is_error):
         log_error("Could not get memory at address ``" + str(address) + " -- " + res.message)
         return None
     return res.memory
 
+@timed("voltron.get_backtrace")
 def get_backtrace(_view):
     try:
         res = binjatron.custom_request("backtrace", {"block:":False}, alert=False)
@@ -85,6 +437,103 @@ def get_backtrace(_view):
         return None
     return res.frames
 
+class StateResult(object):
+    """ Holds the answers to a batch of state requests, in the same order the requests
+    were made. Errors are kept per item, so a failed backtrace doesn't throw away the
+    registers and memory that came back fine. """
+    def __init__(self, requests):
+        self.requests = requests
+        self.values = [None] * len(requests)
+        self.errors = [None] * len(requests)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+    def ok(self, index):
+        return self.errors[index] is None
+
+    def error(self, index):
+        return self.errors[index]
+
+def registers_request(names=None, deref=True):
+    """ Asks for the general purpose registers, or just the named ones. Voltron's dereference
+    chains cost it a memory read per register, so they can be left out when nobody is looking. """
+    return ('registers', names, deref)
+
+def memory_request(address, length):
+    return ('memory', address, length)
+
+def backtrace_request():
+    return ('backtrace',)
+
+def _voltron_request(request):
+    """ Translates one of our sub-requests into the request type and arguments Voltron expects """
+    if request[0] == 'registers':
+        if request[1] is not None:
+            return "registers", {"block":False, "deref":False, "registers":request[1]}
+        return "registers", {"block":False, "deref":request[2]}
+    if request[0] == 'memory':
+        return "memory", {"block":False, "address":request[1], "length":request[2]}
+    if request[0] == 'backtrace':
+        return "backtrace", {"block":False}
+    raise ValueError("Unknown state request: " + str(request[0]))
+
+def _unpack_response(request, res):
+    if request[0] == 'registers':
+        return res.registers, res.deref or {}
+    if request[0] == 'memory':
+        return res.memory
+    return res.frames
+
+def _perform(result, index):
+    request = result.requests[index]
+    with stage("request." + request[0]):
+        _perform_request(result, index, request)
+
+def _perform_request(result, index, request):
+    if request[0] == 'memory':
+        local = _read_local(request[1], request[2], slot=index)
+        if local is not None:
+            result.values[index] = local
+            return
+    try:
+        res = binjatron.custom_request(*_voltron_request(request), alert=False)
+    except Exception as e:
+        result.errors[index] = "Voltron raised an exception: " + str(e)
+        return
+    if res is None or res.is_error:
+        result.errors[index] = res.message if res is not None else "No response"
+        return
+    result.values[index] = _unpack_response(request, res)
+
+@timed("voltron.get_state")
+def get_state(_view, requests):
+    """ Fetches a batch of registers_request/memory_request/backtrace_request items and returns a
+    StateResult. Voltron's API has no envelope for several requests (its own Client.send_requests
+    opens a connection per request too), so this is not one exchange: each request that has to go
+    to Voltron is sent on its own connection, all of them at once, and we wait for the slowest.
+    That still costs one round trip of latency per step instead of one per request. Memory requests
+    are served by the local memory backend when there is one, in which case the value is a
+    memoryview on a buffer that gets reused by the next batch, so wrap values in memoryview() and
+    copy out what you want to keep. """
+    result = StateResult(list(requests))
+    workers = [threading.Thread(target=_perform, args=(result, i)) for i in range(1, len(result))]
+    for worker in workers:
+        worker.start()
+    if len(result) > 0:
+        # No point spinning up a thread for the first request when this one is just going to wait
+        _perform(result, 0)
+    for worker in workers:
+        worker.join()
+    for request, error in zip(result.requests, result.errors):
+        if error is not None:
+            log_error("Could not get " + request[0] + " -- " + error)
+    return result
+
+@timed("voltron.sync")
 def sync(bv):
     binjatron.sync(bv)
     return binjatron.sync_state()
@@ -0,0 +1,56 @@
+from binaryninja import HighlightStandardColor
+import json, os, tempfile
+
+hit_color = HighlightStandardColor.GreenHighlightColor
+
+class CoverageMap(object):
+    """ Tracks which basic blocks of a binary view have run. The debugger appends the addresses of blocks
+    as they get hit to a file, and import_new only reads what's been added since the last call. """
+    def __init__(self, bv, functions=None):
+        self.bv = bv
+        self.blocks = {}
+        for func in (functions if functions is not None else bv.functions):
+            for block in func.basic_blocks:
+                self.blocks[block.start] = block
+        self.hit = set()
+        handle, self.path = tempfile.mkstemp(prefix='binja_coverage_', suffix='.jsonl')
+        os.close(handle)
+        self._offset = 0
+
+    def addresses(self):
+        """ Start addresses of the blocks that haven't been hit yet """
+        return sorted(address for address in self.blocks if address not in self.hit)
+
+    def import_new(self):
+        """ Reads whatever the debugger wrote since the last call. Returns the blocks that were hit for the first time. """
+        try:
+            if os.path.getsize(self.path) <= self._offset:
+                return []
+            hits = open(self.path)
+        except (IOError, OSError):
+            return [] # Closed while we were on our way here
+        new = []
+        with hits:
+            hits.seek(self._offset)
+            for line in hits:
+                if not line.endswith('\n'):
+                    break # The debugger is still writing this one, so pick it up next time
+                self._offset += len(line)
+                for address in json.loads(line):
+                    if address in self.blocks and address not in self.hit:
+                        self.hit.add(address)
+                        new.append(self.blocks[address])
+        return new
+
+    def highlight(self, blocks, color=hit_color):
+        """ Paints every block in one pass. Uses auto highlights so none of it ends up in the undo history.
+        Run this on the main thread. """
+        for block in blocks:
+            block.set_auto_highlight(color)
+
+    def clear_highlights(self):
+        self.highlight([self.blocks[address] for address in self.hit], HighlightStandardColor.NoHighlightColor)
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
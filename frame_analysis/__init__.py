@@ -0,0 +1,149 @@
+from binaryninja import BinaryDataNotification, LowLevelILOperation, log_error
+from bisect import bisect_right
+import threading, traceback
+
+def _offset(value):
+    """ Binja only gives register values an offset when it knows where they point relative to the stack frame """
+    return value.offset if hasattr(value, 'offset') else None
+
+class FunctionInfo(object):
+    """ Everything we need to know about a function to work out where its return address lives.
+    The return instructions are found once, and the register offsets at each ip are memoized
+    as we step through the function. """
+    def __init__(self, func, stack_pointer, base_pointer):
+        self.function = func
+        self.start = func.start
+        self._stack_pointer = stack_pointer
+        self._base_pointer = base_pointer
+        self._offsets = {}
+        # (address, stack pointer offset at the return) for each return instruction
+        self.returns = []
+        for block in func.low_level_il:
+            for instr in block:
+                if instr.operation == LowLevelILOperation.LLIL_RET:
+                    self.returns.append((instr.address, _offset(func.get_reg_value_at(instr.address, stack_pointer))))
+
+    def offsets_at(self, ip):
+        """ Returns the (base pointer, stack pointer) offsets from the start of the frame at ip.
+        Either may be None if Binja can't tell. """
+        offsets = self._offsets.get(ip)
+        if offsets is None:
+            offsets = (_offset(self.function.get_reg_value_at(ip, self._base_pointer)),
+                       _offset(self.function.get_reg_value_at(ip, self._stack_pointer)))
+            self._offsets[ip] = offsets
+        return offsets
+
+class ReturnSlotCache(BinaryDataNotification):
+    """ Caches FunctionInfo by function start, along with a sorted index of basic block ranges
+    so we can find the function containing an ip with a bisect instead of asking Binja every step.
+    Registers itself for notifications so anything Binja reanalyzes gets thrown out. """
+    def __init__(self, bv, base_pointer):
+        BinaryDataNotification.__init__(self)
+        self.bv = bv
+        self._stack_pointer = bv.arch.stack_pointer
+        self._base_pointer = base_pointer
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._generations = {} # Bumped each time a function is invalidated, so we can spot stale FunctionInfos
+        self._starts = []
+        self._ranges = []
+        self._index_stale = True
+        self._invalidations = 0 # Lets _build_index tell whether analysis changed anything while it ran
+        self._warming = False
+        bv.register_notification(self)
+
+    def close(self):
+        self.bv.unregister_notification(self)
+
+    def warm_up(self):
+        """ Builds the function index and the metadata for every function in a background thread """
+        with self._lock:
+            if self._warming:
+                return
+            self._warming = True
+        thread = threading.Thread(target=self._warm)
+        thread.daemon = True
+        thread.start()
+
+    def _warm(self):
+        try:
+            self._build_index()
+            for func in list(self.bv.functions):
+                with self._lock:
+                    if func.start in self._functions:
+                        continue
+                    generation = self._generations.get(func.start, 0)
+                info = FunctionInfo(func, self._stack_pointer, self._base_pointer)
+                self._store(func.start, generation, info)
+        except Exception:
+            log_error(traceback.format_exc())
+        finally:
+            with self._lock:
+                self._warming = False
+
+    def _build_index(self):
+        ranges = []
+        with self._lock:
+            invalidations = self._invalidations
+        for func in list(self.bv.functions):
+            for block in func.basic_blocks:
+                ranges.append((block.start, block.end, func))
+        ranges.sort(key=lambda r: r[0])
+        with self._lock:
+            self._ranges = ranges
+            self._starts = [r[0] for r in ranges]
+            # function_at keeps asking Binja directly until the index is done, and if a function changed
+            # while we were building it, the index stays stale so the next lookup rebuilds it
+            self._index_stale = self._invalidations != invalidations
+
+    def function_at(self, ip):
+        """ Returns the function containing ip, or None if it isn't in one """
+        with self._lock:
+            stale = self._index_stale
+            index = bisect_right(self._starts, ip) - 1
+            if not stale and index >= 0 and ip < self._ranges[index][1]:
+                return self._ranges[index][2]
+        if stale:
+            # Fall back on asking Binja while the index gets rebuilt
+            self.warm_up()
+            blocks = self.bv.get_basic_blocks_at(ip)
+            if len(blocks) > 0:
+                return blocks[0].function
+        return None
+
+    def lookup(self, ip):
+        """ Returns the FunctionInfo for the function containing ip, or None """
+        func = self.function_at(ip)
+        if func is None:
+            return None
+        with self._lock:
+            info = self._functions.get(func.start)
+            generation = self._generations.get(func.start, 0)
+        if info is None:
+            info = FunctionInfo(func, self._stack_pointer, self._base_pointer)
+            self._store(func.start, generation, info)
+        return info
+
+    def _store(self, start, generation, info):
+        """ Caches a FunctionInfo built outside the lock, unless analysis invalidated the function while
+        it was being built (in which case it may describe the old version, and the next lookup rebuilds it) """
+        with self._lock:
+            if self._generations.get(start, 0) == generation:
+                self._functions.setdefault(start, info)
+
+    def invalidate(self, func):
+        with self._lock:
+            self._functions.pop(func.start, None)
+            self._generations[func.start] = self._generations.get(func.start, 0) + 1
+            self._invalidations += 1
+            self._index_stale = True
+
+    # Binja calls these whenever analysis changes a function
+    def function_added(self, view, func):
+        self.invalidate(func)
+
+    def function_removed(self, view, func):
+        self.invalidate(func)
+
+    def function_updated(self, view, func):
+        self.invalidate(func)
@@ -0,0 +1,468 @@
+from __future__ import print_function
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, pyqtSignal
+from PyQt5.QtGui import QFontDatabase, QColor
+from array import array
+from bisect import bisect_left, bisect_right
+import os, struct, zlib
+
+page_size = 0x1000
+# Unsigned 64 bit array typecode. Python 2's array module doesn't have 'Q', but 'L' is 64 bits on x86_64 Linux.
+try:
+    array('Q')
+    word = 'Q'
+except ValueError:
+    word = 'L'
+
+# glibc's tcache_perthread_struct is the first chunk on the heap. Its size tells us whether the counts are
+# uint16_t (glibc 2.30 and later) or char, keyed by the size of a pointer.
+tcache_struct_sizes = {8: {0x290: 2, 0x250: 1}, 4: {0x190: 2, 0x150: 1}}
+tcache_bins = 64
+max_bin_walk = 1024 # Give up on a free list after this many entries, in case it's corrupted into a loop
+# main_arena is found by looking for its pointer to the top chunk. The fastbins come just before that
+# pointer and last_remainder and the regular bins just after it, whichever glibc version this is.
+fastbins = 10
+regular_bins = 127 # Bin 1 is the unsorted bin, 2-63 are small bins and 64-127 are large bins
+max_arena_search = 0x100000
+
+PREV_INUSE, IS_MMAPPED, NON_MAIN_ARENA = 1, 2, 4
+
+class HeapChunks(object):
+    """ The main thread's copy of the chunk index. The worker thread's HeapIndex sends HeapDeltas with just
+    the rows that were re-parsed, which get spliced in here, so the whole index is never copied per step. """
+    def __init__(self, word_size=8):
+        self.word_size = word_size
+        self.base, self.end = 0, 0
+        self.seq = 0
+        self.starts = array(word)
+        self.sizes = array(word)
+        self.fds = array(word)
+        self.bks = array(word)
+        self.tcache = {}
+        self.bins = {}
+        self.arena = None
+        self.reparsed = 0
+
+    def apply(self, delta):
+        """ Splices in every change this copy hasn't seen yet """
+        for seq, row, removed, starts, sizes, fds, bks in delta.splices:
+            if seq <= self.seq:
+                continue
+            self.starts[row:row + removed] = starts
+            self.sizes[row:row + removed] = sizes
+            self.fds[row:row + removed] = fds
+            self.bks[row:row + removed] = bks
+        self.seq = delta.seq
+        self.base, self.end = delta.base, delta.end
+        self.tcache, self.bins, self.arena = delta.tcache, delta.bins, delta.arena
+        self.reparsed = delta.reparsed
+
+    def __len__(self):
+        return len(self.starts)
+
+    def length(self, row):
+        return self.sizes[row] & ~7
+
+    def valid(self, row):
+        length = self.length(row)
+        return length >= 2 * self.word_size and length % (2 * self.word_size) == 0 and \
+            self.starts[row] + length <= self.end
+
+    def state(self, row):
+        """ One of 'corrupt', 'tcache', 'top', 'free' or 'in use' """
+        if not self.valid(row):
+            return 'corrupt'
+        if self.starts[row] in self.tcache:
+            return 'tcache'
+        arena_bin = self.bins.get(self.starts[row])
+        if arena_bin is not None:
+            return 'fastbin' if arena_bin[0].startswith('fastbin') else 'free'
+        if row + 1 == len(self.starts):
+            return 'top'
+        # A chunk is free when the next one says the previous chunk isn't in use. Fastbin and tcache
+        # chunks keep the bit set, which is why the bins are checked above.
+        return 'in use' if self.sizes[row + 1] & PREV_INUSE else 'free'
+
+    def find(self, address):
+        """ Returns the row of the chunk containing address, or None """
+        row = bisect_right(self.starts, address) - 1
+        if row >= 0 and address < self.starts[row] + max(self.length(row), 2 * self.word_size):
+            return row
+        return None
+
+    def annotations(self, first, last):
+        """ (address, length, colour) for the header of each chunk between first and last, for the memory map viewer """
+        marks = []
+        row = max(0, bisect_left(self.starts, first) - 1)
+        while row < len(self.starts) and self.starts[row] < last:
+            marks.append((self.starts[row], 2 * self.word_size, state_colors[self.state(row)]))
+            row += 1
+        return marks
+
+state_colors = {'in use': QColor(128, 198, 233), 'free': QColor(255, 153, 51), 'tcache': QColor(162, 217, 175),
+                'fastbin': QColor(255, 204, 102), 'top': QColor(200, 200, 200), 'corrupt': QColor(222, 143, 151)}
+
+class HeapDelta(object):
+    """ What changed in a HeapIndex since the main thread last caught up: the splices it hasn't applied yet,
+    plus the free lists, which are small enough to send whole """
+    def __init__(self, index):
+        self.word_size = index.word_size
+        self.seq = index.seq
+        self.splices = list(index._splices)
+        self.base, self.end = index.base, index.end
+        self.tcache = dict(index.tcache)
+        self.bins = dict(index.bins)
+        self.arena = index.arena_top
+        self.reparsed = index.reparsed
+
+class HeapIndex(object):
+    """ Persistent index of the chunks on the main glibc heap, kept in arrays sorted by address. Each update
+    checksums the heap a page at a time and only re-walks the chunks around pages that changed, stopping as
+    soon as the walk lands back on a chunk boundary the index already has. A step that mallocs one chunk
+    costs a handful of headers, not a walk of the whole heap.
+
+    Every change to the arrays is also kept as a splice, numbered by update, until the main thread says (by
+    setting acked) that its HeapChunks has applied it. """
+    def __init__(self, word_size=8):
+        self.word_size = word_size
+        self._header = struct.Struct('<4Q' if word_size == 8 else '<4I')
+        self._word = struct.Struct('<Q' if word_size == 8 else '<I')
+        self.base = None
+        self.end = None
+        self.starts = array(word)
+        self.sizes = array(word)
+        self.fds = array(word)
+        self.bks = array(word)
+        self.tcache = {} # chunk address -> (tcache bin, demangled next pointer)
+        self.bins = {} # chunk address -> (main_arena bin name, next pointer)
+        self.arena_top = None # Address of main_arena's pointer to the top chunk, once we've found it
+        self.safe_linking = None # glibc 2.32 started mangling tcache and fastbin pointers. None until we can tell.
+        self.reparsed = 0
+        self.seq = 0
+        self.acked = 0 # The last update the main thread has applied. Written by the main thread.
+        self._splices = []
+        self._crcs = {}
+
+    def delta(self):
+        """ Everything the main thread hasn't applied yet """
+        acked = self.acked
+        self._splices = [splice for splice in self._splices if splice[0] > acked]
+        return HeapDelta(self)
+
+    def _dirty_runs(self, memory):
+        """ Checksums every page and returns (start, end) address ranges of pages that changed """
+        runs = []
+        crcs = {}
+        view = memoryview(memory)
+        for offset in range(0, len(memory), page_size):
+            page = self.base + offset
+            crcs[page] = zlib.crc32(view[offset:offset + page_size])
+            if self._crcs.get(page) == crcs[page]:
+                continue
+            if runs and runs[-1][1] == page:
+                runs[-1] = (runs[-1][0], min(page + page_size, self.end))
+            else:
+                runs.append((page, min(page + page_size, self.end)))
+        self._crcs = crcs
+        return runs
+
+    def update(self, base, memory):
+        """ Brings the index up to date with the heap mapping at base. Returns the number of chunks re-parsed. """
+        self.seq += 1
+        if base != self.base:
+            if len(self.starts) > 0:
+                self._splices.append((self.seq, 0, len(self.starts), array(word), array(word), array(word), array(word)))
+            self.starts, self.sizes, self.fds, self.bks = array(word), array(word), array(word), array(word)
+            self._crcs = {}
+            self.safe_linking = None
+            self.arena_top = None
+        self.base, self.end = base, base + len(memory)
+        self.reparsed = 0
+        walked_to = base
+        for start, end in self._dirty_runs(memory):
+            if end <= walked_to:
+                continue # The last walk already went past this run
+            walked_to = self._walk(memory, max(0, bisect_right(self.starts, start) - 1), end)
+        self._parse_tcache(memory)
+        return self.reparsed
+
+    def _walk(self, memory, row, run_end):
+        """ Re-parses chunks from the given row until we've gone past run_end and are back on a boundary we
+        already know about, then splices the new chunks over the old ones. Returns how far we got. """
+        address = self.starts[row] if row < len(self.starts) else self.base
+        ws = self.word_size
+        starts, sizes, fds, bks = array(word), array(word), array(word), array(word)
+        resume = len(self.starts)
+        while address + 2 * ws <= self.end:
+            offset = address - self.base
+            if offset + 4 * ws <= len(memory):
+                _prev, size, fd, bk = self._header.unpack_from(memory, offset)
+            else:
+                size, fd, bk = self._word.unpack_from(memory, offset + ws)[0], 0, 0
+            starts.append(address)
+            sizes.append(size)
+            fds.append(fd)
+            bks.append(bk)
+            length = size & ~7
+            if length < 2 * ws or length % (2 * ws) or address + length > self.end:
+                break # Corrupt (or not a glibc heap at all), so there's no telling where the next chunk is
+            address += length
+            if address >= run_end:
+                known = bisect_left(self.starts, address, row)
+                if known < len(self.starts) and self.starts[known] == address:
+                    resume = known
+                    break
+        self.starts[row:resume] = starts
+        self.sizes[row:resume] = sizes
+        self.fds[row:resume] = fds
+        self.bks[row:resume] = bks
+        self._splices.append((self.seq, row, resume - row, starts, sizes, fds, bks))
+        self.reparsed += len(starts)
+        return address
+
+    def _in_heap(self, address):
+        return self.base <= address < self.end
+
+    def _demangle(self, position, value):
+        """ Undoes safe-linking (value ^ (position >> 12)) if this glibc uses it, working that out from the
+        first pointer that makes it obvious """
+        key = position >> 12
+        if self.safe_linking is None:
+            if value == 0:
+                return 0
+            if value == key:
+                self.safe_linking = True
+            elif self._in_heap(value):
+                self.safe_linking = False
+            elif self._in_heap(value ^ key):
+                self.safe_linking = True
+            else:
+                return 0
+        return value ^ key if self.safe_linking else value
+
+    def _parse_tcache(self, memory):
+        """ Follows each tcache bin from the tcache_perthread_struct, if the first chunk looks like one """
+        self.tcache = {}
+        if len(self.starts) == 0 or self.starts[0] != self.base:
+            return
+        ws = self.word_size
+        count_width = tcache_struct_sizes[ws].get(self.sizes[0] & ~7)
+        if count_width is None:
+            return
+        counts_at = 2 * ws
+        entries_at = counts_at + tcache_bins * count_width
+        counts = struct.unpack_from('<{}{}'.format(tcache_bins, 'H' if count_width == 2 else 'B'), memory, counts_at)
+        entries = struct.unpack_from('<{}{}'.format(tcache_bins, 'Q' if ws == 8 else 'I'), memory, entries_at)
+        for tcache_bin, (count, entry) in enumerate(zip(counts, entries)):
+            position, seen = entry, 0
+            # Entries point at the chunk's user data, where the next pointer lives
+            while position and self._in_heap(position) and seen < min(max(count, 1), max_bin_walk):
+                if position - 2 * ws in self.tcache:
+                    break # Loop
+                if position + ws > self.end:
+                    break
+                following = self._demangle(position, self._word.unpack_from(memory, position - self.base)[0])
+                self.tcache[position - 2 * ws] = (tcache_bin, following)
+                seen += 1
+                position = following
+
+    def _read_word(self, memory, address):
+        return self._word.unpack_from(memory, address - self.base)[0]
+
+    def _valid_arena(self, bins_data, top_at):
+        """ Checks that every regular bin either points back at itself (empty) or into the heap """
+        ws = self.word_size
+        for index in range(regular_bins):
+            fd, bk = struct.unpack_from('<2Q' if ws == 8 else '<2I', bins_data, 2 * ws * index)
+            header = top_at + 2 * ws * index
+            if not ((fd == header and bk == header) or (self._in_heap(fd) and self._in_heap(bk))):
+                return False
+        return True
+
+    def _find_arena(self, read, regions, top):
+        """ Looks through libc's writable data for main_arena's pointer to the top chunk. We don't have
+        libc's symbols, but nothing else there should point at the top chunk and have 127 valid bins after it. """
+        ws = self.word_size
+        needle = self._word.pack(top)
+        for region in regions:
+            if 'w' not in region.perms or not os.path.basename(region.path).startswith('libc'):
+                continue
+            data = read(region.start, min(region.end - region.start, max_arena_search))
+            if data is None:
+                continue
+            data = bytes(data)
+            position = data.find(needle)
+            while position != -1:
+                bins_at = position + 2 * ws
+                if position % ws == 0 and bins_at + 2 * ws * regular_bins <= len(data) and \
+                        self._valid_arena(data[bins_at:], region.start + position):
+                    return region.start + position
+                position = data.find(needle, position + 1)
+        return None
+
+    def update_arena(self, read, regions, memory):
+        """ Walks main_arena's fastbins and its unsorted, small and large bins. read(address, length) reads
+        the inferior's memory, and regions is its memory map, which is only needed until we've found the arena.
+        Leaves bins empty (so only tcache shows up) if the arena can't be found. """
+        self.bins = {}
+        if len(self.starts) == 0:
+            return
+        ws = self.word_size
+        top = self.starts[-1]
+        if self.arena_top is None:
+            self.arena_top = self._find_arena(read, regions, top)
+            if self.arena_top is None:
+                return
+        data = read(self.arena_top - fastbins * ws, (fastbins + 2 + 2 * regular_bins) * ws)
+        words = struct.unpack_from('<{}{}'.format(fastbins + 2 + 2 * regular_bins, 'Q' if ws == 8 else 'I'), data) \
+            if data is not None else None
+        if words is None or words[fastbins] != top:
+            # Not the arena after all (or the top chunk moved somewhere we don't know about), so look again next time
+            self.arena_top = None
+            return
+        for index in range(fastbins):
+            chunk, seen = words[index], 0
+            while chunk and self._in_heap(chunk) and chunk + 3 * ws <= self.end and seen < max_bin_walk:
+                if chunk in self.bins:
+                    break # Loop
+                following = self._demangle(chunk + 2 * ws, self._read_word(memory, chunk + 2 * ws))
+                self.bins[chunk] = ('fastbin[{}]'.format(index), following)
+                chunk, seen = following, seen + 1
+        for index in range(regular_bins):
+            header = self.arena_top + 2 * ws * index
+            chunk, seen = words[fastbins + 2 + 2 * index], 0
+            name = 'unsorted' if index == 0 else '{}bin[{}]'.format('small' if index < 63 else 'large', index + 1)
+            while chunk != header and self._in_heap(chunk) and chunk + 3 * ws <= self.end and seen < max_bin_walk:
+                if chunk in self.bins:
+                    break
+                following = self._read_word(memory, chunk + 2 * ws)
+                self.bins[chunk] = (name, following)
+                chunk, seen = following, seen + 1
+
+class HeapModel(QAbstractTableModel):
+    """ Table model over a HeapChunks snapshot. Rows are only formatted when they're on screen. """
+    columns = ['Chunk', 'Size', 'Flags', 'State', 'fd / next', 'bk']
+
+    def __init__(self):
+        super(HeapModel, self).__init__()
+        self.chunks = None
+        self._font = QFontDatabase.systemFont(QFontDatabase.FixedFont)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() or self.chunks is None else len(self.chunks)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section]
+        return None
+
+    def set_chunks(self, chunks):
+        self.beginResetModel()
+        self.chunks = chunks
+        self.endResetModel()
+
+    def data(self, index, role=Qt.DisplayRole):
+        chunks, row, column = self.chunks, index.row(), index.column()
+        if chunks is None or row >= len(chunks):
+            return None
+        if role == Qt.FontRole:
+            return self._font
+        if role == Qt.BackgroundRole:
+            return state_colors[chunks.state(row)].lighter(130)
+        if role != Qt.DisplayRole:
+            return None
+        state = chunks.state(row)
+        if column == 0:
+            return hex(chunks.starts[row]).rstrip('L')
+        if column == 1:
+            return hex(chunks.length(row)).rstrip('L')
+        if column == 2:
+            size = chunks.sizes[row]
+            return ''.join(flag if size & bit else '-' for flag, bit in
+                           [('A', NON_MAIN_ARENA), ('M', IS_MMAPPED), ('P', PREV_INUSE)])
+        if column == 3 and state == 'tcache':
+            return 'tcache[{}]'.format(chunks.tcache[chunks.starts[row]][0])
+        if column == 3:
+            return chunks.bins[chunks.starts[row]][0] if chunks.starts[row] in chunks.bins else state
+        if column == 4 and state == 'tcache':
+            return hex(chunks.tcache[chunks.starts[row]][1]).rstrip('L')
+        if column == 4 and state == 'fastbin':
+            return hex(chunks.bins[chunks.starts[row]][1]).rstrip('L')
+        if column == 4 and state == 'free':
+            return hex(chunks.fds[row]).rstrip('L')
+        if column == 5 and state == 'free':
+            return hex(chunks.bks[row]).rstrip('L')
+        return ''
+
+class HeapWindow(QtWidgets.QWidget):
+    """ Lists the chunks on the heap, coloured by state. Clicking a chunk emits CHUNK_SELECTED with its address,
+    and double clicking a free list link jumps to the chunk it points at. """
+    CHUNK_SELECTED = pyqtSignal(object) # Chunk address, which doesn't fit in a C++ int
+    CLOSED = pyqtSignal()
+
+    def __init__(self):
+        super(HeapWindow, self).__init__()
+        self.setWindowTitle("Heap")
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+
+        self._summary = QtWidgets.QLabel("No heap yet")
+        self._layout.addWidget(self._summary)
+
+        self._model = HeapModel()
+        self._table = QtWidgets.QTableView()
+        self._table.setModel(self._model)
+        self._table.verticalHeader().setVisible(False)
+        self._table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self._table.horizontalHeader().setStretchLastSection(True)
+        self._table.clicked.connect(lambda index: self.CHUNK_SELECTED.emit(self._model.chunks.starts[index.row()]))
+        self._table.doubleClicked.connect(self.follow_link)
+        self._layout.addWidget(self._table)
+        self.setObjectName('Heap_Window')
+
+    def closeEvent(self, event):
+        # Nobody's looking, so the heap can stop being indexed every step
+        self._model.set_chunks(None)
+        self._summary.setText("No heap yet")
+        self.CLOSED.emit()
+        super(HeapWindow, self).closeEvent(event)
+
+    @property
+    def chunks(self):
+        return self._model.chunks
+
+    def update_heap(self, delta):
+        """ Applies a HeapDelta from the worker thread's HeapIndex, and returns the update number it brought us up to """
+        chunks = self.chunks if self.chunks is not None else HeapChunks(delta.word_size)
+        chunks.apply(delta)
+        self._model.set_chunks(chunks)
+        bins = "{} in other bins".format(len(chunks.bins)) if chunks.arena is not None else \
+            "main_arena not found, so only tcache is shown"
+        self._summary.setText("{} chunks, {} in tcache, {}, re-parsed {} this step".format(
+            len(chunks), len(chunks.tcache), bins, chunks.reparsed))
+        return chunks.seq
+
+    def select_chunk(self, address):
+        row = self.chunks.find(address) if self.chunks is not None else None
+        if row is not None:
+            self._table.selectRow(row)
+            self._table.scrollTo(self._model.index(row, 0))
+            self.CHUNK_SELECTED.emit(self.chunks.starts[row])
+
+    def follow_link(self, index):
+        chunks = self.chunks
+        if index.column() == 4 and chunks.state(index.row()) == 'tcache':
+            target = chunks.tcache[chunks.starts[index.row()]][1]
+        elif index.column() == 4 and chunks.state(index.row()) == 'fastbin':
+            target = chunks.bins[chunks.starts[index.row()]][1]
+        elif index.column() == 4:
+            target = chunks.fds[index.row()]
+        elif index.column() == 5:
+            target = chunks.bks[index.row()]
+        else:
+            return
+        # tcache links point at user data, the rest point at chunk headers. find() copes with both.
+        self.select_chunk(target)
@@ -0,0 +1,345 @@
+from __future__ import print_function
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtGui import QColor, QFontDatabase, QFontMetrics, QPainter
+from collections import OrderedDict
+import threading
+
+page_size = 0x1000
+bytes_per_line = 16
+prefetch_pages = 4 # Pages fetched ahead of and behind what's on screen, so scrolling doesn't show gaps
+max_run = 16 # Most pages fetched with a single read
+max_scroll = 2**31 - 1 # Qt scrollbars take an int, so bigger mappings move several lines per scrollbar step
+changed_color = QColor(255, 153, 51) # Same orange as the other viewers
+
+class PageCache(object):
+    """ LRU cache of pages read from the inferior. A step doesn't throw pages away, it only marks them stale:
+    a stale page still gets drawn until its replacement arrives, and the replacement is compared against it
+    so the bytes that changed can be highlighted. Pages that couldn't be read are cached as None. """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.generation = 0
+        self._pages = OrderedDict() # page address -> (generation, data, changed offsets)
+        self._lock = threading.Lock()
+
+    def get(self, page):
+        """ Returns (data, changed offsets, whether it's up to date), or None if the page has never been read """
+        with self._lock:
+            entry = self._pages.get(page)
+            if entry is None:
+                return None
+            self._pages[page] = self._pages.pop(page)
+        return entry[1], entry[2], entry[0] == self.generation
+
+    def put(self, page, generation, data):
+        with self._lock:
+            old = self._pages.pop(page, None)
+            changed = frozenset()
+            if old is not None and old[0] > generation:
+                # A newer copy beat this one here
+                self._pages[page] = old
+                return
+            if old is not None and old[1] is not None and data is not None and old[1] != data:
+                changed = frozenset(i for i in range(min(len(data), len(old[1]))) if data[i:i + 1] != old[1][i:i + 1])
+            elif old is not None and old[0] == generation:
+                changed = old[2]
+            self._pages[page] = (generation, data, changed)
+            while len(self._pages) > self.capacity:
+                self._pages.popitem(last=False)
+
+    def invalidate(self):
+        """ Marks every page as out of date. Called once per step. """
+        self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+class PageFetcher(QThread):
+    """ Reads pages on a worker thread so a slow read never holds up scrolling. Only the most recent
+    request counts: if the user scrolls past some pages before they're fetched, they never are. """
+    PAGE_READY = pyqtSignal(object)
+
+    def __init__(self, read):
+        """ read(address, length) should return the bytes there, or None if they can't be read """
+        QThread.__init__(self)
+        self._read = read
+        self._wanted = []
+        self._generation = 0
+        self._running = True
+        self._condition = threading.Condition()
+
+    def request(self, pages, generation):
+        with self._condition:
+            self._wanted = sorted(pages)
+            self._generation = generation
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._wanted:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                # Take a run of adjacent pages so they come back from a single read
+                first = self._wanted[0]
+                count = 1
+                while count < min(max_run, len(self._wanted)) and self._wanted[count] == first + count * page_size:
+                    count += 1
+                del self._wanted[:count]
+                generation = self._generation
+            data = self._read(first, count * page_size)
+            for index in range(count):
+                page = first + index * page_size
+                if data is None and count > 1:
+                    # Part of the run wasn't readable, so fall back to one page at a time to find out which
+                    chunk = self._read(page, page_size)
+                else:
+                    chunk = data[index * page_size:(index + 1) * page_size] if data is not None else None
+                self.PAGE_READY.emit((page, generation, chunk))
+
+class MappingView(QtWidgets.QAbstractScrollArea):
+    """ Hex view of an arbitrarily large range of memory. Only the lines on screen are drawn, and only the
+    pages they're on (plus a small margin) are ever fetched, so a 1 GB heap costs the same as a 4 KB stack. """
+    def __init__(self, read, parent=None):
+        super(MappingView, self).__init__(parent)
+        self.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self.start = 0
+        self.end = 0
+        self.readable = True
+        self.selected = None
+        # Optional annotate(first, last) that returns (address, length, colour) backgrounds for bytes on screen
+        self.annotate = None
+        self.cache = PageCache()
+        self._read = read
+        self._fetcher = None
+        self._top = 0 # First line on screen. The scrollbar only holds it divided by _scale.
+        self._scale = 1
+        self.open_fetcher()
+        self.verticalScrollBar().valueChanged.connect(self._scrolled)
+
+    def open_fetcher(self):
+        """ Starts the page fetcher thread, unless it's already running """
+        if self._fetcher is None:
+            self._fetcher = PageFetcher(self._read)
+            self._fetcher.PAGE_READY.connect(self._page_ready)
+            self._fetcher.start()
+
+    def close_fetcher(self):
+        """ Stops the page fetcher thread. open_fetcher starts a new one if the view is shown again. """
+        if self._fetcher is not None:
+            self._fetcher.stop()
+            self._fetcher.wait()
+            self._fetcher = None
+
+    def _line_height(self):
+        return QFontMetrics(self.font()).height()
+
+    def _visible_lines(self):
+        return max(1, self.viewport().height() // self._line_height())
+
+    def _last_top(self):
+        lines = (self.end - self.start + bytes_per_line - 1) // bytes_per_line
+        return max(0, lines - self._visible_lines())
+
+    def _scrolled(self, value):
+        # The bottom of a scaled scrollbar has to mean the end of the mapping, not the nearest multiple of _scale
+        last = self._last_top()
+        self._top = last if value >= self.verticalScrollBar().maximum() else min(value * self._scale, last)
+        self.viewport().update()
+
+    def _set_top(self, line):
+        """ Scrolls so line is at the top, without losing the lines a scaled scrollbar can't express """
+        self._top = max(0, min(line, self._last_top()))
+        bar = self.verticalScrollBar()
+        bar.blockSignals(True)
+        bar.setValue(self._top // self._scale)
+        bar.blockSignals(False)
+        self.viewport().update()
+
+    def _update_scrollbar(self):
+        last = self._last_top()
+        self._scale = last // max_scroll + 1
+        bar = self.verticalScrollBar()
+        bar.blockSignals(True)
+        bar.setRange(0, last // self._scale)
+        bar.setPageStep(max(1, self._visible_lines() // self._scale))
+        bar.blockSignals(False)
+        self._set_top(self._top)
+
+    def set_range(self, start, end, readable=True):
+        """ Shows the memory from start up to (but not including) end """
+        if (start, end) != (self.start, self.end):
+            self.start, self.end, self.readable = start, end, readable
+            self._top = 0
+        self._update_scrollbar()
+        self.viewport().update()
+
+    def goto(self, address):
+        """ Scrolls so the line with address in it is at the top, and marks the byte """
+        self.selected = address
+        self._set_top((address - self.start) // bytes_per_line)
+
+    def refresh(self):
+        """ Marks the cached pages stale, so the ones on screen get read again (and diffed) """
+        self.cache.invalidate()
+        self.viewport().update()
+
+    def resizeEvent(self, event):
+        super(MappingView, self).resizeEvent(event)
+        self._update_scrollbar()
+
+    def _page_ready(self, update):
+        page, generation, data = update
+        self.cache.put(page, generation, data)
+        first = self.start + self._top * bytes_per_line
+        last = first + self._visible_lines() * bytes_per_line
+        if page < last and page + page_size > first:
+            self.viewport().update()
+
+    def paintEvent(self, _event):
+        painter = QPainter(self.viewport())
+        metrics = QFontMetrics(self.font())
+        char = metrics.width('0')
+        height = metrics.height()
+        palette = self.viewport().palette()
+        painter.fillRect(self.viewport().rect(), palette.base())
+        if self.end <= self.start:
+            return
+        first = self.start + self._top * bytes_per_line
+        lines = self._visible_lines() + 1
+        wanted = set()
+        hex_x = char * 18
+        ascii_x = hex_x + char * (3 * bytes_per_line + 1)
+        marks = {}
+        if self.annotate is not None:
+            for address, length, color in self.annotate(first, first + lines * bytes_per_line):
+                for byte in range(address, address + length):
+                    marks[byte] = color
+        for line in range(lines):
+            address = first + line * bytes_per_line
+            if address >= self.end:
+                break
+            y = line * height
+            painter.setPen(palette.text().color())
+            painter.drawText(0, y + metrics.ascent(), "{:016x}".format(address))
+            page = address - address % page_size
+            entry = self.cache.get(page) if self.readable else (None, frozenset(), True)
+            if entry is None or not entry[2]:
+                wanted.add(page)
+            if entry is None:
+                painter.drawText(hex_x, y + metrics.ascent(), " ".join(["  "] * bytes_per_line))
+                continue
+            data, changed, _fresh = entry
+            offset = address - page
+            for column in range(min(bytes_per_line, self.end - address)):
+                x = hex_x + column * 3 * char
+                if self.selected == address + column:
+                    painter.fillRect(x, y, 2 * char, height, palette.highlight())
+                elif address + column in marks:
+                    painter.fillRect(x, y, 3 * char, height, marks[address + column])
+                if data is None or offset + column >= len(data):
+                    painter.drawText(x, y + metrics.ascent(), "??")
+                    continue
+                value = bytearray(data[offset + column:offset + column + 1])[0]
+                painter.setPen(changed_color if offset + column in changed else palette.text().color())
+                painter.drawText(x, y + metrics.ascent(), "{:02x}".format(value))
+                painter.drawText(ascii_x + column * char, y + metrics.ascent(),
+                                 chr(value) if 32 <= value < 127 else '.')
+            painter.setPen(palette.text().color())
+        painter.end()
+        if wanted and self.readable:
+            # Prefetch a few pages either side of the screen too
+            low, high = min(wanted), max(wanted)
+            for page in range(low - prefetch_pages * page_size, high + (prefetch_pages + 1) * page_size, page_size):
+                if self.start - page_size < page < self.end:
+                    entry = self.cache.get(page)
+                    if entry is None or not entry[2]:
+                        wanted.add(page)
+            if self._fetcher is not None:
+                self._fetcher.request(wanted, self.cache.generation)
+
+class MappingWindow(QtWidgets.QWidget):
+    """ Lets the user browse any mapping in the inferior (heap, .data, shared libraries, anonymous mmaps),
+    not just the stack and .bss """
+    def __init__(self, read):
+        """ read(address, length) should return the bytes at address, or None if they can't be read """
+        super(MappingWindow, self).__init__()
+        self.setWindowTitle("Memory Map")
+        self.regions = []
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+
+        controls = QtWidgets.QHBoxLayout()
+        self._picker = QtWidgets.QComboBox()
+        self._picker.currentIndexChanged.connect(self.change_region)
+        controls.addWidget(self._picker, 1)
+        self._address = QtWidgets.QLineEdit()
+        self._address.setPlaceholderText("Go to address")
+        self._address.returnPressed.connect(lambda: self.goto(self._address.text()))
+        controls.addWidget(self._address)
+        self._layout.addLayout(controls)
+
+        self.view = MappingView(read)
+        self._layout.addWidget(self.view)
+        self.setMinimumWidth(QFontMetrics(self.view.font()).width('0') * 88)
+        self.setObjectName('Mapping_Window')
+
+    def showEvent(self, event):
+        # The fetcher is stopped whenever the window is closed, so this also brings it back on a reopen
+        self.view.open_fetcher()
+        super(MappingWindow, self).showEvent(event)
+
+    def closeEvent(self, event):
+        self.view.close_fetcher()
+        super(MappingWindow, self).closeEvent(event)
+
+    def set_regions(self, regions):
+        """ Updates the list of mappings, keeping the current one selected if it's still there """
+        if regions == self.regions:
+            return
+        current = self.regions[self._picker.currentIndex()] if 0 <= self._picker.currentIndex() < len(self.regions) else None
+        self.regions = list(regions)
+        self._picker.blockSignals(True)
+        self._picker.clear()
+        for region in self.regions:
+            self._picker.addItem("{:x}-{:x} {} {}".format(region.start, region.end, region.perms, region.path))
+        index = 0
+        for i, region in enumerate(self.regions):
+            if current is not None and region.start == current.start:
+                index = i
+        self._picker.setCurrentIndex(index)
+        self._picker.blockSignals(False)
+        self.change_region(index)
+
+    def change_region(self, index):
+        if 0 <= index < len(self.regions):
+            region = self.regions[index]
+            self.view.set_range(region.start, region.end, 'r' in region.perms)
+
+    def goto(self, address):
+        """ Jumps to an address (an int, or a string like "0x601040"), switching mappings if need be """
+        try:
+            address = int(address, 0) if hasattr(address, 'strip') else address
+        except ValueError:
+            print(str(address) + " isn't an address")
+            return
+        for index, region in enumerate(self.regions):
+            if region.start <= address < region.end:
+                if index != self._picker.currentIndex():
+                    self._picker.setCurrentIndex(index)
+                self.view.goto(address)
+                return
+        print(hex(address) + " isn't mapped")
+
+    def step(self, regions=None):
+        """ Called after every step. Re-reads whatever is on screen. """
+        if regions is not None:
+            self.set_regions(regions)
+        self.view.refresh()
@@ -0,0 +1,222 @@
+from __future__ import print_function
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtGui import QFontDatabase
+from binascii import unhexlify
+import re, struct, threading, time
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+chunk_size = 1 << 20
+max_results = 10000
+result_interval = 0.1 # Seconds between batches of results sent to the window
+
+integer_formats = {1: '<B', 2: '<H', 4: '<I', 8: '<Q'}
+
+class Pattern(object):
+    """ A compiled search pattern. length is how many bytes a match covers, which is also how much chunks
+    have to overlap so a match straddling two chunks isn't missed. """
+    def __init__(self, needle, mask=None):
+        self.length = len(needle)
+        if mask is None:
+            body = re.escape(needle)
+        else:
+            # Wildcard bytes match anything, the rest have to match exactly
+            body = b''.join(b'.' if not masked else re.escape(needle[i:i + 1]) for i, masked in enumerate(mask))
+        # Wrapped in a lookahead so matches don't consume anything, and overlapping ones (like "aa" at
+        # every offset of "aaaa") are all found, the same as gdb's find
+        self._regex = re.compile(b'(?=' + body + b')', re.DOTALL)
+
+    def finditer(self, data, limit):
+        """ Yields the offset of every match that starts before limit, including overlapping ones """
+        for match in self._regex.finditer(data):
+            if match.start() >= limit:
+                break
+            yield match.start()
+
+def parse_pattern(text, kind, width=8):
+    """ Builds a Pattern from what the user typed.
+        'string': the text itself, UTF-8 encoded
+        'hex':    bytes in hex, spaces optional, with ?? for bytes that can be anything (eg "de ad ?? ef")
+        'integer': a number (decimal or 0x...) as a little-endian value width bytes wide
+    Raises ValueError if the text doesn't make sense for the kind. """
+    if kind == 'string':
+        needle = text.encode('utf-8') if not isinstance(text, bytes) else text
+        if not needle:
+            raise ValueError("Nothing to search for")
+        return Pattern(needle)
+    if kind == 'hex':
+        digits = ''.join(str(text).split())
+        if not digits or len(digits) % 2:
+            raise ValueError("Hex patterns need two digits per byte")
+        pairs = [digits[i:i + 2] for i in range(0, len(digits), 2)]
+        mask = [pair != '??' for pair in pairs]
+        needle = unhexlify(''.join(pair if pair != '??' else '00' for pair in pairs))
+        return Pattern(needle, mask if not all(mask) else None)
+    if kind == 'integer':
+        value = int(str(text).strip(), 0)
+        return Pattern(struct.pack(integer_formats[width], value & ((1 << (8 * width)) - 1)))
+    raise ValueError("Unknown pattern kind: " + str(kind))
+
+class SearchThread(QThread):
+    """ Searches every readable mapping for a pattern. The mappings are cut into chunk_size pieces that a pool
+    of worker threads read and scan. Each piece is read with pattern.length - 1 extra bytes so matches across
+    the boundary are found, but only matches that start inside the piece are reported, so none turn up twice.
+    Reads release the GIL, so one worker's read overlaps another's matching. Results come out in RESULTS
+    batches as they're found, in no particular order. """
+    RESULTS = pyqtSignal(list)
+    PROGRESS = pyqtSignal(int, int) # Megabytes done, megabytes total
+    FINISHED = pyqtSignal(int, float) # Number of results, seconds taken
+
+    def __init__(self, regions, read, pattern, workers=4):
+        """ regions is a list of procfs.Regions, and read(address, length, slot) returns bytes or None """
+        QThread.__init__(self)
+        self.regions = [region for region in regions if 'r' in region.perms]
+        self.read = read
+        self.pattern = pattern
+        self.workers = workers
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._found = []
+        self._count = 0
+        self._done = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _work(self, jobs, slot):
+        while not self.cancelled:
+            try:
+                region, start = jobs.get_nowait()
+            except Empty:
+                return
+            length = min(chunk_size, region.end - start)
+            data = self.read(start, min(length + self.pattern.length - 1, region.end - start), slot)
+            hits = []
+            if data is not None:
+                for offset in self.pattern.finditer(data, length):
+                    hits.append((start + offset, region.path))
+            with self._lock:
+                room = max_results - self._count
+                self._found.extend(hits[:room])
+                self._count += min(len(hits), room)
+                self._done += length
+                if self._count >= max_results:
+                    self.cancelled = True
+
+    def run(self):
+        began = time.time()
+        jobs = Queue()
+        total = 0
+        for region in self.regions:
+            for start in range(region.start, region.end, chunk_size):
+                jobs.put((region, start))
+            total += region.end - region.start
+        threads = [threading.Thread(target=self._work, args=(jobs, ('search', i))) for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(result_interval)
+            self._emit(total)
+        self._emit(total)
+        self.FINISHED.emit(self._count, time.time() - began)
+
+    def _emit(self, total):
+        with self._lock:
+            found, self._found = self._found, []
+            done = self._done
+        if found:
+            self.RESULTS.emit(found)
+        self.PROGRESS.emit(done >> 20, total >> 20)
+
+class SearchWindow(QtWidgets.QWidget):
+    """ Search box for inferior memory. Double clicking a result emits RESULT_SELECTED with its address. """
+    RESULT_SELECTED = pyqtSignal(object) # Address of the hit, which doesn't fit in a C++ int
+    SEARCH_REQUESTED = pyqtSignal(object) # A Pattern, for whoever knows the process's mappings
+
+    kinds = [('String', 'string'), ('Hex bytes (?? = any)', 'hex'), ('Integer', 'integer')]
+
+    def __init__(self):
+        super(SearchWindow, self).__init__()
+        self.setWindowTitle("Memory Search")
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+        self._thread = None
+
+        controls = QtWidgets.QHBoxLayout()
+        self._kind = QtWidgets.QComboBox()
+        for label, _kind in self.kinds:
+            self._kind.addItem(label)
+        self._kind.currentIndexChanged.connect(lambda index: self._width.setVisible(self.kinds[index][1] == 'integer'))
+        controls.addWidget(self._kind)
+        self._width = QtWidgets.QComboBox()
+        for width in sorted(integer_formats):
+            self._width.addItem("{} bytes".format(width), width)
+        self._width.setCurrentIndex(len(integer_formats) - 1)
+        self._width.setVisible(False)
+        controls.addWidget(self._width)
+        self._text = QtWidgets.QLineEdit()
+        self._text.returnPressed.connect(self.start_search)
+        controls.addWidget(self._text, 1)
+        self._button = QtWidgets.QPushButton("Search")
+        self._button.clicked.connect(self.start_search)
+        controls.addWidget(self._button)
+        self._layout.addLayout(controls)
+
+        self._progress = QtWidgets.QProgressBar()
+        self._progress.setVisible(False)
+        self._layout.addWidget(self._progress)
+        self._status = QtWidgets.QLabel()
+        self._layout.addWidget(self._status)
+
+        self._results = QtWidgets.QListWidget()
+        self._results.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self._results.setUniformItemSizes(True)
+        self._results.itemDoubleClicked.connect(lambda item: self.RESULT_SELECTED.emit(item.data(Qt.UserRole)))
+        self._layout.addWidget(self._results)
+        self.setObjectName('Search_Window')
+
+    def start_search(self):
+        if self._thread is not None and self._thread.isRunning():
+            self._thread.cancel()
+            return
+        kind = self.kinds[self._kind.currentIndex()][1]
+        try:
+            pattern = parse_pattern(self._text.text(), kind, self._width.currentData())
+        except (ValueError, TypeError) as e:
+            self._status.setText("Bad pattern: " + str(e))
+            return
+        self.SEARCH_REQUESTED.emit(pattern)
+
+    def run_search(self, regions, read, pattern):
+        """ Starts searching the given regions. Called back by whoever handles SEARCH_REQUESTED. """
+        self._results.clear()
+        self._status.setText("Searching...")
+        self._button.setText("Cancel")
+        self._progress.setVisible(True)
+        self._thread = SearchThread(regions, read, pattern)
+        self._thread.RESULTS.connect(self.add_results)
+        self._thread.PROGRESS.connect(self.show_progress)
+        self._thread.FINISHED.connect(self.search_finished)
+        self._thread.start()
+
+    def add_results(self, results):
+        self._results.setUpdatesEnabled(False)
+        for address, path in results:
+            item = QtWidgets.QListWidgetItem("{:016x}  {}".format(address, path))
+            item.setData(Qt.UserRole, address)
+            self._results.addItem(item)
+        self._results.setUpdatesEnabled(True)
+
+    def show_progress(self, done, total):
+        self._progress.setMaximum(max(total, 1))
+        self._progress.setValue(done)
+
+    def search_finished(self, count, seconds):
+        self._button.setText("Search")
+        self._progress.setVisible(False)
+        more = " (stopped at the limit)" if count >= max_results else ""
+        self._status.setText("{} results in {:.2f}s{}".format(count, seconds, more))
@@ -4,6 +4,66 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
 from hexview import HexDisplay
 from collections import OrderedDict
+from ..address_classifier import kind_colors
+import zlib
+
+page_size = 0x1000
+line_size = 64 # Granularity of the comparison inside a page that changed
+changed_color = QColor(255, 153, 51) # Same orange as changed registers
+
+def _diff_bytes(old, old_address, new, new_address):
+    """ Compares two buffers where they overlap and returns a list of (address, length)
+    ranges of bytes that differ. Goes a cache line at a time so only lines that differ
+    are compared byte by byte. """
+    start = max(old_address, new_address)
+    end = min(old_address + len(old), new_address + len(new))
+    ranges = []
+    for line in range(start, end, line_size):
+        line_end = min(line + line_size, end)
+        old_line = old[line - old_address:line_end - old_address]
+        new_line = new[line - new_address:line_end - new_address]
+        if old_line == new_line:
+            continue
+        for index in range(len(new_line)):
+            if old_line[index] != new_line[index]:
+                addr = line + index
+                if ranges and ranges[-1][0] + ranges[-1][1] == addr:
+                    ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+                else:
+                    ranges.append((addr, 1))
+    return ranges
+
+class ShadowSegment(object):
+    """ Keeps a copy of the memory last pushed to a segment, along with a checksum of each page
+    (pages are aligned to absolute addresses, so the checksums still line up when the segment
+    grows). Only pages whose checksums differ get compared byte by byte. """
+    def __init__(self):
+        self.address = None
+        self.memory = b''
+        self._pages = {}
+
+    def update(self, address, memory):
+        """ Swaps in a new copy of the segment. Returns a list of (offset, length) runs of pages that
+        differ from the old copy and a list of (address, length) ranges of bytes that changed. Memory
+        that wasn't in the old copy at all shows up in the first list, but not the second. """
+        pages = {}
+        dirty = []
+        changed = []
+        end = address + len(memory)
+        for page in range(address - (address % page_size), end, page_size):
+            low, high = max(address, page), min(end, page + page_size)
+            chunk = memory[low - address:high - address]
+            pages[page] = (low, high, zlib.crc32(chunk))
+            if self._pages.get(page) == pages[page]:
+                continue
+            if dirty and dirty[-1][0] + dirty[-1][1] == low - address:
+                dirty[-1] = (dirty[-1][0], dirty[-1][1] + high - low)
+            else:
+                dirty.append((low - address, high - low))
+            if self.address is not None:
+                changed.extend(_diff_bytes(self.memory, self.address, chunk, low))
+        self.address, self.memory, self._pages = address, memory, pages
+        return dirty, changed
 
 class MemoryWindow(QtWidgets.QWidget):
     """
@@ -24,6 +84,11 @@ class MemoryWindow(QtWidgets.QWidget):
         self.base_pointer = None
         self.retn_address = None
         self.instr_pointer = None
+        self.changed = {}
+        self.pointers = {}
+        self._highlights = {} # (segment, name) -> the ranges currently on the display
+        self._pending = None
+        self._display_dirty = False
 
         if segments is not None:
             if type(segments) is not OrderedDict:
@@ -50,6 +115,7 @@ class MemoryWindow(QtWidgets.QWidget):
             else:
                 disp = HexDisplay(starting_address=self.segment_starts[segment])
             self.viewstack.addWidget(disp)
+        self.shadows = {segment: ShadowSegment() for segment in self._segments}
 
         self._layout.addWidget(self.viewstack)
         self.setMaximumWidth(self.viewstack.widget(0).maximumWidth() + 20)
@@ -80,45 +146,117 @@ class MemoryWindow(QtWidgets.QWidget):
         return None
 
     def update_display(self, segment, address, new_memory):
-        """ Updates the displayed memory. The way this is currently implemented,
-        memory should always be pushed to 0x0 and the offset updated manually.
-        Any memory at addresses after the end of the new buffer will simply be lost."""
+        """ Updates the displayed memory and highlights any bytes that changed. The way hexview is
+        implemented, memory should always be pushed to 0x0 and the offset updated manually (any memory
+        at addresses after the end of the new buffer will simply be lost), so the whole buffer goes over
+        whenever anything in it changed. The shadow copy works out which bytes to highlight, and lets
+        us skip the push altogether when nothing did."""
         # print("Got", len(new_memory), "bytes to push to", segment, "at", hex(address))
-        self.get_widget(segment).update_addr(0x0, new_memory)
-        self.get_widget(segment).set_new_offset(address)
+        shadow = self.shadows[segment]
+        moved = shadow.address != address or len(shadow.memory) != len(new_memory)
+        dirty, changed = shadow.update(address, new_memory)
+        if moved or dirty:
+            self.get_widget(segment).update_addr(0x0, new_memory)
+        if moved:
+            self.get_widget(segment).set_new_offset(address)
+            self._reapply_highlights(segment)
+        self._display_dirty = self._display_dirty or moved or len(dirty) > 0
+        self.highlight_changed(segment, changed)
 
     def highlight_bytes_at_address(self, segment, address, length, color=Qt.red, name="*"):
         """ Helper function for highlighting """
         self.get_widget(segment).highlight_address(address, length, color, name)
 
+    def begin_highlights(self):
+        """ Starts a highlight transaction. Groups set with set_highlights are collected until
+        commit_highlights, which works out what actually changed and touches only that. """
+        if self._pending is None:
+            self._pending = OrderedDict()
+
+    def set_highlights(self, segment, name, ranges, color=Qt.red):
+        """ Replaces every highlight in the named group with a list of (address, length) or
+        (address, length, color) ranges. Groups that aren't mentioned are left alone, and an empty
+        list removes the group. Outside a transaction the change is applied straight away. """
+        group = OrderedDict()
+        for item in ranges:
+            fill = QColor(item[2] if len(item) > 2 else color)
+            group[(item[0], item[1], fill.rgba())] = fill
+        if self._pending is not None:
+            self._pending[(segment, name)] = group
+            return
+        self._pending = OrderedDict([((segment, name), group)])
+        self.commit_highlights(redraw=False)
+
+    def commit_highlights(self, redraw=True):
+        """ Applies the highlights collected since begin_highlights. A group that only gained ranges
+        gets just the new ones added. HexDisplay can only remove highlights a name at a time, so a group
+        that lost any is cleared and re-added. Repaints once at the end if anything changed (including
+        memory pushed with update_display since the last repaint), and returns whether it did. """
+        pending, self._pending = self._pending or {}, None
+        changed = False
+        for (segment, name), group in pending.items():
+            current = self._highlights.get((segment, name), {})
+            if set(group) == set(current):
+                continue
+            widget = self.get_widget(segment)
+            if any(key not in group for key in current):
+                widget.clear_named_highlight(name)
+                added = group
+            else:
+                added = OrderedDict((key, fill) for key, fill in group.items() if key not in current)
+            for (address, length, _), fill in added.items():
+                widget.highlight_address(address, length, fill, name)
+            self._highlights[(segment, name)] = group
+            changed = True
+        if redraw and (changed or self._display_dirty):
+            self.redraw()
+            return True
+        return False
+
+    def _reapply_highlights(self, segment):
+        """ Clears a segment's highlights after its buffer has been replaced, and queues them to be
+        added again unless the current transaction already has something newer for them """
+        auto = self._pending is None
+        self.begin_highlights()
+        for key in [key for key in self._highlights if key[0] == segment]:
+            self.get_widget(segment).clear_named_highlight(key[1])
+            group = self._highlights.pop(key)
+            if key not in self._pending:
+                self._pending[key] = group
+        if auto:
+            self.commit_highlights(redraw=False)
+
     def highlight_stack_pointer(self, sp, width=8):
-        """ Removes old stack pointer highlights and creates a new one """
-        if self.stack_pointer is not None:
-            self.get_widget('stack').clear_named_highlight('sp')
-        self.highlight_bytes_at_address('stack', sp, width, QColor(162, 217, 175), 'sp')
+        """ Moves the stack pointer highlight """
+        self.set_highlights('stack', 'sp', [(sp, width)], QColor(162, 217, 175))
         self.stack_pointer = sp
 
     def highlight_base_pointer(self, bp, width=8):
         """ Highlights the base pointer """
-        if self.base_pointer is not None:
-            self.get_widget('stack').clear_named_highlight('bp')
-        self.highlight_bytes_at_address('stack', bp, width, QColor(128, 198, 233), 'bp')
+        self.set_highlights('stack', 'bp', [(bp, width)], QColor(128, 198, 233))
         self.base_pointer = bp
 
     def highlight_retn_addr(self, ret, width=8):
         """ Highlights the return address, unsurprisingly """
-        if self.retn_address is not None:
-            self.get_widget('stack').clear_named_highlight('ret')
-        if (ret is not None):
-            self.highlight_bytes_at_address('stack', ret, width, QColor(222, 143, 151), 'ret')
+        self.set_highlights('stack', 'ret', [(ret, width)] if ret is not None else [], QColor(222, 143, 151))
         self.retn_address = ret
 
     def highlight_instr_pointer(self, ip):
-        """ Removes old instruction pointer highlights and creates a new one """
-        if self.instr_pointer is not None:
-            self.get_widget('stack').clear_highlight(self.instr_pointer)
-        self.highlight_bytes_at_address('stack', ip, 1, Qt.red)
+        """ Moves the instruction pointer highlight. Pass None when it's no longer on the stack. """
+        self.set_highlights('stack', 'ip', [(ip, 1)] if ip is not None else [], Qt.red)
         self.instr_pointer = ip
 
+    def highlight_changed(self, segment, ranges):
+        """ Replaces the highlights on bytes that changed since the last update """
+        self.set_highlights(segment, 'changed', ranges, changed_color)
+        self.changed[segment] = ranges
+
+    def highlight_pointers(self, segment, pointers, width=8):
+        """ Colours the words in a segment that point somewhere, by what they point to. Takes the
+        (address, kind) pairs from AddressClassifier.classify_words. """
+        self.set_highlights(segment, 'pointer', [(address, width, kind_colors[kind]) for address, kind in pointers])
+        self.pointers[segment] = pointers
+
     def redraw(self):
+        self._display_dirty = False
         self.get_widget(self._picker.currentIndex()).redraw()
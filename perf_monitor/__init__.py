@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+from PyQt5 import QtWidgets
+from PyQt5.QtCore import Qt, QTimer
+from PyQt5.QtGui import QFontDatabase
+from collections import deque, OrderedDict
+from functools import wraps
+import json, math, threading, time
+
+# time.time is the best clock Python 2 has
+clock = getattr(time, 'perf_counter', time.time)
+
+enabled = False # Timing is skipped entirely unless this is set, so the hooks cost one global lookup
+window = 1000 # How many of the most recent samples each stage keeps
+current_step = 0 # The step being worked on, written to the log with each sample
+_stages = OrderedDict()
+_lock = threading.Lock()
+_log = None
+
+class Histogram(object):
+    """ Keeps the last `size` durations (in seconds) recorded for a stage, plus how many there have been in total """
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.total = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.total += 1
+
+    def summary(self):
+        """ Count, mean, percentiles and max of the samples we still have, in milliseconds """
+        ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        pick = lambda fraction: 1000.0 * ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+        return OrderedDict([('count', len(ordered)), ('mean_ms', 1000.0 * sum(ordered) / len(ordered)),
+                            ('p50_ms', pick(0.50)), ('p95_ms', pick(0.95)), ('p99_ms', pick(0.99)),
+                            ('max_ms', 1000.0 * ordered[-1])])
+
+    def buckets(self, edges):
+        """ Counts the samples that fall under each edge (in seconds), with everything slower in a final bucket """
+        counts = [0] * (len(edges) + 1)
+        for sample in list(self.samples):
+            index = 0
+            while index < len(edges) and sample > edges[index]:
+                index += 1
+            counts[index] += 1
+        return counts
+
+def record(name, seconds):
+    """ Adds a duration to a stage's histogram, and to the log if there is one """
+    with _lock:
+        histogram = _stages.get(name)
+        if histogram is None:
+            histogram = _stages[name] = Histogram(window)
+        histogram.add(seconds)
+        if _log is not None:
+            _log.write(json.dumps({'time': time.time(), 'step': current_step, 'stage': name,
+                                   'ms': round(1000.0 * seconds, 4)}) + '\n')
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+
+    def __exit__(self, *_exc):
+        record(self.name, clock() - self.start)
+
+class _NullStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *_exc):
+        pass
+
+_null_stage = _NullStage()
+
+def stage(name):
+    """ Context manager that times the block inside it, if timing is enabled """
+    return _Stage(name) if enabled else _null_stage
+
+def timed(name=None):
+    """ Decorator that times every call to a function, if timing is enabled. Uses the function's name by default. """
+    def decorate(func):
+        stage_name = name or func.__name__
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage_name, clock() - start)
+        return wrapper
+    return decorate
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def set_log(path):
+    """ Starts appending every sample to a JSONL file, or stops if path is None """
+    global _log
+    with _lock:
+        if _log is not None:
+            _log.close()
+        _log = open(path, 'a') if path is not None else None
+
+def reset(size=None):
+    """ Throws away everything recorded so far. Optionally changes how many samples each stage keeps. """
+    global window
+    with _lock:
+        if size is not None:
+            window = size
+        _stages.clear()
+
+def summary():
+    """ Returns an OrderedDict of stage name -> summary statistics """
+    with _lock:
+        stages = list(_stages.items())
+    return OrderedDict((name, histogram.summary()) for name, histogram in stages if histogram.total > 0)
+
+class PerfWindow(QtWidgets.QWidget):
+    """ Shows rolling timing statistics for each stage of a step, refreshed twice a second while visible """
+    # Histogram bucket edges in seconds, and the characters used to draw them
+    edges = [0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3]
+    bars = u' ▁▂▃▄▅▆▇█'
+    columns = ['Stage', 'Count', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'Max (ms)', u'100µs → 300ms']
+
+    def __init__(self):
+        super(PerfWindow, self).__init__()
+        self.setWindowTitle("Performance")
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+
+        controls = QtWidgets.QHBoxLayout()
+        # Opening the panel turns timing on, since there'd be nothing to show otherwise
+        self._enabled = QtWidgets.QCheckBox("Record timings")
+        self._enabled.toggled.connect(enable)
+        self._enabled.setChecked(True)
+        controls.addWidget(self._enabled)
+        self._log_button = QtWidgets.QPushButton("Log to file...")
+        self._log_button.setCheckable(True)
+        self._log_button.toggled.connect(self.toggle_log)
+        controls.addWidget(self._log_button)
+        self._reset = QtWidgets.QPushButton("Reset")
+        self._reset.clicked.connect(lambda: (reset(), self.refresh()))
+        controls.addWidget(self._reset)
+        self._layout.addLayout(controls)
+
+        self._table = QtWidgets.QTableWidget(0, len(self.columns))
+        self._table.setHorizontalHeaderLabels(self.columns)
+        self._table.verticalHeader().setVisible(False)
+        self._table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self._table.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self._layout.addWidget(self._table)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(500)
+        self.setObjectName('Perf_Window')
+
+    def showEvent(self, event):
+        # Picks timing back up when a closed panel is reopened, unless it was switched off by hand
+        enable(self._enabled.isChecked())
+        super(PerfWindow, self).showEvent(event)
+
+    def hideEvent(self, event):
+        # Nobody can see the numbers, so steps shouldn't pay for collecting them
+        enable(False)
+        super(PerfWindow, self).hideEvent(event)
+
+    def toggle_log(self, on):
+        if on:
+            path, _filter = QtWidgets.QFileDialog.getSaveFileName(self, "Log timings to", "timings.jsonl")
+            if not path:
+                self._log_button.setChecked(False)
+                return
+            set_log(path)
+            self._log_button.setText("Logging to " + path.split('/')[-1])
+        else:
+            set_log(None)
+            self._log_button.setText("Log to file...")
+
+    def _cell(self, row, column, text):
+        item = self._table.item(row, column)
+        if item is None:
+            item = QtWidgets.QTableWidgetItem()
+            if column > 0:
+                item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+            self._table.setItem(row, column, item)
+        if item.text() != text:
+            item.setText(text)
+
+    def refresh(self):
+        if not self.isVisible():
+            return
+        with _lock:
+            stages = [(name, histogram) for name, histogram in _stages.items() if histogram.total > 0]
+        self._table.setRowCount(len(stages))
+        for row, (name, histogram) in enumerate(stages):
+            stats = histogram.summary()
+            if stats is None:
+                continue
+            counts = histogram.buckets(self.edges)
+            peak = float(max(counts))
+            self._cell(row, 0, name)
+            self._cell(row, 1, str(histogram.total))
+            for column, key in enumerate(['p50_ms', 'p95_ms', 'p99_ms', 'max_ms'], 2):
+                self._cell(row, column, "{:.2f}".format(stats[key]))
+            self._cell(row, 6, u''.join(self.bars[int(round(count / peak * (len(self.bars) - 1)))] for count in counts))
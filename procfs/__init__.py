@@ -0,0 +1,125 @@
+from bisect import bisect_right
+from collections import namedtuple
+import ctypes, ctypes.util, errno, os
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_pread = _libc.pread64
+_pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+_pread.restype = ctypes.c_ssize_t
+
+# One line of /proc/<pid>/maps. start is inclusive and end is exclusive, like the kernel prints them.
+Region = namedtuple('Region', ['start', 'end', 'perms', 'offset', 'path'])
+
+def parse_maps(text):
+    """ Turns the contents of a maps file into a list of Regions sorted by start address """
+    regions = []
+    for line in text.splitlines():
+        fields = line.split(None, 5)
+        if len(fields) < 5:
+            continue
+        start, end = fields[0].split('-')
+        path = fields[5].strip() if len(fields) > 5 else ''
+        regions.append(Region(int(start, 16), int(end, 16), fields[1], int(fields[2], 16), path))
+    regions.sort(key=lambda r: r.start)
+    return regions
+
+class ProcessMaps(object):
+    """ Cached view of the memory map of the debugged process. The maps file is only read
+    again after invalidate() has been called (ie, when something might have mapped or unmapped
+    memory), and only re-parsed if what we read back is actually different. """
+    def __init__(self, pid):
+        self.pid = pid
+        self._path = '/proc/{}/maps'.format(pid)
+        self._raw = None
+        self._regions = []
+        self._starts = []
+        self._dirty = True
+
+    def invalidate(self):
+        """ Marks the table as possibly out of date. Cheap, and safe to call from any thread. """
+        self._dirty = True
+
+    def refresh(self):
+        """ Re-reads the maps file if the table has been invalidated. Returns True if the mappings
+        changed. Raises IOError/OSError if the process has gone away. """
+        if not self._dirty:
+            return False
+        with open(self._path, 'rb') as mapfile:
+            raw = mapfile.read()
+        self._dirty = False
+        if raw == self._raw:
+            return False
+        self._raw = raw
+        self._regions = parse_maps(raw.decode('utf-8', 'replace'))
+        self._starts = [r.start for r in self._regions]
+        return True
+
+    @property
+    def regions(self):
+        return self._regions
+
+    def find(self, address):
+        """ Returns the region containing address, or None if it isn't mapped """
+        index = bisect_right(self._starts, address) - 1
+        if index >= 0 and address < self._regions[index].end:
+            return self._regions[index]
+        return None
+
+    def named(self, name):
+        """ Returns the first region with the given path. Brackets are optional for the
+        special regions, so 'stack' and '[stack]' both work. """
+        for region in self._regions:
+            if region.path == name or region.path.strip('[]') == name:
+                return region
+        return None
+
+class ProcessMemory(object):
+    """ Reads the memory of the debugged process straight out of /proc/<pid>/mem, which is much
+    cheaper than having Voltron encode it as JSON. Only works when the debugger runs on the same
+    host and we're allowed to ptrace the inferior, so the constructor raises OSError when the
+    kernel (eg, Yama's ptrace_scope) won't let us open it.
+
+    Reads go into buffers that are allocated once per slot and reused, and come back as memoryviews
+    on those buffers, so a view is only valid until the next read into the same slot. """
+    def __init__(self, pid):
+        self.pid = pid
+        self._fd = os.open('/proc/{}/mem'.format(pid), os.O_RDONLY)
+        self._buffers = {}
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def _buffer(self, slot, length):
+        buf = self._buffers.get(slot)
+        if buf is None or len(buf) < length:
+            # Round up to a whole page so a stack that grows a little doesn't reallocate every step
+            buf = bytearray((length + 0xfff) & ~0xfff)
+            self._buffers[slot] = buf
+        return buf
+
+    def read_into(self, address, length, slot=None):
+        """ Reads length bytes at address into the buffer for slot and returns a memoryview of what was
+        read. Raises OSError if the read fails, or IOError if the memory is only partially mapped. """
+        buf = self._buffer(slot, length)
+        target = (ctypes.c_char * len(buf)).from_buffer(buf)
+        done = 0
+        while done < length:
+            count = _pread(self._fd, ctypes.addressof(target) + done, length - done, address + done)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+            if count == 0:
+                raise IOError("Only {} of {} bytes at {} are mapped".format(done, length, hex(address)))
+            done += count
+        return memoryview(buf)[:length]
+
+    def read(self, address, length):
+        """ Reads memory into a new string, for callers that need to hang onto it """
+        return self.read_into(address, length).tobytes()
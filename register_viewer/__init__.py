@@ -1,8 +1,11 @@
 from __future__ import print_function
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, QSize
+from PyQt5.QtCore import Qt, QSize, QAbstractTableModel, QModelIndex, pyqtSignal
 from PyQt5.QtGui import QFontDatabase, QColor, QBrush
 from collections import OrderedDict
+from binascii import unhexlify
+from ..address_classifier import kind_colors
+import struct
 
 monospace = QFontDatabase.systemFont(QFontDatabase.FixedFont)
 highlight = QBrush(QColor(255, 153, 51))
@@ -24,6 +27,47 @@ def _makewidget(val, center=False):
         out.setTextAlignment(Qt.AlignCenter)
     return out
 
+def format_register(value, bitwidth, encoding, dereference=None):
+    """ Formats a register value in one of the display modes. If you want to add a new encoding,
+    you'll need to add it here and to RegisterWindow._display_modes """
+    if encoding == 'hex':
+        base = hex(value).replace("L","")
+        return "0x" + "0"*((bitwidth / 4) - len(base.split('0x')[1])) + base.split('0x')[1]
+    if encoding == 'decimal':
+        return str(value)
+    if encoding == 'binary':
+        base = bin(value)[2:]
+        out = '0' * (bitwidth - len(base)) + base
+        return ' '.join([chunk for chunk in _chunks(out, 8)])
+    if encoding == 'ascii':
+        hexstr = format_register(value, bitwidth, 'hex')[2:]
+        return "".join([('.' if (int(c, 16) < 32 or int(c, 16) >= 127) else chr(int(c, 16))) for c in _chunks(hexstr, 2)])
+    if encoding == 'deref':
+        if dereference:
+            # Voltron gives us an array of the values in sequence
+            return " --> ".join((hex(item[1]) if (item[0] == 'pointer') else \
+            (item[1] if (item[0] != 'string') else "\"" + item[1] \
+            .replace("\n","\\n").replace("\t","\\t") + "\"")) for item in dereference[1:])
+        return ""
+    return None
+
+# Lane formats for vector registers, as struct format characters
+lane_formats = OrderedDict([('i8', 'b'), ('i16', 'h'), ('i32', 'i'), ('i64', 'q'), ('f32', 'f'), ('f64', 'd')])
+
+def register_bytes(value, bitwidth):
+    """ Turns a register value from Voltron into its little-endian bytes. Voltron hands us most
+    vector registers as (very large) integers, but some debuggers give back raw strings. """
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    return unhexlify('%0*x' % (bitwidth // 4, value))[::-1]
+
+def split_lanes(raw, fmt):
+    """ Splits the raw bytes of a vector register into lanes with a single struct call """
+    code = lane_formats[fmt]
+    size = struct.calcsize(code)
+    count = len(raw) // size
+    return struct.unpack('<' + str(count) + code, raw[:count * size])
+
 def parse_flag_register(flagsval):
     """ Borrowed Snare's code for parsing the eflags/rflags register """
     values = OrderedDict()
@@ -31,11 +75,286 @@ def parse_flag_register(flagsval):
         values[flag] = (flagsval & (1 << flagbits[flag]) > 0)
     return values
 
+class RegisterModel(QAbstractTableModel):
+    """ Table model for the register window. The register state lives in flat lists indexed by
+    row, with a bytearray of dirty bits, and the formatted text for each row is only built when
+    the view asks for it (which it only does for rows that are on screen). """
+    def __init__(self):
+        super(RegisterModel, self).__init__()
+        self.display_mode = 'hex'
+        self.names = []
+        self.rows = {}
+        self.values = []
+        self.widths = []
+        self.derefs = []
+        self.kinds = []
+        self.labels = []
+        self.dirty = bytearray()
+        self._text = []
+        self._touched = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 3
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return ['Register', 'Value', 'Points to'][section]
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        row = index.row()
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return self.names[row]
+            if index.column() == 2:
+                return self.labels[row]
+            if self._text[row] is None:
+                self._text[row] = format_register(self.values[row], self.widths[row], self.display_mode, self.derefs[row])
+            return self._text[row]
+        if role == Qt.FontRole:
+            return monospace
+        if role == Qt.ForegroundRole and index.column() == 1:
+            return highlight if self.dirty[row] else default
+        if role == Qt.ForegroundRole and index.column() == 2 and self.kinds[row] is not None:
+            return QBrush(kind_colors[self.kinds[row]])
+        return None
+
+    def add_register(self, name, width, value):
+        row = len(self.names)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows[name] = row
+        self.names.append(name)
+        self.values.append(value)
+        self.widths.append(width)
+        self.derefs.append([])
+        self.kinds.append(None)
+        self.labels.append("")
+        self.dirty.append(0)
+        self._text.append(None)
+        self.endInsertRows()
+
+    def set_value(self, name, value):
+        """ Changes a register value and marks it dirty if it actually changed """
+        row = self.rows[name]
+        value = int(value)
+        if self.values[row] != value:
+            self.values[row] = value
+            self.dirty[row] = 1
+            self._text[row] = None
+            self._touched.add(row)
+
+    def set_deref(self, name, deref):
+        row = self.rows[name]
+        if self.derefs[row] != deref:
+            self.derefs[row] = deref
+            if self.display_mode == 'deref':
+                self._text[row] = None
+                self._touched.add(row)
+
+    def set_class(self, name, kind, label):
+        """ Sets what the register points to, as worked out locally by the AddressClassifier """
+        row = self.rows[name]
+        if self.labels[row] != label or self.kinds[row] != kind:
+            self.kinds[row] = kind
+            self.labels[row] = label
+            self._touched.add(row)
+
+    def clean(self):
+        """ Clears the dirty bits, remembering which rows need their highlight removed """
+        for row in range(len(self.dirty)):
+            if self.dirty[row]:
+                self.dirty[row] = 0
+                self._touched.add(row)
+
+    def flush(self):
+        """ Tells the view about the rows that changed since the last flush, one contiguous run at a time """
+        rows = sorted(self._touched)
+        self._touched = set()
+        run_start = None
+        for i, row in enumerate(rows):
+            if run_start is None:
+                run_start = row
+            if i + 1 == len(rows) or rows[i + 1] != row + 1:
+                self.dataChanged.emit(self.index(run_start, 0), self.index(row, 2))
+                run_start = None
+
+    def set_display_mode(self, mode):
+        """ Throws out the formatted text. Since the view only asks for rows that are visible,
+        the rest won't be re-formatted until they're scrolled into view. """
+        self.display_mode = mode
+        self._text = [None] * len(self.names)
+        if len(self.names) > 0:
+            self.dataChanged.emit(self.index(0, 1), self.index(len(self.names) - 1, 1))
+
+class VectorModel(QAbstractTableModel):
+    """ Table model for the vector/x87 panel. One row per register and one column per lane, so the
+    view only asks us to format the lanes that are actually on screen. Each register is split into
+    lanes once (per format) the first time any of its lanes is needed. """
+    def __init__(self):
+        super(VectorModel, self).__init__()
+        self.lane_format = 'i32'
+        self.names = []
+        self.widths = []
+        self.raw = []
+        self._lanes = []
+
+    def set_registers(self, registers):
+        """ Takes a dict of 'name': width in bits """
+        self.beginResetModel()
+        self.names = list(registers.keys())
+        self.widths = [registers[name] for name in self.names]
+        self.raw = [None] * len(self.names)
+        self._lanes = [None] * len(self.names)
+        self.endResetModel()
+
+    def set_lane_format(self, fmt):
+        self.beginResetModel()
+        self.lane_format = fmt
+        self._lanes = [None] * len(self.names)
+        self.endResetModel()
+
+    def update_values(self, values):
+        """ Takes a dict of 'name': value for whichever registers were fetched """
+        for name in values:
+            if name not in self.names or values[name] is None:
+                continue
+            row = self.names.index(name)
+            if isinstance(values[name], float):
+                # x87 registers sometimes come back already converted
+                raw = values[name]
+            else:
+                raw = register_bytes(values[name], self.widths[row])
+            if raw != self.raw[row]:
+                self.raw[row] = raw
+                self._lanes[row] = None
+                self.dataChanged.emit(self.index(row, 1), self.index(row, self.columnCount() - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid() or len(self.widths) == 0:
+            return 0
+        return 1 + max(self.widths) // (8 * struct.calcsize(lane_formats[self.lane_format]))
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return 'Register' if section == 0 else str(section - 1)
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        row, column = index.row(), index.column()
+        if role == Qt.FontRole:
+            return monospace
+        if role != Qt.DisplayRole:
+            return None
+        if column == 0:
+            return self.names[row]
+        if self.raw[row] is None:
+            return None
+        if self._lanes[row] is None:
+            if isinstance(self.raw[row], float):
+                self._lanes[row] = ('{:g}'.format(self.raw[row]),)
+            else:
+                self._lanes[row] = split_lanes(self.raw[row], self.lane_format)
+        lanes = self._lanes[row]
+        if column - 1 >= len(lanes):
+            return None
+        lane = lanes[column - 1]
+        return '{:g}'.format(lane) if isinstance(lane, float) else str(lane)
+
+class VectorRegisterPanel(QtWidgets.QWidget):
+    """ Collapsible panel for the SIMD and x87 registers. These are big and expensive to fetch,
+    so they're only requested while the panel is expanded, and only for the rows on screen.
+    Whenever the set of registers we want changes, WANTED_CHANGED is emitted with the new list
+    so the owner can fetch them and hand them to update_values (it's empty while collapsed). """
+    WANTED_CHANGED = pyqtSignal(list)
+
+    def __init__(self):
+        super(VectorRegisterPanel, self).__init__()
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+        self._layout.setContentsMargins(0, 0, 0, 0)
+        self.wanted = []
+
+        self._header = QtWidgets.QHBoxLayout()
+        self._toggle = QtWidgets.QToolButton()
+        self._toggle.setText("Vector / x87 registers")
+        self._toggle.setToolButtonStyle(Qt.ToolButtonTextBesideIcon)
+        self._toggle.setArrowType(Qt.RightArrow)
+        self._toggle.setCheckable(True)
+        self._toggle.setAutoRaise(True)
+        self._toggle.toggled.connect(self.set_expanded)
+        self._header.addWidget(self._toggle)
+        self._format = QtWidgets.QComboBox()
+        for fmt in lane_formats:
+            self._format.addItem(fmt)
+        self._format.setCurrentIndex(list(lane_formats.keys()).index('i32'))
+        self._format.currentIndexChanged.connect(lambda i: self._model.set_lane_format(list(lane_formats.keys())[i]))
+        self._format.setVisible(False)
+        self._header.addWidget(self._format)
+        self._layout.addLayout(self._header)
+
+        self._model = VectorModel()
+        self._table = QtWidgets.QTableView()
+        self._table.setModel(self._model)
+        self._table.verticalHeader().setVisible(False)
+        self._table.setVisible(False)
+        self._table.verticalScrollBar().valueChanged.connect(self._check_wanted)
+        self._layout.addWidget(self._table)
+
+    @property
+    def expanded(self):
+        return self._toggle.isChecked()
+
+    def set_registers(self, registers):
+        """ Takes a dict of 'name': width in bits """
+        self._model.set_registers(registers)
+        self._check_wanted()
+
+    def set_expanded(self, expanded):
+        self._toggle.setArrowType(Qt.DownArrow if expanded else Qt.RightArrow)
+        self._format.setVisible(expanded)
+        self._table.setVisible(expanded)
+        self._check_wanted()
+
+    def update_values(self, values):
+        self._model.update_values(values)
+
+    def resizeEvent(self, event):
+        super(VectorRegisterPanel, self).resizeEvent(event)
+        self._check_wanted()
+
+    def _check_wanted(self, *_args):
+        """ Works out which registers are on screen, and lets the owner know if that changed """
+        wanted = []
+        if self.expanded and len(self._model.names) > 0:
+            first = self._table.rowAt(0)
+            last = self._table.rowAt(self._table.viewport().height() - 1)
+            first = 0 if first < 0 else first
+            last = len(self._model.names) - 1 if last < 0 else last
+            wanted = self._model.names[first:last + 1]
+        if wanted != self.wanted:
+            self.wanted = wanted
+            self.WANTED_CHANGED.emit(wanted)
+
 class RegisterWindow(QtWidgets.QWidget):
     """ GUI for displaying a live dump of the contents of the registers in various formats."""
     _display_modes = ['binary', 'decimal', 'hex', 'ascii', 'deref']
-    registers = OrderedDict()
     display_mode = 'hex'
+    # Emitted with the index of the recorded step the user scrubbed to on the history slider
+    HISTORY_SELECTED = pyqtSignal(int)
+    # Emitted with the name of the new display mode whenever it changes
+    DISPLAY_MODE_CHANGED = pyqtSignal(str)
 
     def __init__(self, registers=None):
         super(RegisterWindow, self).__init__()
@@ -52,14 +371,14 @@ class RegisterWindow(QtWidgets.QWidget):
         self._picker.currentIndexChanged.connect(self.change_display_mode)
 
         # Set up register table
-        self._table = QtWidgets.QTableWidget()
-        self._table.setColumnCount(2)
-        self._table.setHorizontalHeaderLabels(['Register', 'Value'])
+        self._model = RegisterModel()
+        self._table = QtWidgets.QTableView()
+        self._table.setModel(self._model)
         self._table.horizontalHeader().setStretchLastSection(True)
         self._table.verticalHeader().setVisible(False)
         self._layout.addWidget(self._table)
 
-        # Set up flag viewer
+        # Set up flag viewer. The cells are created once and only touched when a flag changes.
         self._flags = QtWidgets.QTableWidget()
         self._flags.setColumnCount(len(flagbits.keys()))
         self._flags.setHorizontalHeaderLabels(flagbits.keys())
@@ -70,8 +389,25 @@ class RegisterWindow(QtWidgets.QWidget):
         self._flags.setRowCount(1)
         for index, value in enumerate(flagnames):
             self._flags.horizontalHeaderItem(index).setToolTip(value)
+            self._flags.setItem(0, index, _makewidget("", True))
+        self._flag_values = None
+        self._flag_dirty = [False] * len(flagbits.keys())
         self._layout.addWidget(self._flags)
 
+        # Set up the (collapsed) vector register panel
+        self.vector_panel = VectorRegisterPanel()
+        self._layout.addWidget(self.vector_panel)
+
+        # Set up the history slider. It follows the newest step until the user drags it somewhere else.
+        self._history = QtWidgets.QHBoxLayout()
+        self._slider = QtWidgets.QSlider(Qt.Horizontal)
+        self._slider.setRange(0, 0)
+        self._slider.valueChanged.connect(self._history_moved)
+        self._history.addWidget(self._slider)
+        self._history_label = QtWidgets.QLabel("Live")
+        self._history.addWidget(self._history_label)
+        self._layout.addLayout(self._history)
+
         self.setObjectName('Register_Window')
 
         self.should_clean = False
@@ -79,48 +415,51 @@ class RegisterWindow(QtWidgets.QWidget):
         if registers is not None:
             self.update_registers(registers)
 
+    def set_history_length(self, length):
+        """ Tells the slider how many steps have been recorded, and snaps it back to the newest one """
+        self._slider.blockSignals(True)
+        self._slider.setRange(0, max(length - 1, 0))
+        self._slider.setValue(max(length - 1, 0))
+        self._slider.blockSignals(False)
+        self._history_label.setText("Live")
+
+    def set_history_label(self, text):
+        self._history_label.setText(text)
+
+    def _history_moved(self, value):
+        self.HISTORY_SELECTED.emit(value)
+
     def update_registers(self, registers):
         """ Takes a dict of registers - 'name' : (value, width). Mostly just a wrapper around update_single_registers"""
-        self._table.setRowCount(len(registers))
         for register in registers:
             self.update_single_register(register, registers[register][0], registers[register][1])
+        self._model.flush()
         self.resize(QSize(self._layout.sizeHint().width(), self._table.viewportSizeHint().height() + self._picker.sizeHint().height() + self._table.sizeHint().height()))
 
     def update_single_register(self, name, value, width=32):
         """ Updates a single register (and adds it if it doesn't exist). Cleans registers if dirty values have been highlighted"""
         if(self.should_clean):
-            for reg in self.registers:
-                self.registers[reg].dirty = False
-        if name not in self.registers.keys():
-            self.registers[name] = Register(name, len(self.registers.keys()), width, value)
-            self._update_table_entry(name)
+            self._model.clean()
+            self.should_clean = False
+        if name not in self._model.rows:
+            self._model.add_register(name, width, int(value))
         else:
-            if self.registers[name].value != value:
-                self.registers[name].setval(value)
-                self._update_table_entry(name)
+            self._model.set_value(name, value)
         if name == 'eflags' or name == 'rflags':
             self._update_flag_display(value)
-        self.should_clean = False
-
-    def _update_table_entry(self, name):
-        """ Replaces the table widgets for a given register."""
-        self._table.setItem(self.registers[name].index, 0, _makewidget(self.registers[name].name))
-        # Passes the display mode to regsiter.getitem
-        self._table.setItem(self.registers[name].index, 1, _makewidget(self.registers[name][self.display_mode]))
 
     def _update_flag_display(self, value):
         """ Handles dirty flag highlighting and updates in general. This is simpler than the register
         highlighting, which is why it thinks all the flags need to be highlighted when first launched."""
-        values = parse_flag_register(value)
-        for i in range(len(flagbits.keys())):
-            oldval = self._flags.item(0, i)
-            if oldval is not None:
-                oldval = oldval.text()
-            self._flags.setItem(0, i, _makewidget("1" if (values[values.keys()[i]]) else "0", True))
-            if self._flags.item(0, i).text() != oldval:
-                self._flags.item(0, i).setForeground(highlight)
-            else:
-                self._flags.item(0, i).setForeground(default)
+        values = list(parse_flag_register(value).values())
+        for i in range(len(values)):
+            changed = self._flag_values is None or self._flag_values[i] != values[i]
+            if changed:
+                self._flags.item(0, i).setText("1" if values[i] else "0")
+            if changed != self._flag_dirty[i]:
+                self._flags.item(0, i).setForeground(highlight if changed else default)
+                self._flag_dirty[i] = changed
+        self._flag_values = values
 
     def change_display_mode(self, mode):
         """ Changes the way register values are decoded. Default is as hexadecimal, but
@@ -135,97 +474,26 @@ class RegisterWindow(QtWidgets.QWidget):
             print(str(mode) + " is not a valid display mode! Valid modes are: " + str(self._display_modes))
             return
         self.display_mode = mode
-        for name in self.registers.keys():
-            self._update_table_entry(name)
-        self.should_clean = False
-        self.highlight_dirty()
+        self._model.set_display_mode(mode)
+        self.DISPLAY_MODE_CHANGED.emit(mode)
 
     def highlight_dirty(self):
-        """ Highlights any registers that have been marked as dirty, and indicates that
-        all registers should be cleaned next time the values are updated (Note: NOT the next
-        time the display mode is changed)"""
-        for reg in self.registers:
-            reg = self.registers[reg]
-            if(reg.dirty):
-                t_item = self._table.item(reg.index, 1)
-                if t_item is not None:
-                    t_item.setForeground(highlight)
-                if(self.should_clean):
-                    reg.dirty = False
-            else:
-                t_item = self._table.item(reg.index, 1)
-                if t_item is not None:
-                    t_item.setForeground(default)
+        """ Repaints the registers that changed (or stopped being highlighted) since the last update,
+        and indicates that all registers should be cleaned next time the values are updated (Note: NOT
+        the next time the display mode is changed)"""
+        self._model.flush()
         self.should_clean = True
 
     def update_derefs(self, derefs):
         """ Updates dereference values for each register. Necessary because
         derefs are stored separately from values (not pulled live)"""
         for reg in derefs.keys():
-            if self.registers[reg].dereference != derefs[reg]:
-                self.registers[reg].dereference = derefs[reg]
-                # if self.display_mode == 'deref':
-                self._update_table_entry(reg)
-
-class Register():
-    def __init__(self, name, index, width, value=0):
-        self.name = name
-        self.bitwidth = width
-        self.value = value
-        self.index = index
-        self.dirty = False
-        self.dereference = []
-
-    def __getitem__(self, encoding):
-        # If you want to add a new encoding, you'll need to also add it here
-        if encoding == 'hex':
-            return self.hex
-        if encoding == 'decimal':
-            return self.decimal
-        if encoding == 'binary':
-            return self.binary
-        if encoding == 'ascii':
-            return self.ascii
-        if encoding == 'deref':
-            return self.deref
-        return None
-
-    def __repr__(self):
-        return self.name + " (" + str(self.bitwidth) + "b): " + self.hex
-
-    @property
-    def binary(self):
-        base = bin(self.value)[2:]
-        out = '0' * (self.bitwidth - len(base)) + base
-        return ' '.join([chunk for chunk in _chunks(out, 8)])
-
-    @property
-    def decimal(self):
-        """ Registers are stored as decimal by default, so that's how they should
-        be passed to setval """
-        return self.value
-
-    @property
-    def hex(self):
-        base = hex(self.value).replace("L","")
-        out = "0x" + "0"*((self.bitwidth / 4) - len(base.split('0x')[1])) + base.split('0x')[1]
-        return out
-
-    @property
-    def ascii(self):
-        hexstr = self.hex[2:]
-        return "".join([('.' if (int(c, 16) < 32 or int(c, 16) >= 127) else chr(int(c, 16))) for c in _chunks(hexstr, 2)])
-
-    @property
-    def deref(self):
-        if len(self.dereference) > 0:
-            # Voltron gives us an array of the values in sequence
-            return " --> ".join((hex(item[1]) if (item[0] == 'pointer') else \
-            (item[1] if (item[0] != 'string') else "\"" + item[1] \
-            .replace("\n","\\n").replace("\t","\\t") + "\"")) for item in self.dereference[1:])
-        return ""
+            self._model.set_deref(reg, derefs[reg])
 
-    def setval(self, newval):
-        """ Changes the register value and marks it as having changed since the last cleaning """
-        self.value = int(newval)
-        self.dirty = True
+    def update_classes(self, classes):
+        """ Takes a dict of 'name': (kind, label) describing where each register points. Only
+        the rows whose label changed get repainted, on the next flush. """
+        for reg in classes.keys():
+            if reg in self._model.rows:
+                self._model.set_class(reg, classes[reg][0], classes[reg][1])
+        self._model.flush()
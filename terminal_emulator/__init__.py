@@ -1,10 +1,12 @@
 from __future__ import print_function
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize
+from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QTimer
 from PyQt5.QtGui import QColor, QPalette, QTextCursor, QIcon, QFontDatabase
 from base64 import b64decode
 
-import pty, select, os, struct
+import pty, select, os, struct, errno, fcntl, termios, tty, mmap, tempfile, threading, time
+from array import array
+from bisect import bisect_right
 try:
     from queue import Queue
 except ImportError:
@@ -14,43 +16,294 @@ from functools import partial
 from binaryninja import log_alert, user_plugin_path
 
 usercolor = QColor(255, 153, 51) # Nice orange highlight color
+flush_interval = 33 # Milliseconds between repaints of new output (about 30 Hz)
+scrollback_lines = 10000 # Oldest lines get dropped off the top after this many
+
+class Transcript(object):
+    """ Append-only file holding everything sent to and received from the binary. Each record is a
+    header (timestamp, step number, direction, length) followed by the raw bytes. We keep an index
+    of where each record starts and read the file back through a memory map, so the history can
+    grow without limit and still be paged through and searched without loading it all. """
+    INPUT, OUTPUT = 0, 1
+    header = struct.Struct('<dIBI')
+
+    def __init__(self, path=None):
+        # Transcripts we made up a temporary file for get deleted again when they're closed
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='binja_dynamics_', suffix='.transcript')
+            os.close(fd)
+        self.path = path
+        self.step = 0
+        self.offsets = array('L')
+        self._file = open(path, 'w+b')
+        self._size = 0
+        self._lock = threading.Lock()
+        self._map = None
+
+    def append(self, direction, data):
+        """ Adds a record for data travelling in the given direction (INPUT or OUTPUT) """
+        record = self.header.pack(time.time(), self.step, direction, len(data)) + bytes(data)
+        with self._lock:
+            self._file.write(record)
+            self.offsets.append(self._size)
+            self._size += len(record)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _view(self):
+        """ Returns a memory map covering every record written so far, remapping if the file grew """
+        with self._lock:
+            if self._size == 0:
+                return b'', 0
+            if self._map is None or len(self._map) < self._size:
+                self._file.flush()
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), self._size, access=mmap.ACCESS_READ)
+            return self._map, len(self.offsets)
+
+    def record(self, index):
+        """ Returns (timestamp, step, direction, data) for the index-th record """
+        view, _count = self._view()
+        offset = self.offsets[index]
+        timestamp, step, direction, length = self.header.unpack_from(view, offset)
+        start = offset + self.header.size
+        return timestamp, step, direction, view[start:start + length]
+
+    def records(self, first, count):
+        """ Returns a window of records, for displaying part of the history """
+        return [self.record(index) for index in range(max(first, 0), min(first + count, len(self)))]
+
+    def search(self, pattern, start=0, limit=1000):
+        """ Finds the pattern in the recorded data. Returns a list of (record index, offset into the
+        record) for up to limit hits. Matches that straddle two records aren't found. """
+        view, count = self._view()
+        hits = []
+        if len(pattern) == 0 or count == 0:
+            return hits
+        position = self.offsets[start] if start < count else len(view)
+        while len(hits) < limit:
+            position = view.find(pattern, position)
+            if position < 0:
+                break
+            index = bisect_right(self.offsets, position, 0, count) - 1
+            data_start = self.offsets[index] + self.header.size
+            length = self.header.unpack_from(view, self.offsets[index])[3]
+            if position >= data_start and position + len(pattern) <= data_start + length:
+                hits.append((index, position - data_start))
+            position += 1
+        return hits
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+            if self._temporary and os.path.exists(self.path):
+                os.remove(self.path)
+
+class TranscriptWindow(QtWidgets.QWidget):
+    """ Lets you search the transcript and page through it a window of records at a time """
+    window_size = 200
+
+    def __init__(self, transcript):
+        super(TranscriptWindow, self).__init__()
+        self.transcript = transcript
+        self.setWindowTitle("Transcript")
+        self.setLayout(QtWidgets.QVBoxLayout())
+        self._layout = self.layout()
+
+        self._search = QtWidgets.QLineEdit()
+        self._search.setPlaceholderText("Search (raw text)")
+        self._search.returnPressed.connect(self.run_search)
+        self._layout.addWidget(self._search)
+
+        self._results = QtWidgets.QListWidget()
+        self._results.currentRowChanged.connect(self.show_result)
+        self._results.setMaximumHeight(150)
+        self._layout.addWidget(self._results)
+
+        self._textBrowser = QtWidgets.QTextBrowser()
+        self._textBrowser.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+        self._layout.addWidget(self._textBrowser)
+        self._hits = []
+        self.setObjectName('Transcript_Window')
+
+    def run_search(self):
+        self._hits = self.transcript.search(str(self._search.text()))
+        self._results.clear()
+        for index, offset in self._hits:
+            _timestamp, step, direction, _data = self.transcript.record(index)
+            self._results.addItem("step {}, {} record {} +{}".format(step, "in" if direction == Transcript.INPUT else "out", index, offset))
+        if len(self._hits) == 0:
+            self.show_window(max(len(self.transcript) - self.window_size, 0))
+
+    def show_result(self, row):
+        if 0 <= row < len(self._hits):
+            self.show_window(self._hits[row][0] - self.window_size // 2, self._hits[row][0])
+
+    def show_window(self, first, current=None):
+        """ Renders a window of records, with input in orange like the rest of the UI """
+        self._textBrowser.clear()
+        cursor = QTextCursor(self._textBrowser.document())
+        for index, (timestamp, step, direction, data) in enumerate(self.transcript.records(first, self.window_size), max(first, 0)):
+            fmt = cursor.charFormat()
+            fmt.setForeground(usercolor if direction == Transcript.INPUT else self.palette().color(QPalette.WindowText))
+            fmt.setFontWeight(75 if index == current else 50)
+            cursor.insertText(data.decode('latin-1'), fmt)
+            if index == current:
+                self._textBrowser.setTextCursor(cursor)
+        self._textBrowser.ensureCursorVisible()
+
+def _read_file(path):
+    """ Generates the contents of a file a chunk at a time, and closes it when we're done """
+    with open(path, 'rb') as payload:
+        while True:
+            chunk = payload.read(InputStream.chunk_size)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+class InputStream(object):
+    """ A payload to feed into the pty a chunk at a time. The source can be a string, a file
+    object, or an iterable that generates strings, so payloads never have to be held in memory
+    all at once. Bytes are written exactly as given. """
+    chunk_size = 16 * 1024
+    _next_id = 0
+
+    def __init__(self, source, total=None):
+        InputStream._next_id += 1
+        self.stream_id = InputStream._next_id
+        if isinstance(source, (bytes, bytearray)):
+            self._chunks = iter([bytes(source)])
+            total = len(source) if total is None else total
+        elif hasattr(source, 'read'):
+            self._chunks = iter(lambda: source.read(self.chunk_size), b'')
+            if total is None and hasattr(source, 'fileno'):
+                total = os.fstat(source.fileno()).st_size
+        else:
+            self._chunks = iter(source)
+        self.total = total if total is not None else -1
+        self.sent = 0
+        self._buffer = b''
+
+    def pending(self):
+        """ Returns the bytes waiting to be written, or an empty string once the source runs dry """
+        while len(self._buffer) == 0:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return b''
+        return self._buffer[:self.chunk_size]
+
+    def consume(self, count):
+        """ Marks count bytes from the front of pending() as written """
+        self._buffer = self._buffer[count:]
+        self.sent += count
 
 class TerminalThread(QThread):
     """ Helper thread that creates the tty for gdb to redirect input and output
-    for the binary to. """
+    for the binary to. Sleeps in select until the binary writes something or
+    send() wakes it up through a pipe, so it doesn't use any CPU while idle. """
     RECV_LINE = pyqtSignal(str)
+    # Stream id, bytes sent so far, total bytes (-1 if we don't know)
+    SEND_PROGRESS = pyqtSignal(int, int, int)
+    min_read = 1024
+    max_read = 64 * 1024
+    progress_interval = 64 * 1024 # Bytes between progress updates
 
-    def __init__(self, message_q):
+    def __init__(self, message_q, transcript=None):
         QThread.__init__(self)
         self.messages = message_q
+        self.transcript = transcript
         # Only the inferior process need use the slave file descriptor
         self.master, self.slave = pty.openpty()
         self.tty = os.ttyname(self.slave)
+        self._wake_read, self._wake_write = os.pipe()
+        # Partial writes are fine (we keep track of how much went out), but blocking isn't
+        fcntl.fcntl(self.master, fcntl.F_SETFL, fcntl.fcntl(self.master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._cooked = termios.tcgetattr(self.slave)
 
     def __del__(self):
         os.close(self.master)
         os.close(self.slave)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def send(self, message):
+        """ Queues a message for the thread and wakes it up. Expects a message to contain either
+        the string 'exit', a line of input in a tuple: ('input', None), or an InputStream """
+        self.messages.put(message)
+        os.write(self._wake_write, b'\0')
+
+    def set_raw(self, raw):
+        """ Switches the terminal between raw mode, where every byte reaches the binary untouched,
+        and the normal line-buffered mode (with echo, ^C, ^D and friends) """
+        if raw:
+            tty.setraw(self.slave, termios.TCSANOW)
+        else:
+            termios.tcsetattr(self.slave, termios.TCSANOW, self._cooked)
+
+    def _write(self, stream):
+        """ Writes as much of the stream as the pty will take right now. Returns True once it's done. """
+        chunk = stream.pending()
+        if len(chunk) > 0:
+            try:
+                count = os.write(self.master, chunk)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                count = 0
+            before = stream.sent
+            stream.consume(count)
+            if self.transcript is not None and count > 0:
+                self.transcript.append(Transcript.INPUT, chunk[:count])
+            if before // self.progress_interval != stream.sent // self.progress_interval:
+                self.SEND_PROGRESS.emit(stream.stream_id, stream.sent, stream.total)
+            if len(stream.pending()) > 0:
+                return False
+        self.SEND_PROGRESS.emit(stream.stream_id, stream.sent, stream.total)
+        return True
 
     def run(self):
-        while True :
-            writefd = []
-            if not self.messages.empty():
-                # Expects a message to contain either the string 'exit'
-                # or a line of input in a tuple: ('input', None)
-                message = self.messages.get()
-                if message == 'exit':
-                    self.messages.task_done()
-                    break
-                else:
-                    message, _encoding = message
-                    writefd = [self.master]
-            r,w,_ = select.select([self.master], writefd, [], 0)
-            if r:
-                # Read when the binary has new output for us (sometimes this came from us writing)
-                line = os.read(self.master, 1024) # Reads up to a kilobyte at once. Should this be higher/lower?
-                self.RECV_LINE.emit(line)
-            if w:
-                os.write(self.master, message + "\n")
+        outgoing = []
+        readsize = self.min_read
+        while True:
+            # We only ask about writing while we have something to send, and we keep reading the whole
+            # time, so a big payload trickles in as fast as the binary takes it without blocking output.
+            r,w,_ = select.select([self.master, self._wake_read], [self.master] if outgoing else [], [])
+            if self._wake_read in r:
+                os.read(self._wake_read, 4096) # One byte per message, but we just drain the queue
+                while not self.messages.empty():
+                    message = self.messages.get()
+                    if message == 'exit':
+                        self.messages.task_done()
+                        return
+                    if not isinstance(message, InputStream):
+                        message = InputStream(message[0] + "\n")
+                    outgoing.append(message)
+            if self.master in r:
+                # Read when the binary has new output for us (sometimes this came from us writing).
+                # Grow the read size while the binary keeps filling it, and shrink it again once it quiets down.
+                try:
+                    line = os.read(self.master, readsize)
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    line = b''
+                if len(line) == readsize:
+                    readsize = min(readsize * 2, self.max_read)
+                elif len(line) < readsize // 4:
+                    readsize = max(readsize // 2, self.min_read)
+                if len(line) > 0:
+                    if self.transcript is not None:
+                        self.transcript.append(Transcript.OUTPUT, line)
+                    self.RECV_LINE.emit(line)
+            if w and self._write(outgoing[0]):
+                outgoing.pop(0)
                 self.messages.task_done()
 
 class TerminalWindow(QtWidgets.QWidget):
@@ -73,8 +326,9 @@ class TerminalWindow(QtWidgets.QWidget):
         self._textBrowser = QtWidgets.QTextBrowser()
         self._textBrowser.setOpenLinks(False)
         self._textBrowser.setTextColor(self.palette().color(QPalette.WindowText))
-        self._textBrowser.textChanged.connect(self.handle_new_output)
         self._textBrowser.selectionChanged.connect(self.handle_selection_changed)
+        # The document drops its oldest blocks once it's full, so it behaves like a ring buffer of lines
+        self._textBrowser.document().setMaximumBlockCount(scrollback_lines)
         self._textBrowser.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
         self._layout.addWidget(self._textBrowser)
 
@@ -103,6 +357,18 @@ class TerminalWindow(QtWidgets.QWidget):
         self._hist_button.setMenu(self._hist_menu)
 
         self._sublayout.addWidget(self._hist_button)
+
+        # Creates the controls for sending big binary payloads
+        self._raw_box = QtWidgets.QCheckBox("raw")
+        self._raw_box.setToolTip("Pass every byte straight through to the binary, with no line editing or echo")
+        self._raw_box.toggled.connect(self.set_raw_mode)
+        self._sublayout.addWidget(self._raw_box)
+        self._file_button = QtWidgets.QPushButton("Send file...")
+        self._file_button.clicked.connect(self.choose_file)
+        self._sublayout.addWidget(self._file_button)
+        self._transcript_button = QtWidgets.QPushButton("Transcript")
+        self._transcript_button.clicked.connect(self.show_transcript)
+        self._sublayout.addWidget(self._transcript_button)
         self._layout.addLayout(self._sublayout)
 
         # Creates the bottom label that displays the byte counts
@@ -112,18 +378,35 @@ class TerminalWindow(QtWidgets.QWidget):
         # Cursor position, line length
         self._leftLabel.setText("0, 0")
         # Selection size, total bytes output, +bytes in last write
-        self._rightLabel.setText("0, 0, +0")
+        self._selection_size = 0
+        self._total_output = 0
+        self._last_write = 0
+        self._update_right_label()
         self._statusbar.addWidget(self._leftLabel)
+        # Shows how far along the payload currently being sent is
+        self._progress = QtWidgets.QProgressBar()
+        self._progress.setVisible(False)
+        self._statusbar.addWidget(self._progress)
         self._statusbar.addWidget(self._rightLabel)
         self._layout.addLayout(self._statusbar)
 
         # Create message passing queue, initialize thread, connect incoming lines
         # to text browser
         self._messages = Queue()
-        self._pty_thread = TerminalThread(self._messages)
+        self.transcript = Transcript()
+        self._transcript_window = None
+        self._pty_thread = TerminalThread(self._messages, self.transcript)
         self._pty_thread.RECV_LINE.connect(self.recv_line)
+        self._pty_thread.SEND_PROGRESS.connect(self.handle_send_progress)
         self._pty_thread.start()
 
+        # Output gets batched up and pushed to the browser at most flush_interval ms apart
+        self._pending = []
+        self._flush_timer = QTimer()
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(flush_interval)
+        self._flush_timer.timeout.connect(self.flush_output)
+
         self._textbox.returnPressed.connect(self.submit_line)
 
         self.resize(self.width(), int(self.height() * 0.5))
@@ -136,9 +419,22 @@ class TerminalWindow(QtWidgets.QWidget):
         self._textBrowser.ensureCursorVisible()
 
     def recv_line(self, line):
-        """ Inserts the line into the browser without any highlighting """
-        self._textBrowser.insertPlainText(line)
+        """ Queues the line to be inserted into the browser on the next flush """
+        self._pending.append(line)
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def flush_output(self):
+        """ Inserts everything received since the last flush into the browser in one go, without any highlighting """
+        if len(self._pending) == 0:
+            return
+        output = "".join(self._pending)
+        self._pending = []
+        cursor = QTextCursor(self._textBrowser.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(output)
         self._autoscroll()
+        self.handle_new_output(len(output))
 
     def submit_line(self):
         """ Writes the input to the text browser, adds it to the history, and
@@ -152,7 +448,7 @@ class TerminalWindow(QtWidgets.QWidget):
             action = QtWidgets.QAction(str(raw), self)
             action.triggered.connect(partial(self.set_text_box_contents, raw))
             self._hist_menu.insertAction(self._hist_menu.actions()[0], action)
-        self._messages.put((line, None))
+        self._pty_thread.send((line, None))
         self._autoscroll()
         # self._textBrowser.setTextColor(usercolor)
         # self._textBrowser.insertPlainText(line + "\n")
@@ -160,6 +456,47 @@ class TerminalWindow(QtWidgets.QWidget):
         self._textbox.clear()
         self._autoscroll()
 
+    def send_payload(self, source, total=None):
+        """ Streams a payload to the binary without blocking the UI. Takes a string, a file object,
+        or an iterable that generates strings (handy for payloads built in the Python console). """
+        self._pty_thread.send(InputStream(source, total))
+
+    def choose_file(self):
+        """ Asks for a file and streams its contents to the binary """
+        path, _filter = QtWidgets.QFileDialog.getOpenFileName(self, "Send file to binary")
+        if path:
+            self.send_payload(_read_file(path), os.path.getsize(path))
+
+    def set_step(self, step):
+        """ Tags everything recorded in the transcript from now on with the given step number """
+        self.transcript.step = step
+
+    def close_session(self):
+        """ Stops talking to the binary and throws the transcript away. The window is no use after this. """
+        self._pty_thread.send('exit')
+        self._pty_thread.wait()
+        if self._transcript_window is not None:
+            self._transcript_window.close()
+        self.transcript.close()
+
+    def show_transcript(self):
+        if self._transcript_window is None:
+            self._transcript_window = TranscriptWindow(self.transcript)
+        self._transcript_window.show_window(max(len(self.transcript) - TranscriptWindow.window_size, 0))
+        self._transcript_window.show()
+
+    def set_raw_mode(self, raw):
+        self._pty_thread.set_raw(raw)
+
+    def handle_send_progress(self, _stream_id, sent, total):
+        if total <= 0 or sent >= total:
+            self._progress.setVisible(False)
+            return
+        # QProgressBar only takes ints, so we count in kilobytes to keep big payloads in range
+        self._progress.setMaximum(total // 1024)
+        self._progress.setValue(sent // 1024)
+        self._progress.setVisible(True)
+
     @property
     def tty(self):
         return self._pty_thread.tty
@@ -208,13 +545,15 @@ class TerminalWindow(QtWidgets.QWidget):
         oldtext = self._leftLabel.text().split(', ')
         self._leftLabel.setText(oldtext[0] + ', ' + str(len(newText)))
 
-    def handle_new_output(self):
-        oldtext = self._rightLabel.text().split(', +')[0].split(', ')
-        oldlen, newlen = int(oldtext[1]), len(self._textBrowser.toPlainText())
-        self._rightLabel.setText(oldtext[0] + ', ' + str(newlen) + ', +' + str(newlen-oldlen))
+    def handle_new_output(self, length):
+        self._total_output += length
+        self._last_write = length
+        self._update_right_label()
 
     def handle_selection_changed(self):
-        oldtext = self._rightLabel.text().split(', +')[0].split(', ')
-        oldR = self._rightLabel.text().split(', +')[1]
-        selection = self._textBrowser.textCursor().selectedText()
-        self._rightLabel.setText(str(len(selection)) + ', ' + oldtext[1] + ', +'+ oldR)
+        cursor = self._textBrowser.textCursor()
+        self._selection_size = cursor.selectionEnd() - cursor.selectionStart()
+        self._update_right_label()
+
+    def _update_right_label(self):
+        self._rightLabel.setText("{}, {}, +{}".format(self._selection_size, self._total_output, self._last_write))
@@ -0,0 +1,222 @@
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from hashlib import sha1
+
+# Unsigned 64 bit array typecode. Python 2's array module doesn't have 'Q', but 'L' is 64 bits on x86_64 Linux.
+try:
+    array('Q')
+    word = 'Q'
+except ValueError:
+    word = 'L'
+word_mask = (1 << (array(word).itemsize * 8)) - 1
+page_size = 0x1000
+
+class TraceRecorder(object):
+    """ Records the register state at each step in compact array-backed columns instead of a dict
+    per step. Every step stores its step number, ip and flags, plus a (register id, value) pair for
+    each other register that changed. Every keyframe_interval steps we also store a full copy of the
+    registers, so any step can be rebuilt by bisecting to the nearest keyframe and replaying at most
+    keyframe_interval steps of deltas. A million steps comes to a few tens of megabytes. """
+    def __init__(self, names, ip_name, flags_name, keyframe_interval=256):
+        self.names = list(names)
+        self.ip_name = ip_name
+        self.flags_name = flags_name
+        self.keyframe_interval = keyframe_interval
+        self._ids = dict((name, index) for index, name in enumerate(self.names))
+        # One entry per recorded step
+        self.steps = array('I')
+        self.ips = array(word)
+        self.flags = array('I')
+        self.delta_start = array('I')
+        # Register deltas, indexed by delta_start
+        self.delta_reg = array('H')
+        self.delta_value = array(word)
+        # Full copies of the registers, len(names) values for each keyframe
+        self.keyframe_entries = array('I')
+        self.keyframe_values = array(word)
+        self._current = [None] * len(self.names)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def record(self, step, registers):
+        """ Records a dict of register values from the given step """
+        entry = len(self.steps)
+        self.steps.append(step)
+        self.ips.append(registers.get(self.ip_name, 0) & word_mask)
+        self.flags.append(registers.get(self.flags_name, 0) & 0xffffffff)
+        self.delta_start.append(len(self.delta_reg))
+        for name in registers:
+            index = self._ids.get(name)
+            if index is None or name == self.ip_name or name == self.flags_name:
+                continue
+            value = registers[name] & word_mask
+            if value != self._current[index]:
+                self._current[index] = value
+                self.delta_reg.append(index)
+                self.delta_value.append(value)
+        if entry % self.keyframe_interval == 0:
+            self.keyframe_entries.append(entry)
+            self.keyframe_values.extend(value if value is not None else 0 for value in self._current)
+
+    def find(self, step):
+        """ Returns the index of the last entry recorded at or before the given step number, or -1 """
+        return bisect_right(self.steps, step) - 1
+
+    def state_at(self, entry):
+        """ Rebuilds an OrderedDict of every register's value at the given entry """
+        keyframe = bisect_right(self.keyframe_entries, entry) - 1
+        start = self.keyframe_entries[keyframe]
+        count = len(self.names)
+        values = self.keyframe_values[keyframe * count:(keyframe + 1) * count].tolist()
+        end = self.delta_start[entry + 1] if entry + 1 < len(self.steps) else len(self.delta_reg)
+        for delta in range(self.delta_start[start + 1] if start < entry else end, end):
+            values[self.delta_reg[delta]] = self.delta_value[delta]
+        state = OrderedDict(zip(self.names, values))
+        if self.ip_name in state:
+            state[self.ip_name] = self.ips[entry]
+        if self.flags_name in state:
+            state[self.flags_name] = self.flags[entry]
+        return state
+
+class _SegmentHistory(object):
+    """ The recorded states of one memory segment. Each entry is the segment's (address, length) at that
+    step plus a dict of {page address: page key} for the pages that changed since the previous entry.
+    Every keyframe_interval entries we also keep the full page dict. """
+    def __init__(self):
+        self.steps = array('I')
+        self.bounds = []
+        self.deltas = []
+        self.keyframes = {}
+        self.base = 0 # Number of entries evicted from the front, so entry numbers stay stable
+        self._current = {}
+
+def page_keys(address, memory):
+    """ Cuts a segment into pages aligned to absolute addresses and hashes each one. Returns a list of
+    (page, key) pairs for MemoryHistory.record. Doesn't touch any shared state, so the hashing can be
+    done on the update scheduler's worker thread instead of the main thread. """
+    keys = []
+    end = address + len(memory)
+    for page in range(address - (address % page_size), end, page_size):
+        low, high = max(address, page), min(end, page + page_size)
+        # The offset is part of the key so a partial page at the edge of the segment never gets
+        # mixed up with a whole page that happens to hash the same.
+        keys.append((page, (low - page, sha1(memory[low - address:high - address]).digest())))
+    return keys
+
+class MemoryHistory(object):
+    """ Copy-on-write snapshots of memory segments (the stack and .bss) at each step. Pages are aligned
+    to absolute addresses and stored once per distinct content, so a step that only touches the top of
+    the stack costs one page. When the pages held pass budget bytes, the oldest steps get dropped a
+    keyframe at a time. Rebuilt segments are kept in a small LRU so scrubbing back and forth is cheap. """
+    def __init__(self, budget=64 * 1024 * 1024, keyframe_interval=64, cache_size=32):
+        self.budget = budget
+        self.keyframe_interval = keyframe_interval
+        self.cache_size = cache_size
+        self.size = 0
+        self._segments = {}
+        self._pages = {} # page key -> [data, refcount]
+        self._views = OrderedDict()
+
+    def _ref(self, key, data=None):
+        page = self._pages.get(key)
+        if page is None:
+            self._pages[key] = page = [data, 0]
+            self.size += len(data)
+        page[1] += 1
+
+    def _unref(self, key):
+        page = self._pages[key]
+        page[1] -= 1
+        if page[1] == 0:
+            self.size -= len(page[0])
+            del self._pages[key]
+
+    def record(self, step, segment, address, memory, keys=None):
+        """ Records the contents of a segment at the given step. keys is what page_keys returned for
+        the same memory; if it's been worked out already, all that's left here is comparing digests
+        and copying the pages we haven't seen before. """
+        history = self._segments.get(segment)
+        if history is None:
+            history = self._segments[segment] = _SegmentHistory()
+        if keys is None:
+            keys = page_keys(address, memory)
+        delta = {}
+        end = address + len(memory)
+        for page, key in keys:
+            if history._current.get(page) != key:
+                low = page + key[0]
+                self._ref(key, bytes(memory[low - address:min(end, page + page_size) - address]))
+                delta[page] = key
+        history._current.update(delta)
+        entry = history.base + len(history.steps)
+        history.steps.append(step)
+        history.bounds.append((address, len(memory)))
+        history.deltas.append(delta)
+        if entry % self.keyframe_interval == 0:
+            # Only keep the pages that are in the segment right now, so old pages can be let go
+            frame = dict((page, history._current[page])
+                         for page in range(address - (address % page_size), end, page_size))
+            for key in frame.values():
+                self._ref(key)
+            history.keyframes[entry] = frame
+            history._current = dict(frame)
+        while self.size > self.budget and self._evict():
+            pass
+
+    def _evict(self):
+        """ Drops the oldest keyframe's worth of entries from whichever segment goes back furthest.
+        Returns False if there's nothing left that can go. """
+        oldest = None
+        for history in self._segments.values():
+            if len(history.keyframes) > 1 and (oldest is None or history.steps[0] < oldest.steps[0]):
+                oldest = history
+        if oldest is None:
+            return False
+        first = min(oldest.keyframes)
+        count = min(entry for entry in oldest.keyframes if entry != first) - first
+        for key in oldest.keyframes.pop(first).values():
+            self._unref(key)
+        for delta in oldest.deltas[:count]:
+            for key in delta.values():
+                self._unref(key)
+        del oldest.steps[:count]
+        del oldest.bounds[:count]
+        del oldest.deltas[:count]
+        oldest.base += count
+        return True
+
+    def find(self, segment, step):
+        """ Returns the entry number of the last snapshot of a segment taken at or before the given step,
+        or None if there isn't one (or it has been evicted). """
+        history = self._segments.get(segment)
+        if history is None:
+            return None
+        index = bisect_right(history.steps, step) - 1
+        return history.base + index if index >= 0 else None
+
+    def segment_at(self, segment, entry):
+        """ Rebuilds the (address, bytes) of a segment as it was at the given entry """
+        cached = self._views.get((segment, entry))
+        if cached is not None:
+            self._views[(segment, entry)] = self._views.pop((segment, entry))
+            return cached
+        history = self._segments[segment]
+        start = entry - (entry % self.keyframe_interval)
+        pages = dict(history.keyframes[start])
+        for delta in history.deltas[start + 1 - history.base:entry + 1 - history.base]:
+            pages.update(delta)
+        address, length = history.bounds[entry - history.base]
+        end = address + length
+        chunks = []
+        for page in range(address - (address % page_size), end, page_size):
+            low, high = max(address, page), min(end, page + page_size)
+            offset, _digest = pages[page]
+            data = self._pages[pages[page]][0]
+            chunks.append(data[low - page - offset:high - page - offset])
+        view = (address, b''.join(chunks))
+        self._views[(segment, entry)] = view
+        if len(self._views) > self.cache_size:
+            self._views.popitem(last=False)
+        return view
@@ -1,21 +1,34 @@
 from __future__ import print_function
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QColor, QFontDatabase
+from PyQt5.QtGui import QColor, QFontDatabase, QTextCursor
 
 def padhex(val, length):
     return "0x{}".format('0'*(length - len(hex(val)))) + hex(val).split('0x')[1]
 
+max_indent = 64 # Deep recursion would otherwise indent the innermost frames right off the screen
+
 class TracebackWindow(QtWidgets.QWidget):
     """ Displays the traceback of the current execution, as retrieved from GDB/LLDB """
     def __init__(self):
         super(TracebackWindow, self).__init__()
         self.framelist = []
         self.ret_add = 0x0
+        self.page_size = 500 # How many more frames to render each time the user asks
+        self._limit = self.page_size
+        self._rows = []
+        self._first_row = 0
+        self._padlength = None
         self.setWindowTitle("Traceback")
         self.setLayout(QtWidgets.QVBoxLayout())
         self._layout = self.layout()
 
+        # Link to render more of the outer frames when the stack is too deep to show all at once
+        self._more = QtWidgets.QLabel()
+        self._more.setVisible(False)
+        self._more.linkActivated.connect(self.show_more)
+        self._layout.addWidget(self._more)
+
         # Creates the rich text viewer that displays the traceback
         self._textBrowser = QtWidgets.QTextBrowser()
         self._textBrowser.setOpenLinks(False)
@@ -33,15 +46,68 @@ class TracebackWindow(QtWidgets.QWidget):
 
     def update_frames(self, framelist):
         """ Renders the list of frames delivered to the traceback viewer and sets
-        hyperlinks on the addresses of each function within the binary """
-        self._textBrowser.clear()
+        hyperlinks on the addresses of each function within the binary. The outermost frame
+        is drawn first, so we only rewrite the rows after the first frame that changed. """
         padlength = max([len(hex(frame['addr'])) for frame in framelist])
-        for row, frame in enumerate(framelist[::-1]):
-            self._textBrowser.insertPlainText("{}. ".format(len(framelist) - frame['index']))
-            self._textBrowser.insertHtml(" &nbsp;"*row + '<a href=\"{}\">'.format(frame['addr']) +  padhex(frame['addr'], padlength) + '</a>' + ' in ' + str(frame['name']))
-            self._textBrowser.insertPlainText("\n")
+        rows = [(frame['addr'], frame['name']) for frame in framelist[::-1]]
+        # Only render the innermost frames, but keep the first rendered row where it was for
+        # as long as we can so that the rows we've already drawn stay valid.
+        first = self._first_row
+        if first >= len(rows) or len(rows) - first > 2 * self._limit:
+            first = max(len(rows) - self._limit, 0)
+        if padlength != self._padlength or first != self._first_row:
+            changed = first
+            self._rows = []
+        else:
+            changed = first + len(self._rows)
+            for row in range(first, min(len(rows), first + len(self._rows))):
+                if rows[row] != self._rows[row - first]:
+                    changed = row
+                    break
+            # After a return the new list can be a prefix of the old one, and the rows past its end have to go
+            changed = min(changed, len(rows))
+        self._render(rows, first, changed, padlength)
         self.framelist = framelist
 
+    def _row_html(self, row, frame, padlength):
+        addr, name = frame
+        return "{}. ".format(row + 1) + " &nbsp;"*min(row, max_indent) + '<a href=\"{}\">'.format(addr) + \
+            padhex(addr, padlength) + '</a>' + ' in ' + str(name).replace('&', '&amp;').replace('<', '&lt;')
+
+    def _render(self, rows, first, changed, padlength):
+        """ Replaces the rendered rows from changed onwards with a single insertHtml call. Rows we'd
+        drawn past the end of the new list are removed along with the rest. """
+        changed = min(changed, len(rows))
+        keep = max(changed - first, 0)
+        if keep == len(self._rows) and len(rows) - first == keep:
+            return
+        cursor = QTextCursor(self._textBrowser.document())
+        if keep == 0:
+            self._textBrowser.clear()
+        else:
+            # Each row is its own block, so we cut from the end of the last row we're keeping
+            cursor.setPosition(self._textBrowser.document().findBlockByNumber(keep - 1).position())
+            cursor.movePosition(QTextCursor.EndOfBlock)
+            cursor.movePosition(QTextCursor.End, QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+        cursor.movePosition(QTextCursor.End)
+        html = "".join('<p style="margin:0">' + self._row_html(row, rows[row], padlength) + '</p>' for row in range(changed, len(rows)))
+        if keep > 0 and len(html) > 0:
+            cursor.insertBlock()
+        cursor.insertHtml(html)
+        self._rows = rows[first:]
+        self._first_row = first
+        self._padlength = padlength
+        if first > 0:
+            self._more.setText('{} outer frames not shown. <a href="more">Show more</a>'.format(first))
+        self._more.setVisible(first > 0)
+
+    def show_more(self, _link=None):
+        """ Renders another page of the outer frames """
+        self._limit += self.page_size
+        self._first_row = len(self.framelist)
+        self.update_frames(self.framelist)
+
     def update_ret_address(self, addr, label=None):
         """ Displays the return address. No highlight-on-change currently """
         if label is not None:
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import json, os, tempfile
+
+class TracepointHistory(object):
+    """ Every value recorded at one tracepoint. values[i] is the list of values of expressions[i],
+    one per hit, with None wherever the debugger couldn't evaluate the expression. """
+    def __init__(self, address, expressions):
+        self.address = address
+        self.expressions = list(expressions)
+        self.values = [[] for _ in self.expressions]
+        self.hits = 0
+
+    def extend(self, hits):
+        for row in hits:
+            for column, value in zip(self.values, row):
+                column.append(value)
+        self.hits += len(hits)
+
+    def summary(self):
+        """ A few lines describing what we've seen, to go in a comment at the address """
+        lines = ["Tracepoint: {} hits".format(self.hits)]
+        for expression, column in zip(self.expressions, self.values):
+            known = [value for value in column if value is not None]
+            if not known:
+                lines.append("{}: ?".format(expression))
+                continue
+            lines.append("{}: last {:#x}, {} distinct, {:#x}..{:#x}".format(
+                expression, known[-1], len(set(known)), min(known), max(known)))
+        return "\n".join(lines)
+
+class TracepointStore(object):
+    """ Holds the tracepoint configuration and imports the hits the debugger appends to the output file.
+    Each import only reads what was added since the last one, so it's cheap to call after every stop. """
+    def __init__(self):
+        handle, self.path = tempfile.mkstemp(prefix='binja_tracepoints_', suffix='.jsonl')
+        os.close(handle)
+        self.points = OrderedDict()
+        self._offset = 0
+
+    def add(self, address, expressions):
+        self.points[address] = TracepointHistory(address, expressions)
+
+    def __len__(self):
+        return len(self.points)
+
+    def history(self, address):
+        return self.points.get(address)
+
+    def import_new(self):
+        """ Reads whatever the debugger wrote since the last call. Returns the histories that got new hits. """
+        try:
+            if os.path.getsize(self.path) <= self._offset:
+                return []
+            hits = open(self.path)
+        except (IOError, OSError):
+            return [] # Closed while we were on our way here
+        changed = OrderedDict()
+        with hits:
+            hits.seek(self._offset)
+            for line in hits:
+                if not line.endswith('\n'):
+                    break # The debugger is still writing this one, so pick it up next time
+                self._offset += len(line)
+                for address, rows in json.loads(line).items():
+                    history = self.points.get(int(address))
+                    if history is not None:
+                        history.extend(rows)
+                        changed[history.address] = history
+        return list(changed.values())
+
+    def close(self):
+        """ Deletes the output file. The debugger stops writing to it once its tracepoints are cleared. """
+        if os.path.exists(self.path):
+            os.remove(self.path)
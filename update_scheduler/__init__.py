@@ -0,0 +1,76 @@
+from __future__ import print_function
+from PyQt5.QtCore import QThread, pyqtSignal
+import threading, traceback
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from binaryninja import log_error
+from .. import perf_monitor
+
+class UpdateScheduler(QThread):
+    """ Worker thread that runs debugger commands and the state fetch that follows them, so
+    none of the debugger I/O happens on the Qt main thread. Every command gets a generation
+    number. Commands always run in order (each click really does step), but a fetch is only
+    started if no newer command is waiting, and a finished snapshot is only handed back if it's
+    still the newest one. That way a burst of clicks results in a single refresh. """
+    STATE_READY = pyqtSignal(object)
+
+    def __init__(self, fetch):
+        """ fetch is called on the worker thread as fetch(bv, is_stale) and should return a
+        snapshot of the program state, or None if there's nothing to render. is_stale() returns
+        True once a newer command has been scheduled, and fetch should bail out early when it does. """
+        QThread.__init__(self)
+        self._fetch = fetch
+        self._jobs = Queue()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._fetched = 0
+
+    def schedule(self, command, bv):
+        """ Queues a command (a function that takes the binary view) followed by a refresh.
+        Safe to call from any thread. """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self._jobs.put((command, bv, generation))
+        return generation
+
+    def is_stale(self, generation):
+        """ True if a newer command has been scheduled since the given generation """
+        return generation != self._generation
+
+    def idle(self):
+        """ True if every command scheduled so far has been followed by a fetch. When it's False,
+        the next command will be coalesced with the ones before it. """
+        return self._fetched == self._generation
+
+    def stop(self):
+        """ Asks the worker to exit once it finishes whatever it's doing """
+        self._jobs.put(None)
+
+    def run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            command, bv, generation = job
+            perf_monitor.current_step = generation
+            try:
+                with perf_monitor.stage("command"):
+                    command(bv)
+            except Exception:
+                log_error(traceback.format_exc())
+            if self.is_stale(generation):
+                # Another command is already queued behind this one, so skip straight to it
+                continue
+            self._fetched = generation
+            try:
+                with perf_monitor.stage("fetch"):
+                    snapshot = self._fetch(bv, lambda: self.is_stale(generation))
+            except Exception:
+                log_error(traceback.format_exc())
+                continue
+            if snapshot is not None and not self.is_stale(generation):
+                self.STATE_READY.emit((generation, snapshot))